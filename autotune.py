@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+自动调参：在真实的 QwenEnhancedDrugSynergyModel 上，用最坏情况的 batch (训练集中文本最长、原子最多的样本) 跑完整的
+训练步 (autocast 前向 + 反向 + AdamW 更新)，按显存 (CUDA) 或进程 RSS (CPU) 预算探测能容纳的最大 batch_size：
+倍增直到超出预算或 OOM，再二分回退。随后对候选 batch_size 与 DataLoader worker 数 (以及设备常驻加载) 的组合
+实测训练吞吐，把 samples/s 最高的组合写入 autotune_config.json，main.py 启动时自动读取。
+
+用法:
+    python autotune.py                                   # 使用 main.py 的模型配置，预算默认为显存的 90%
+    python autotune.py --memory-budget-gb 40 --workers 0,2,4,8
+    python autotune.py --qwen-model cache/tiny_qwen --gcn-config '{"in_feats":64,"hidden_size":16,"out_feats":32}' \\
+        --memory-budget-gb 3 --out /tmp/autotune_config.json   # 无 GPU 时按 RSS 预算在 CPU 上验证
+"""
+import os
+import gc
+import json
+import time
+import ctypes
+import argparse
+import threading
+
+import torch
+
+from instrumentation import current_rss_bytes
+
+AUTOTUNE_VERSION = 1
+
+
+def describe_device(device):
+    """写入配置的设备描述：换了 GPU 型号后旧的调参结果不再适用"""
+    if device.type == 'cuda':
+        return f"cuda:{torch.cuda.get_device_name(device)}"
+    return device.type
+
+
+def load_autotune_config(path, **expected):
+    """
+    读取 autotune.py 写出的配置；文件不存在或记录的模型 / 设备与 expected 不一致时返回 None
+    :param expected: 需要一致的字段，如 device=..., model={...}
+    """
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    mismatched = [key for key, value in expected.items() if config.get(key) != value]
+    if mismatched:
+        print(f"{path} 的调参结果与当前 {', '.join(mismatched)} 不一致，使用默认配置 (请重新运行 autotune.py)")
+        return None
+    return config
+
+
+def _default_budget(device):
+    """默认预算：CUDA 为显存的 90%；CPU 为 (当前 RSS + 可用内存) 的 80%"""
+    if device.type == 'cuda':
+        return int(torch.cuda.get_device_properties(device).total_memory * 0.9)
+    with open('/proc/meminfo') as f:
+        available = next(int(line.split()[1]) * 1024 for line in f if line.startswith('MemAvailable'))
+    return int((current_rss_bytes() + available) * 0.8)
+
+
+def _release_memory(device):
+    gc.collect()
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+    else:
+        # glibc 不会主动把释放的小块内存还给系统，否则上一次试验的 RSS 会计入下一次
+        try:
+            ctypes.CDLL('libc.so.6').malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+
+def _is_oom(error):
+    if isinstance(error, (torch.cuda.OutOfMemoryError, MemoryError)):
+        return True
+    message = str(error)
+    return isinstance(error, RuntimeError) and ('out of memory' in message or "can't allocate memory" in message)
+
+
+class PeakMemoryMonitor:
+    """一次试验期间的峰值内存：CUDA 为 max_memory_reserved，CPU 为后台线程按 interval 秒采样的进程 RSS"""
+
+    def __init__(self, device, interval=0.001):
+        self.device = device
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self.peak = current_rss_bytes()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            self.peak = torch.cuda.max_memory_reserved(self.device)
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, current_rss_bytes())
+        return False
+
+
+def probe_batch_size(trial, start=8, max_batch=1024, multiple=8):
+    """
+    :param trial: fn(batch_size) -> bool，能否在预算内完成训练步
+    :param multiple: 二分的粒度，结果 (不小于 multiple 时) 为其整数倍
+    :return: 可容纳的最大 batch_size，batch_size=1 也放不下时为 0
+    起点放不下时逐次减半回退；放得下时倍增到首次失败 (或 max_batch)，再在最后一次成功与首次失败之间二分
+    """
+    low, high, size = 0, None, start
+    while size >= 1:
+        if trial(size):
+            low = size
+            break
+        high, size = size, size // 2
+    if low == 0:
+        return 0
+
+    if high is None:
+        size = low * 2
+        while size <= max_batch:
+            if not trial(size):
+                high = size
+                break
+            low, size = size, size * 2
+        if high is None:
+            return low
+
+    step = multiple if low >= multiple else 1
+    while True:
+        mid = (low + high) // 2 // step * step
+        if mid <= low:
+            return low
+        if trial(mid):
+            low = mid
+        else:
+            high = mid
+
+
+def _timed_epoch(trainer, loader):
+    trainer.train_loader = loader
+    if trainer.device.type == 'cuda':
+        torch.cuda.synchronize(trainer.device)
+    start = time.perf_counter()
+    trainer.train_epoch(1)
+    if trainer.device.type == 'cuda':
+        torch.cuda.synchronize(trainer.device)
+    return time.perf_counter() - start
+
+
+def measure_throughput(trainer, make_loader, batches, warmup=3):
+    """
+    用训练器真实的 train_epoch 测吞吐：先只跑前 warmup 个 batch，再跑全部 batch，两次耗时之差对应后面的 batch，
+    worker 启动、首次分配等固定开销在差值中抵消
+    :param make_loader: fn(batch 下标列表的列表) -> loader
+    :return: samples/s
+    """
+    warm_time = _timed_epoch(trainer, make_loader(batches[:warmup]))
+    total_time = _timed_epoch(trainer, make_loader(batches))
+    samples = sum(len(batch) for batch in batches[warmup:])
+    return samples / max(total_time - warm_time, 1e-9)
+
+
+def main():
+    from torch.utils.data import DataLoader, random_split
+    from main import QWEN_MODEL_NAME, GCN_CONFIG, LORA_CONFIG, BUNDLE_PATH, GRAPH_CACHE_PATH, build_processor
+    from model import QwenEnhancedDrugSynergyModel
+    from trainer import ImprovedDrugSynergyTrainer
+    from dataset import DrugSynergyDataset
+    from utils import SmilesTokenCache, create_tokenized_collate_fn, create_packed_collate_fn
+    from sampler import LengthBucketBatchSampler, compute_pair_lengths
+    from device_loader import DeviceResidentLoader
+
+    parser = argparse.ArgumentParser(description="探测最大 batch_size 并实测选择 batch_size / DataLoader worker 数")
+    parser.add_argument('--qwen-model', default=QWEN_MODEL_NAME)
+    parser.add_argument('--gcn-config', type=json.loads, default=GCN_CONFIG)
+    parser.add_argument('--lora-config', type=json.loads, default=LORA_CONFIG)
+    parser.add_argument('--bundle', default=BUNDLE_PATH)
+    parser.add_argument('--graph-cache', default=GRAPH_CACHE_PATH)
+    parser.add_argument('--precision', default='bf16', choices=['fp32', 'bf16'])
+    parser.add_argument('--memory-budget-gb', type=float, default=None,
+                        help="显存 (CUDA) 或 RSS (CPU) 预算，默认显存的 90%% / 内存的 80%%")
+    parser.add_argument('--start-batch', type=int, default=8)
+    parser.add_argument('--max-batch', type=int, default=1024)
+    parser.add_argument('--multiple', type=int, default=8, help="batch_size 取该值的整数倍")
+    parser.add_argument('--workers', default='0,2,4,8', help="候选 DataLoader worker 数 (超过 CPU 核数的会被跳过)")
+    parser.add_argument('--throughput-batches', type=int, default=20, help="每个组合计时的 batch 数")
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--out', default='autotune_config.json')
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    budget = int(args.memory_budget_gb * 2 ** 30) if args.memory_budget_gb else _default_budget(device)
+    print(f"设备 {describe_device(device)}，{'显存' if device.type == 'cuda' else 'RSS'} 预算 {budget / 2 ** 30:.2f} GB")
+
+    # 与 main.py 相同的数据处理与 8:1:1 划分，只在训练集上调参
+    processor = build_processor(args.bundle, args.graph_cache)
+    full_dataset = DrugSynergyDataset.from_bundle(processor)
+    total_size = len(full_dataset)
+    train_size, val_size = int(0.8 * total_size), int(0.1 * total_size)
+    train_dataset, _, _ = random_split(full_dataset, [train_size, val_size, total_size - train_size - val_size],
+                                       generator=torch.Generator().manual_seed(42))
+
+    model = QwenEnhancedDrugSynergyModel(gcn_config=args.gcn_config, qwen_model_name=args.qwen_model,
+                                         target_dim=processor.target_dim, cell_dim=processor.cell_dim,
+                                         physchem_dim=processor.physchem_dim, lora_config=args.lora_config)
+    token_cache = SmilesTokenCache(model.tokenizer)
+    trainer = ImprovedDrugSynergyTrainer(model, None, None, None, device, precision=args.precision,
+                                         metrics_log=None)
+    lengths, atoms = compute_pair_lengths(train_dataset, processor, token_cache)
+
+    # 1. 最大 batch_size：文本最长、原子最多的样本组成的 batch 连跑两步 (第一步之后才分配 AdamW 状态)
+    worst_order = sorted(range(len(lengths)), key=lambda i: (int(lengths[i]), int(atoms[i])), reverse=True)
+    trials = []
+
+    def trial(batch_size):
+        batches = [worst_order[:batch_size]] * 2
+        loader = DeviceResidentLoader(train_dataset, processor, device, batch_sampler=batches, token_cache=token_cache)
+        _release_memory(device)
+        monitor = PeakMemoryMonitor(device)
+        try:
+            with monitor:
+                trainer.train_loader = loader
+                trainer.train_epoch(1)
+            fits, peak = monitor.peak <= budget, monitor.peak
+        except Exception as e:
+            if not _is_oom(e):
+                raise
+            fits, peak = False, None
+        trainer.optimizer.zero_grad(set_to_none=True)
+        del loader
+        _release_memory(device)
+        trials.append({'batch_size': batch_size, 'peak_bytes': peak, 'fits': fits})
+        peak_text = 'OOM' if peak is None else f"{peak / 2 ** 30:.2f} GB"
+        print(f"  batch_size={batch_size}: 峰值 {peak_text} -> {'可以' if fits else '超出预算'}")
+        return fits
+
+    print("探测最大 batch_size (最坏情况 batch)...")
+    max_batch = probe_batch_size(trial, start=args.start_batch, max_batch=args.max_batch, multiple=args.multiple)
+    if max_batch == 0:
+        raise SystemExit("batch_size=1 也超出内存预算")
+    print(f"最大 batch_size: {max_batch}")
+
+    # 2. 候选 batch_size × 加载方式的实测吞吐 (分桶采样的真实 batch)
+    worker_counts = [int(w) for w in args.workers.split(',') if w.strip()]
+    worker_counts = [w for w in worker_counts if w <= (os.cpu_count() or 1)]
+    if any(worker_counts):
+        # 与 main.py 一致：多 worker 时特征矩阵放入共享内存
+        processor.share_memory()
+    full_dataset.include_graphs = False
+    collate_fn = create_tokenized_collate_fn(token_cache, create_packed_collate_fn(processor))
+
+    results = []
+    for batch_size in sorted({max_batch, max(max_batch // 2, 1)}, reverse=True):
+        sampler = LengthBucketBatchSampler(lengths, atoms, batch_size=batch_size, shuffle=True)
+        batches = [[int(i) for i in batch] for batch in sampler._make_batches()[:args.warmup + args.throughput_batches]]
+        loaders = {'device': lambda b: DeviceResidentLoader(train_dataset, processor, device, batch_sampler=b,
+                                                            token_cache=token_cache)}
+        for workers in worker_counts:
+            loaders[f'workers={workers}'] = lambda b, w=workers: DataLoader(
+                train_dataset, batch_sampler=b, collate_fn=collate_fn, num_workers=w,
+                pin_memory=device.type == 'cuda')
+        for name, make_loader in loaders.items():
+            samples_per_sec = measure_throughput(trainer, make_loader, batches, warmup=args.warmup)
+            results.append({'batch_size': batch_size, 'loader': name, 'samples_per_sec': samples_per_sec})
+            print(f"  batch_size={batch_size} {name}: {samples_per_sec:.1f} samples/s")
+
+    best = max(results, key=lambda r: r['samples_per_sec'])
+    device_resident = best['loader'] == 'device'
+    config = {
+        'version': AUTOTUNE_VERSION,
+        'batch_size': best['batch_size'],
+        'device_resident': device_resident,
+        'num_workers': 0 if device_resident else int(best['loader'].split('=')[1]),
+        'samples_per_sec': best['samples_per_sec'],
+        'max_batch_size': max_batch,
+        'memory_budget_bytes': budget,
+        'device': describe_device(device),
+        'model': {'qwen': args.qwen_model, 'gcn': args.gcn_config, 'lora': args.lora_config,
+                  'precision': args.precision},
+        'probe_trials': trials,
+        'throughput': results,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+    with open(f"{args.out}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=2, ensure_ascii=False)
+    os.replace(f"{args.out}.tmp", args.out)
+    loader_text = '设备常驻加载' if device_resident else f"DataLoader num_workers={config['num_workers']}"
+    print(f"选择 batch_size={config['batch_size']}, {loader_text} ({best['samples_per_sec']:.1f} samples/s)，"
+          f"已写入 {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+离线性能基准：数据管线微基准、DataLoader 吞吐、小型本地 Qwen2 的前向/反向耗时与峰值内存。
+结果输出为 JSON，并可与保存的基线对比，超出容忍度的指标会被标记为回退 (退出码 1)。
+
+用法:
+    python benchmark.py --out bench.json                      # 运行并保存结果
+    python benchmark.py --baseline bench_baseline.json        # 与基线对比
+    python benchmark.py --out bench_baseline.json --quick     # 快速模式生成基线
+
+worker 内存测量依赖 psutil (未安装时跳过)。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from instrumentation import time_it, current_rss_bytes, peak_rss_bytes
+
+DATA_FILES = ('merged_drug_data_complete.csv', 'Drug_Target_Protein.csv', 'cell_ge_1024_features.csv')
+SYNERGY_FILE = 'two_class_synergy_data.csv'
+TINY_GCN_CONFIG = {'in_feats': 64, 'hidden_size': 32, 'out_feats': 64}
+
+
+def _metric(value, unit, higher_is_better=False):
+    return {'value': float(value), 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+def bench_data_pipeline(processor, dataset, repeat):
+    """process_sample / smiles_to_graph / collate_fn 微基准"""
+    from utils import collate_fn, create_packed_collate_fn
+
+    results = {}
+    row = dataset.data.iloc[0]
+    results['process_sample'] = _metric(
+        time_it(lambda: processor.process_sample(row['Drug1'], row['Drug2'], row['Cell_line']), repeat), 'ms')
+    if getattr(processor, 'use_feature_store', False):
+        ids = dataset.sample_ids[0].tolist()
+        results['process_ids'] = _metric(time_it(lambda: processor.process_ids(*ids), repeat), 'ms')
+
+    smiles = processor.get_drug_smiles(row['Drug1'])
+    results['smiles_to_graph_cached'] = _metric(time_it(lambda: processor.smiles_to_graph(smiles), repeat), 'ms')
+    results['smiles_to_graph_parse'] = _metric(time_it(lambda: processor._featurize_smiles(smiles), repeat), 'ms')
+
+    samples = [dataset[i] for i in range(32)]
+    results['collate_fn_b32'] = _metric(time_it(lambda: collate_fn(samples), repeat), 'ms')
+    if getattr(processor, 'use_feature_store', False):
+        # 按药物 ID 从打包数组拼图；样本本身不再带分子图 (include_graphs=False)
+        packed_collate_fn = create_packed_collate_fn(processor)
+        id_samples = [processor.process_ids(*dataset.sample_ids[i].tolist(), include_graphs=False) for i in range(32)]
+        for sample in id_samples:
+            sample['labels'] = torch.tensor(0)
+        results['collate_packed_b32'] = _metric(time_it(lambda: packed_collate_fn(id_samples), repeat), 'ms')
+        results['process_ids_no_graph'] = _metric(
+            time_it(lambda: processor.process_ids(*ids, include_graphs=False), repeat), 'ms')
+    return results
+
+
+def bench_dataloader(dataset, worker_counts, num_batches, batch_size=32):
+    """不同 worker 数下 DataLoader 的样本吞吐"""
+    from utils import collate_fn
+
+    results = {}
+    subset = Subset(dataset, range(min(len(dataset), num_batches * batch_size)))
+    for num_workers in worker_counts:
+        loader = DataLoader(subset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn,
+                            num_workers=num_workers)
+        start = time.perf_counter()
+        count = sum(len(batch['labels']) for batch in loader)
+        elapsed = time.perf_counter() - start
+        results[f'dataloader_workers{num_workers}'] = _metric(count / elapsed, 'samples/s', higher_is_better=True)
+    return results
+
+
+def bench_device_loader(processor, dataset, num_batches, batch_size=32):
+    """设备常驻模式 (特征与打包分子图一次性放在设备上，batch 由下标 gather 生成) 的样本吞吐，与 DataLoader 对比"""
+    from device_loader import DeviceResidentLoader
+
+    subset = Subset(dataset, range(min(len(dataset), num_batches * batch_size)))
+    loader = DeviceResidentLoader(subset, processor, torch.device('cpu'), batch_size=batch_size)
+    start = time.perf_counter()
+    count = sum(len(batch['labels']) for batch in loader)
+    elapsed = time.perf_counter() - start
+    return {'device_resident_loader': _metric(count / elapsed, 'samples/s', higher_is_better=True)}
+
+
+def _worker_memory(dataset, num_workers, num_batches, context, batch_size=32):
+    """启动 DataLoader worker 并取若干 batch 后，读取各 worker 的 USS (独占内存) 与 PSS (共享页按进程数分摊)"""
+    import psutil
+    from utils import collate_fn
+
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=collate_fn, num_workers=num_workers,
+                        persistent_workers=True, multiprocessing_context=context)
+    data_iter = iter(loader)
+    for _ in range(num_batches):
+        next(data_iter)
+    infos = [psutil.Process(w.pid).memory_full_info() for w in data_iter._workers]
+    del data_iter, loader
+    return sum(i.uss for i in infos) / len(infos) / 2 ** 20, sum(i.pss for i in infos) / 2 ** 20
+
+
+def bench_worker_memory(bundle_path, worker_counts, num_batches, contexts=('fork', 'spawn')):
+    """
+    不使用磁盘图缓存 (分子图存于进程内)，对比 share_memory() 前后每个 worker 的额外常驻内存：
+    worker_uss 为单个 worker 平均独占内存，worker_pss_total 为全部 worker 的 PSS 之和
+    """
+    try:
+        import psutil  # noqa: F401
+    except ImportError:
+        print("未安装 psutil，跳过 worker 内存测量")
+        return {}
+    from data_processor import DrugCellDataProcessor
+    from dataset import DrugSynergyDataset
+
+    results = {}
+    for shared in (False, True):
+        processor = DrugCellDataProcessor.from_bundle(bundle_path, precompute_jobs=1)
+        if shared:
+            processor.share_memory()
+        dataset = DrugSynergyDataset.from_bundle(processor)
+        tag = 'shared' if shared else 'private'
+        for context in contexts:
+            for num_workers in worker_counts:
+                if num_workers == 0:
+                    continue
+                uss, pss = _worker_memory(dataset, num_workers, num_batches, context)
+                results[f'worker_uss_{tag}_{context}_w{num_workers}'] = _metric(uss, 'MB')
+                results[f'worker_pss_total_{tag}_{context}_w{num_workers}'] = _metric(pss, 'MB')
+    return results
+
+
+def bench_model(processor, dataset, tiny_qwen_dir, repeat, batch_size=16):
+    """小型本地 Qwen2 配置下的前向、前向+反向耗时与峰值内存"""
+    from model import QwenEnhancedDrugSynergyModel
+    from utils import SmilesTokenCache, build_tiny_qwen, create_tokenized_collate_fn
+
+    if not os.path.exists(os.path.join(tiny_qwen_dir, 'config.json')):
+        build_tiny_qwen(tiny_qwen_dir, processor.drug_smiles_map.values())
+
+    torch.manual_seed(0)
+    model = QwenEnhancedDrugSynergyModel(
+        gcn_config=TINY_GCN_CONFIG,
+        qwen_model_name=tiny_qwen_dir,
+        target_dim=processor.target_dim,
+        cell_dim=processor.cell_dim,
+        physchem_dim=processor.physchem_dim
+    )
+    collate = create_tokenized_collate_fn(SmilesTokenCache(model.tokenizer))
+    batch = collate([dataset[i] for i in range(batch_size)])
+    criterion = torch.nn.CrossEntropyLoss()
+
+    def forward():
+        with torch.no_grad():
+            model(batch)
+
+    def forward_backward():
+        model.zero_grad(set_to_none=True)
+        criterion(model(batch), batch['labels']).backward()
+
+    results = {}
+    model.eval()
+    results['model_forward_b16'] = _metric(time_it(forward, repeat, warmup=2), 'ms')
+    model.train()
+    rss_before = current_rss_bytes() / 2 ** 20
+    results['model_forward_backward_b16'] = _metric(time_it(forward_backward, repeat, warmup=2), 'ms')
+    results['model_train_step_rss_growth'] = _metric(current_rss_bytes() / 2 ** 20 - rss_before, 'MB')
+    if torch.cuda.is_available():
+        results['cuda_peak_allocated'] = _metric(torch.cuda.max_memory_allocated() / 2 ** 20, 'MB')
+    return results
+
+
+def run(args):
+    import logging
+    logging.disable(logging.WARNING)
+    from data_processor import DrugCellDataProcessor
+    from dataset import DrugSynergyDataset
+
+    repeat = 10 if args.quick else 50
+    start = time.perf_counter()
+    processor = DrugCellDataProcessor(*DATA_FILES, use_feature_store=True, graph_cache_path=args.graph_cache)
+    results = {'processor_init': _metric((time.perf_counter() - start) * 1000, 'ms')}
+    dataset = DrugSynergyDataset(SYNERGY_FILE, processor)
+
+    # 二进制数据包：预先构建一次，只计打开耗时
+    DrugCellDataProcessor.from_bundle(args.bundle)
+    start = time.perf_counter()
+    bundle_processor = DrugCellDataProcessor.from_bundle(args.bundle, graph_cache_path=args.graph_cache)
+    DrugSynergyDataset.from_bundle(bundle_processor)
+    results['bundle_open'] = _metric((time.perf_counter() - start) * 1000, 'ms')
+
+    results.update(bench_data_pipeline(processor, dataset, repeat))
+    results.update(bench_dataloader(dataset, args.workers, num_batches=5 if args.quick else 30))
+    results.update(bench_device_loader(processor, dataset, num_batches=5 if args.quick else 30))
+    if not args.skip_memory:
+        results.update(bench_worker_memory(args.bundle, args.workers, num_batches=5 if args.quick else 20))
+    if not args.skip_model:
+        results.update(bench_model(processor, dataset, args.tiny_qwen_dir, repeat=3 if args.quick else 10))
+    results['peak_rss'] = _metric(peak_rss_bytes() / 2 ** 20, 'MB')
+
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'cpu_count': os.cpu_count(),
+            'quick': args.quick
+        },
+        'results': results
+    }
+
+
+def compare(current, baseline, tolerance):
+    """与基线逐项对比，返回回退的指标列表"""
+    regressions = []
+    print(f"{'metric':<36}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, cur in current['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if base is None or base['value'] == 0:
+            continue
+        change = (cur['value'] - base['value']) / base['value']
+        worse = -change if cur['higher_is_better'] else change
+        flag = ''
+        if worse > tolerance:
+            flag = '  <-- REGRESSION'
+            regressions.append(name)
+        print(f"{name:<36}{base['value']:>12.3f}{cur['value']:>12.3f}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="药物协同模型离线性能基准")
+    parser.add_argument('--out', help="结果 JSON 输出路径")
+    parser.add_argument('--baseline', help="对比的基线 JSON")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="允许的相对退化比例")
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4])
+    parser.add_argument('--graph-cache', default='cache/drug_graphs.bin')
+    parser.add_argument('--bundle', default='cache/dataset.bundle')
+    parser.add_argument('--tiny-qwen-dir', default='cache/tiny_qwen')
+    parser.add_argument('--skip-model', action='store_true', help="跳过模型前向/反向基准")
+    parser.add_argument('--skip-memory', action='store_true', help="跳过 DataLoader worker 内存测量")
+    parser.add_argument('--quick', action='store_true', help="减少重复次数，快速运行")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"基准结果已写入 {args.out}")
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"检测到 {len(regressions)} 项性能回退: {', '.join(regressions)}")
+            sys.exit(1)
+        print("未检测到性能回退")
+
+
+if __name__ == '__main__':
+    main()
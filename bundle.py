@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+紧凑的二进制数据集包：把药物、靶点、细胞系与协同数据 CSV 一次性编译为单个文件，
+包含词表 (药物/细胞系/靶点名称、SMILES)、int32 的样本对与标签、float32 特征矩阵，以及源文件校验和。
+DrugCellDataProcessor.from_bundle / DrugSynergyDataset.from_bundle 以 memmap 方式打开，启动时不再解析 CSV；
+源文件内容变化后校验和不一致，会自动重新构建。
+
+用法:
+    python bundle.py build                        # 用默认的四个 CSV 构建 cache/dataset.bundle
+    python bundle.py build --out my.bundle --synergy balanced_synergy_data.csv
+"""
+import os
+import time
+import hashlib
+import logging
+import argparse
+
+import numpy as np
+
+from graph_store import write_packed, read_packed_header, open_packed_arrays
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b'DSBUNDL1'
+# 编译逻辑 (列的含义、词表规则) 变化时递增，使旧包失效
+BUNDLE_VERSION = 1
+
+DEFAULT_SOURCES = {
+    'drug_data_file': 'merged_drug_data_complete.csv',
+    'drug_target_file': 'Drug_Target_Protein.csv',
+    'cell_line_file': 'cell_ge_1024_features.csv',
+    'synergy_file': 'two_class_synergy_data.csv'
+}
+
+
+def source_checksum(sources):
+    """按固定顺序对各源文件的内容做 sha1"""
+    digest = hashlib.sha1(f"bundle-v{BUNDLE_VERSION}".encode('utf-8'))
+    for name in sorted(sources):
+        digest.update(name.encode('utf-8'))
+        with open(sources[name], 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DataBundle:
+    """已打开的数据包：header 为词表等元数据，arrays 为写时复制的 memmap 数组"""
+
+    def __init__(self, path, header, arrays):
+        self.path = path
+        self.header = header
+        self.arrays = arrays
+
+    def __getattr__(self, name):
+        header = self.__dict__.get('header') or {}
+        if name in header:
+            return header[name]
+        raise AttributeError(name)
+
+    def __getstate__(self):
+        # 传给 DataLoader worker 时只传路径与元数据，在子进程中重新 memmap
+        state = self.__dict__.copy()
+        state['arrays'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.arrays = open_packed_arrays(self.path, self.header, mode='c')
+
+
+def build_bundle(path, sources=None):
+    """解析 CSV (沿用 DrugCellDataProcessor / DrugSynergyDataset 的清洗逻辑) 并写出数据包"""
+    from data_processor import DrugCellDataProcessor
+    from dataset import DrugSynergyDataset
+
+    sources = dict(DEFAULT_SOURCES, **(sources or {}))
+    start_time = time.time()
+    processor = DrugCellDataProcessor(sources['drug_data_file'], sources['drug_target_file'],
+                                      sources['cell_line_file'], use_feature_store=True)
+    dataset = DrugSynergyDataset(sources['synergy_file'], processor)
+
+    header = {
+        'version': BUNDLE_VERSION,
+        'checksum': source_checksum(sources),
+        'sources': {name: os.path.abspath(p) for name, p in sources.items()},
+        'drug_names': processor.drug_names,
+        'drug_smiles_by_id': processor.drug_smiles_by_id,
+        # 只有 SMILES 有效的药物会参与图预计算，单独记录
+        'drug_smiles_map': processor.drug_smiles_map,
+        # 细胞系文件中缺失名称的行在 pandas 中为 NaN，词表统一存为字符串
+        'cell_names': [str(name) for name in processor.cell_names],
+        'physchem_columns': [str(c) for c in processor.drug_physchem.columns],
+        'target_names': [str(c) for c in processor.drug_targets.columns]
+    }
+    arrays = {
+        'physchem': processor.physchem_tensor.numpy(),
+        'target': processor.target_tensor.numpy(),
+        'cell': processor.cell_tensor.numpy(),
+        'pairs': dataset.sample_ids.numpy().astype(np.int32),
+        'labels': dataset.labels.numpy().astype(np.int32)
+    }
+    write_packed(path, _MAGIC, header, arrays)
+    logger.info(f"数据包已写入 {path}: {len(processor.drug_names) - 1} 个药物, {len(processor.cell_names) - 1} 个细胞系, "
+                f"{len(arrays['pairs'])} 个样本，耗时 {time.time() - start_time:.2f}s")
+
+
+def load_bundle(path, sources=None, rebuild=True):
+    """
+    打开数据包；文件缺失、版本或源文件校验和不一致时重新构建
+    :param sources: 源 CSV 路径 (键同 DEFAULT_SOURCES)，None 表示使用包内记录的路径；源文件不存在时跳过校验
+    """
+    header = None
+    build_sources = sources
+    if os.path.exists(path):
+        try:
+            header = read_packed_header(path, _MAGIC)
+        except Exception as e:
+            logger.warning(f"数据包 {path} 无法读取: {e}")
+
+    if header is not None and header.get('version') == BUNDLE_VERSION:
+        check_sources = build_sources = dict(header['sources'], **(sources or {}))
+        if not all(os.path.exists(p) for p in check_sources.values()):
+            logger.warning("数据包的源文件不存在，跳过校验和检查")
+        elif source_checksum(check_sources) != header['checksum']:
+            logger.info("源文件已变化，重新构建数据包")
+            header = None
+    else:
+        header = None
+
+    if header is None:
+        if not rebuild:
+            raise FileNotFoundError(f"数据包不可用: {path}")
+        build_bundle(path, build_sources)
+        header = read_packed_header(path, _MAGIC)
+    return DataBundle(path, header, open_packed_arrays(path, header, mode='c'))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="编译二进制数据包")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help="由 CSV 构建数据包")
+    build.add_argument('--out', default='cache/dataset.bundle')
+    build.add_argument('--drug-data', default=DEFAULT_SOURCES['drug_data_file'])
+    build.add_argument('--drug-target', default=DEFAULT_SOURCES['drug_target_file'])
+    build.add_argument('--cell-line', default=DEFAULT_SOURCES['cell_line_file'])
+    build.add_argument('--synergy', default=DEFAULT_SOURCES['synergy_file'])
+    args = parser.parse_args()
+
+    build_bundle(args.out, {
+        'drug_data_file': args.drug_data,
+        'drug_target_file': args.drug_target,
+        'cell_line_file': args.cell_line,
+        'synergy_file': args.synergy
+    })
+
+
+if __name__ == '__main__':
+    main()
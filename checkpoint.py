@@ -0,0 +1,173 @@
+import os
+import glob
+import json
+import random
+import threading
+
+import numpy as np
+import torch
+
+LATEST_FILE = 'latest.json'
+
+
+def _unwrap(model):
+    """DDP 等包装器下取出真正的模型"""
+    return model.module if hasattr(model, 'module') else model
+
+
+def _to_cpu(obj):
+    """递归地把张量拷贝到 CPU (得到与训练继续进行互不影响的快照)"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def trainable_state_dict(model):
+    """
+    只保存需要训练的参数 (Qwen 解冻的部分 + GAT/投影/分类头)，以及 Qwen 之外子模块的 buffer
+    (如 BatchNorm 的 running 统计量)；冻结的 Qwen 基座在恢复时直接从预训练权重重建
+    """
+    model = _unwrap(model)
+    state = {name: param for name, param in model.named_parameters() if param.requires_grad}
+    state.update({name: buf for name, buf in model.named_buffers() if not name.startswith('qwen.')})
+    return _to_cpu(state)
+
+
+def rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state()
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def build_checkpoint(model, optimizer, scheduler, epoch, extra=None):
+    """在主线程上生成 CPU 快照，之后的序列化可放到后台线程"""
+    return {
+        'epoch': epoch,
+        'model': trainable_state_dict(model),
+        'optimizer': _to_cpu(optimizer.state_dict()),
+        'scheduler': scheduler.state_dict() if scheduler is not None else None,
+        'rng': rng_state(),
+        'extra': extra or {}
+    }
+
+
+class AsyncCheckpointer:
+    """后台线程写 checkpoint：训练线程只负责拍快照，torch.save 与落盘不阻塞训练"""
+
+    def __init__(self, checkpoint_dir, keep_last=2):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self._thread = None
+        self._error = None
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def save(self, checkpoint):
+        # 同一时刻只允许一个写线程，上一次还没写完时先等待
+        self.wait()
+        path = os.path.join(self.checkpoint_dir, f"checkpoint_epoch{checkpoint['epoch']:04d}.pt")
+        self._thread = threading.Thread(target=self._write, args=(checkpoint, path), daemon=True)
+        self._thread.start()
+        return path
+
+    def _write(self, checkpoint, path):
+        try:
+            tmp_path = f"{path}.tmp"
+            torch.save(checkpoint, tmp_path)
+            os.replace(tmp_path, path)
+
+            latest = os.path.join(self.checkpoint_dir, LATEST_FILE)
+            with open(f"{latest}.tmp", 'w', encoding='utf-8') as f:
+                json.dump({'epoch': checkpoint['epoch'], 'path': os.path.basename(path)}, f)
+            os.replace(f"{latest}.tmp", latest)
+
+            old = sorted(glob.glob(os.path.join(self.checkpoint_dir, 'checkpoint_epoch*.pt')))
+            for stale in old[:-self.keep_last] if self.keep_last else []:
+                os.remove(stale)
+        except Exception as e:
+            self._error = e
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f"保存 checkpoint 失败: {error}") from error
+
+
+def resolve_checkpoint(path):
+    """path 可以是 checkpoint 文件或目录 (取目录下 latest.json 指向的最新文件)"""
+    if os.path.isdir(path):
+        latest = os.path.join(path, LATEST_FILE)
+        if not os.path.exists(latest):
+            return None
+        with open(latest, 'r', encoding='utf-8') as f:
+            return os.path.join(path, json.load(f)['path'])
+    return path if os.path.exists(path) else None
+
+
+def load_model_state(model, state):
+    """
+    在已从预训练权重构建好的模型上加载 (增量) 权重：冻结参数可以缺失，
+    缺少任何可训练参数或出现模型中不存在的键时报错
+    """
+    target = _unwrap(model)
+    missing, unexpected = target.load_state_dict(state, strict=False)
+
+    trainable = {name for name, param in target.named_parameters() if param.requires_grad}
+    missing_trainable = trainable & set(missing)
+    if missing_trainable or unexpected:
+        message = f"checkpoint 与模型结构不匹配: 缺少 {sorted(missing_trainable)[:5]}, 多余 {sorted(unexpected)[:5]}"
+        # 全秩微调的键为 ...q_proj.weight，LoRA 模型中为 ...q_proj.base.weight / lora_A / lora_B
+        if any('.lora_' in name or '.base.' in name for name in missing_trainable | set(unexpected)):
+            message += ("。权重与模型的 LoRA 设置不一致：请传入与训练时相同的 --lora-config "
+                        "(main.py 中为 LORA_CONFIG)，全秩微调的权重传 null")
+        raise RuntimeError(message)
+
+
+def load_model_weights(model, path, map_location='cpu'):
+    """
+    只加载模型权重 (推理 / 蒸馏用)：path 可以是 state_dict 文件、训练器的 checkpoint 文件或 checkpoint 目录 (取最新)
+    :return: 实际读取的文件路径
+    """
+    checkpoint_path = resolve_checkpoint(path)
+    if checkpoint_path is None:
+        raise FileNotFoundError(f"未找到模型权重: {path}")
+    state = torch.load(checkpoint_path, map_location=map_location, weights_only=False)
+    if 'model' in state and 'epoch' in state:
+        state = state['model']
+    load_model_state(model, state)
+    return checkpoint_path
+
+
+def load_checkpoint(path, model, optimizer=None, scheduler=None, map_location='cpu'):
+    """
+    在已从预训练权重构建好的模型上加载增量权重，并恢复优化器、调度器与随机数状态
+    :return: checkpoint 字典 (含 epoch 与 extra)
+    """
+    checkpoint = torch.load(path, map_location=map_location, weights_only=False)
+    load_model_state(model, checkpoint['model'])
+
+    if optimizer is not None:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+    if scheduler is not None and checkpoint.get('scheduler') is not None:
+        scheduler.load_state_dict(checkpoint['scheduler'])
+    set_rng_state(checkpoint['rng'])
+    return checkpoint
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+独立的 CPU 打分器：只依赖 torch，加载 export.py 的导出目录 (TorchScript 分类头 + DrugGAT 编码器 + 预计算的药物 /
+细胞系特征) 对 (药物1, 药物2, 细胞系) 打分。不导入 transformers / torch_geometric / RDKit，也不读取 CSV 特征文件。
+未收录的药物 / 细胞系与训练时一样映射到 ID 0 (全零特征)。
+
+用法:
+    python cpu_runner.py --export-dir export --query "DrugA,DrugB,CELL" --query "DrugC,DrugD,CELL"
+    python cpu_runner.py --export-dir export --pairs pairs.csv --out scores.csv   (列: Drug1, Drug2, Cell_line)
+"""
+import os
+import csv
+import json
+import time
+import argparse
+
+import torch
+
+UNKNOWN_ID = 0
+
+
+class SynergyScorer:
+    def __init__(self, export_dir, num_threads=None):
+        """
+        :param num_threads: torch 的 intra-op 线程数，None 时保持默认
+        """
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        with open(os.path.join(export_dir, 'manifest.json'), encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        self.head = torch.jit.load(os.path.join(export_dir, 'head.pt'), map_location='cpu').eval()
+        self.encoders = [torch.jit.load(os.path.join(export_dir, name), map_location='cpu').eval()
+                         for name in ('gat_drug1.pt', 'gat_drug2.pt')]
+
+        features = torch.load(os.path.join(export_dir, 'features.pt'), map_location='cpu', weights_only=True)
+        self.drug_names = features['drug_names']
+        self.cell_names = features['cell_names']
+        self.drug_to_id = {name: i for i, name in enumerate(self.drug_names)}
+        self.cell_to_id = {name: i for i, name in enumerate(self.cell_names)}
+        self.drug_embedding1 = features['drug_embedding1']
+        self.drug_embedding2 = features['drug_embedding2']
+        self.target = features['target']
+        self.physchem = features['physchem']
+        self.cell = features['cell']
+
+    def get_drug_id(self, drug_name):
+        return self.drug_to_id.get(str(drug_name).strip(), UNKNOWN_ID)
+
+    def get_cell_id(self, cell_line):
+        return self.cell_to_id.get(str(cell_line).strip(), UNKNOWN_ID)
+
+    @torch.inference_mode()
+    def score_ids(self, ids):
+        """
+        :param ids: LongTensor [B, 3]，(drug1_id, drug2_id, cell_id)
+        :return: FloatTensor [B]，协同概率
+        """
+        drug1, drug2, cell = ids.unbind(dim=1)
+        logits = self.head(self.drug_embedding1[drug1], self.drug_embedding2[drug2],
+                           self.target[drug1], self.target[drug2],
+                           self.physchem[drug1], self.physchem[drug2], self.cell[cell])
+        return torch.softmax(logits, dim=1)[:, 1]
+
+    def score(self, queries):
+        """
+        :param queries: [(drug1, drug2, cell_line), ...]
+        :return: 协同概率列表
+        """
+        if not queries:
+            return []
+        ids = torch.tensor([[self.get_drug_id(d1), self.get_drug_id(d2), self.get_cell_id(c)]
+                            for d1, d2, c in queries], dtype=torch.long)
+        return self.score_ids(ids).tolist()
+
+    @torch.inference_mode()
+    def encode_graph(self, x, edge_index, batch, ptr):
+        """
+        用导出的两个 DrugGAT 编码器计算 (批量) 分子图的池化嵌入，用于特征表之外的新分子；
+        原子特征需与训练时的特征提取一致 (manifest 中的 atom_feature_dim)
+        :return: (drug_embedding1, drug_embedding2)，各为 [图数, out_feats]
+        """
+        return tuple(encoder(x, edge_index, batch, ptr) for encoder in self.encoders)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="用导出的 TorchScript 产物在 CPU 上为药物对打分")
+    parser.add_argument('--export-dir', default='export')
+    parser.add_argument('--query', action='append', default=[], help="'药物1,药物2,细胞系'，可重复")
+    parser.add_argument('--pairs', default=None, help="含 Drug1, Drug2, Cell_line 列的 CSV")
+    parser.add_argument('--out', default=None, help="--pairs 的打分结果 CSV (默认打印)")
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    scorer = SynergyScorer(args.export_dir, num_threads=args.threads)
+    rows = [tuple(part.strip() for part in q.split(',')) for q in args.query]
+    if args.pairs:
+        with open(args.pairs, newline='', encoding='utf-8') as f:
+            rows += [(r['Drug1'], r['Drug2'], r['Cell_line']) for r in csv.DictReader(f)]
+
+    start = time.perf_counter()
+    probs = scorer.score(rows)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    if args.out:
+        with open(args.out, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Drug1', 'Drug2', 'Cell_line', 'synergy_prob'])
+            writer.writerows((*row, f'{p:.6f}') for row, p in zip(rows, probs))
+        print(f"已写出 {len(rows)} 条打分到 {args.out}")
+    else:
+        for (d1, d2, c), p in zip(rows, probs):
+            print(f"{d1} + {d2} @ {c}: {p:.4f}")
+    print(f"{len(rows)} 条打分耗时 {elapsed:.2f} ms ({'int8' if scorer.manifest['quantized'] else 'fp32'})")
+
+
+if __name__ == '__main__':
+    main()
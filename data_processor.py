@@ -1,10 +1,18 @@
+import os
+import json
+import time
 import torch
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from torch_geometric.data import Data
 import logging
 from sklearn.preprocessing import StandardScaler
 
+from graph_store import PackedGraphStore, SharedGraphArrays, graph_key, pack_graphs
+from bundle import load_bundle
+from propagation import propagated_target_profiles
+
 # 设置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -17,14 +25,80 @@ except ImportError:
     RDKIT_AVAILABLE = False
     logger.warning("RDKit未安装，将使用简化分子表示")
 
+# 特征仓库中 ID 0 对应的占位名称
+UNKNOWN_NAME = '<unk>'
+
+# 原子特征提取逻辑的版本号，修改 featurize_smiles / smiles_to_graph 后需递增，使磁盘图缓存失效
+FEATURIZER_VERSION = 'atom64-v1'
+
+ATOM_TYPES = np.array(['C', 'N', 'O', 'S', 'F', 'Cl', 'Br', 'I', 'P'])
+
+
+def featurize_smiles(smiles, atom_feature_dim=64):
+    """
+    模块级的分子特征提取 (可被进程池序列化调用)，处理器的全部建图路径都经由这里：
+    先把每个原子的原始属性收集成列，再一次性组装成 [原子数, atom_feature_dim] 的特征矩阵。
+    :return: (edge_index [2, E] int64, x [N, atom_feature_dim] float32)；解析失败返回 None
+    """
+    if not RDKIT_AVAILABLE:
+        return None
+    try:
+        mol = Chem.MolFromSmiles(smiles)
+        if mol is None:
+            return None
+
+        atoms = list(mol.GetAtoms())
+        symbols = np.array([atom.GetSymbol() for atom in atoms])
+        props = np.array([
+            (atom.GetDegree(), atom.GetFormalCharge(), int(atom.GetChiralTag()), int(atom.GetIsAromatic()),
+             atom.GetTotalNumHs(), atom.GetMass() / 100.0, atom.GetAtomicNum())
+            for atom in atoms
+        ], dtype=np.float64).reshape(len(atoms), 7)
+
+        full = np.concatenate([symbols[:, None] == ATOM_TYPES[None, :], props], axis=1)
+        x = np.zeros((len(atoms), atom_feature_dim), dtype=np.float32)
+        width = min(full.shape[1], atom_feature_dim)
+        x[:, :width] = full[:, :width]
+
+        bonds = np.array([(b.GetBeginAtomIdx(), b.GetEndAtomIdx()) for b in mol.GetBonds()], dtype=np.int64)
+        if len(bonds):
+            # 每条键保持 [i, j], [j, i] 的原有顺序
+            edge_index = np.stack([bonds, bonds[:, ::-1]], axis=1).reshape(-1, 2).T.copy()
+        else:
+            edge_index = np.zeros((2, 1), dtype=np.int64)
+        return edge_index, x
+    except Exception:
+        return None
+
+
+def gather_csr_rows(ptr, indices, values, rows):
+    """
+    取 CSR 矩阵的若干行，拼成 embedding_bag 的输入格式 (各张量在同一设备上即可，不经过 Python 循环)
+    :return: (indices [nnz], offsets [B], values [nnz])
+    """
+    starts = ptr[rows]
+    counts = ptr[rows + 1] - starts
+    offsets = torch.cumsum(counts, 0) - counts
+    # 每个位置在所属行区间内的序号 + 区间起点 = 在 CSR 数组中的位置
+    total = int(counts.sum())
+    shift = torch.repeat_interleave(offsets - starts, counts, output_size=total)
+    positions = torch.arange(total, device=rows.device) - shift
+    return indices[positions], offsets, values[positions]
+
 
 class DrugCellDataProcessor:
-    def __init__(self, drug_data_file, drug_target_file, cell_line_file):
+    def __init__(self, drug_data_file, drug_target_file, cell_line_file, use_feature_store=False,
+                 graph_cache_path=None, precompute_jobs=None, sparse_targets=False):
         """
         改进的数据处理器
         :param drug_data_file: 包含SMILES和理化性质的完整药物数据 (merged_drug_data_complete.csv)
         :param drug_target_file: 药物靶点信息 (Drug_Target_Protein.csv)
         :param cell_line_file: 细胞系基因表达特征 (cell_ge_1024_features.csv)
+        :param use_feature_store: 是否启用特征仓库模式 (药物/细胞系映射为整数ID，特征存为连续 float32 张量)
+        :param graph_cache_path: 磁盘图缓存文件路径 (如 cache/drug_graphs.bin)，为 None 时仅使用进程内缓存
+        :param precompute_jobs: 不为 None 时在初始化阶段用该数量的进程批量预计算全部药物图
+        :param sparse_targets: 特征仓库模式下样本只携带每个药物的靶点下标与取值 (而非 1162 维稠密向量)，
+                               由模型用 embedding_bag 求和完成与稠密 Linear 等价的投影
         """
         logger.info("初始化数据处理器 (Enhanced)...")
 
@@ -38,8 +112,7 @@ class DrugCellDataProcessor:
         self.cell_line_expr = self._load_cell_features(cell_line_file)
 
         # 图结构缓存
-        self.graph_cache = {}
-        self.atom_feature_dim = 64
+        self._init_graph_cache(graph_cache_path, precompute_jobs)
 
         # 特征维度记录
         self.physchem_dim = self.drug_physchem.shape[1] if self.drug_physchem is not None else 0
@@ -51,6 +124,66 @@ class DrugCellDataProcessor:
         logger.info(f"靶点特征维度: {self.target_dim}")
         logger.info(f"细胞系特征维度: {self.cell_dim}")
 
+        # 4. 特征仓库模式：一次性完成 名称 -> ID 映射，避免每个样本都做 pandas 索引
+        self.use_feature_store = use_feature_store
+        self.sparse_targets = sparse_targets and use_feature_store
+        self.target_propagation = None
+        if self.use_feature_store:
+            self._build_feature_store()
+
+    @classmethod
+    def from_bundle(cls, bundle_path, sources=None, graph_cache_path=None, precompute_jobs=None,
+                    sparse_targets=False):
+        """
+        从 bundle.py 编译的二进制数据包构建 (特征仓库模式)，不解析 CSV；特征矩阵为 memmap 视图
+        :param sources: 源 CSV 路径，用于校验和检查 (变化时自动重建数据包)，None 表示使用包内记录的路径
+        """
+        self = cls.__new__(cls)
+        bundle = load_bundle(bundle_path, sources)
+        self.bundle = bundle
+
+        self.drug_smiles_map = bundle.drug_smiles_map
+        self.drug_names = bundle.drug_names
+        self.drug_to_id = {name: i for i, name in enumerate(self.drug_names)}
+        self.drug_smiles_by_id = bundle.drug_smiles_by_id
+        self.cell_names = bundle.cell_names
+        self.cell_to_id = {name: i for i, name in enumerate(self.cell_names)}
+
+        self.physchem_tensor = torch.from_numpy(bundle.arrays['physchem'])
+        self.target_tensor = torch.from_numpy(bundle.arrays['target'])
+        self.target_names = bundle.target_names
+        self.cell_tensor = torch.from_numpy(bundle.arrays['cell'])
+        self.physchem_dim = self.physchem_tensor.shape[1]
+        self.target_dim = self.target_tensor.shape[1]
+        self.cell_dim = self.cell_tensor.shape[1]
+
+        self.physchem_columns = bundle.physchem_columns
+        self._frames_from_tensors()
+
+        self._build_target_index()
+
+        self._init_graph_cache(graph_cache_path, precompute_jobs)
+        self.use_feature_store = True
+        self.sparse_targets = sparse_targets
+        self.target_propagation = None
+        logger.info(f"已从数据包 {bundle_path} 加载: {len(self.drug_names) - 1} 个药物, "
+                    f"{len(self.cell_names) - 1} 个细胞系")
+        return self
+
+    def _init_graph_cache(self, graph_cache_path, precompute_jobs):
+        self.graph_cache = {}
+        self.atom_feature_dim = 64
+        self.graph_store = None
+        if graph_cache_path is not None and RDKIT_AVAILABLE:
+            self.graph_store = PackedGraphStore(graph_cache_path, FEATURIZER_VERSION)
+            logger.info(f"已打开磁盘图缓存: {len(self.graph_store)} 个分子")
+        elif graph_cache_path is not None:
+            logger.warning("RDKit未安装，不使用磁盘图缓存 (避免把随机占位图持久化)")
+
+        # 有磁盘缓存时必须补齐缺失分子，否则按需决定是否预计算
+        if self.graph_store is not None or precompute_jobs is not None:
+            self.precompute_graphs(n_jobs=precompute_jobs or 1)
+
     def _load_drug_data(self, file_path):
         """加载药物SMILES和理化性质"""
         try:
@@ -133,6 +266,163 @@ class DrugCellDataProcessor:
             logger.error(f"加载细胞系数据失败: {e}")
             raise
 
+    def _build_feature_store(self):
+        """构建特征仓库：ID 0 保留给未知药物/细胞系 (SMILES 为 'C'，特征全 0)，与逐样本查找的回退行为一致"""
+        drug_names = set(self.drug_smiles_map)
+        if self.drug_physchem is not None:
+            drug_names |= set(map(str, self.drug_physchem.index))
+        drug_names |= set(map(str, self.drug_targets.index))
+        self.drug_names = [UNKNOWN_NAME] + sorted(drug_names)
+        self.drug_to_id = {name: i for i, name in enumerate(self.drug_names)}
+        self.drug_smiles_by_id = [self.get_drug_smiles(name) for name in self.drug_names]
+
+        self.physchem_tensor = self._frame_to_tensor(self.drug_physchem, self.drug_names, self.physchem_dim)
+        self.target_tensor = self._frame_to_tensor(self.drug_targets, self.drug_names, self.target_dim)
+        self.target_names = [str(c) for c in self.drug_targets.columns]
+        self.physchem_columns = [str(c) for c in self.drug_physchem.columns] if self.drug_physchem is not None else []
+        self._build_target_index()
+
+        cell_index = self.cell_line_expr.index.astype(str).str.strip()
+        self.cell_names = [UNKNOWN_NAME] + list(dict.fromkeys(cell_index))
+        self.cell_to_id = {name: i for i, name in enumerate(self.cell_names)}
+        cell_frame = self.cell_line_expr.set_axis(cell_index)
+        self.cell_tensor = self._frame_to_tensor(cell_frame, self.cell_names, self.cell_dim)
+
+        logger.info(f"特征仓库构建完成: {len(self.drug_names) - 1} 个药物, {len(self.cell_names) - 1} 个细胞系")
+
+    def _build_target_index(self):
+        """
+        靶点矩阵的 CSR 表示：药物 i 的靶点下标为 target_indices[target_ptr[i]:target_ptr[i + 1]]，
+        取值 (crosstab 计数，可能大于 1) 在 target_values 的同一区间
+        """
+        rows, cols = self.target_tensor.nonzero(as_tuple=True)
+        self.target_indices = cols
+        self.target_values = self.target_tensor[rows, cols]
+        counts = torch.bincount(rows, minlength=len(self.target_tensor))
+        self.target_ptr = torch.cat([torch.zeros(1, dtype=torch.long), counts.cumsum(0)])
+
+    def propagate_targets(self, network_file, method='rwr', restart_prob=0.5, diffusion_time=1.0, min_value=1e-3,
+                          cache_dir='cache'):
+        """
+        用靶点相互作用网络 (Target_realation.csv) 对所有药物的靶点谱做一次批量传播 (随机游走重启 / 热扩散)，
+        替换特征仓库中的靶点矩阵；结果按网络与参数缓存到磁盘，训练时每个样本没有额外开销
+        """
+        if not self.use_feature_store:
+            raise ValueError("靶点网络传播需要特征仓库模式 (use_feature_store=True)")
+        self.target_tensor = propagated_target_profiles(
+            self.target_tensor, self.target_names, network_file, method=method, restart_prob=restart_prob,
+            diffusion_time=diffusion_time, min_value=min_value, cache_dir=cache_dir)
+        self.target_propagation = {'network_file': os.path.basename(network_file), 'method': method,
+                                   'restart_prob': restart_prob, 'diffusion_time': diffusion_time,
+                                   'min_value': min_value}
+        # 按名称查询的接口同步使用传播后的结果
+        self._frames_from_tensors()
+        self._build_target_index()
+
+    def feature_key(self):
+        """特征版本标识 (数据包校验和 + 靶点传播设置)，按特征缓存的结果 (教师 logits、筛选断点等) 以此为键"""
+        bundle = getattr(self, 'bundle', None)
+        return json.dumps({'bundle': bundle.header['checksum'] if bundle is not None else None,
+                           'target_propagation': self.target_propagation}, sort_keys=True)
+
+    def _frames_from_tensors(self):
+        """按名称查询的接口 (process_sample 等) 使用与特征张量同一份内存的 DataFrame 视图，第 0 行为未知占位不纳入"""
+        self.drug_physchem = pd.DataFrame(self.physchem_tensor.numpy()[1:], index=self.drug_names[1:],
+                                          columns=self.physchem_columns, copy=False)
+        self.drug_targets = pd.DataFrame(self.target_tensor.numpy()[1:], index=self.drug_names[1:],
+                                         columns=self.target_names, copy=False)
+        self.cell_line_expr = pd.DataFrame(self.cell_tensor.numpy()[1:], index=self.cell_names[1:], copy=False)
+
+    def share_memory(self):
+        """
+        在主进程 (创建 DataLoader 之前) 调用一次：特征矩阵与靶点 CSR 数组移入共享内存，
+        进程内图缓存打包为共享内存中的扁平数组，DataFrame 换成共享张量上的视图。
+        之后 worker 无论以 fork 还是 spawn 启动，都只附加到同一份物理内存，不再各自持有拷贝。
+        """
+        if not self.use_feature_store:
+            raise ValueError("共享内存需要特征仓库模式 (use_feature_store=True)")
+        for name in ('physchem_tensor', 'target_tensor', 'cell_tensor', 'target_indices', 'target_values',
+                     'target_ptr'):
+            getattr(self, name).share_memory_()
+        self._frames_from_tensors()
+
+        # 磁盘图缓存本身是 memmap (页缓存在进程间共享)；否则把字典里的小张量打包成几块共享数组
+        if self.graph_store is None and self.graph_cache:
+            self.graph_store = SharedGraphArrays(self.graph_cache)
+            self.graph_cache = {}
+        logger.info("特征张量与分子图已放入共享内存")
+        return self
+
+    def __getstate__(self):
+        # 以 spawn 方式启动 worker 时不序列化 DataFrame (共享张量只传句柄)，在子进程中重建为视图
+        state = self.__dict__.copy()
+        if self.use_feature_store:
+            state['drug_physchem'] = state['drug_targets'] = state['cell_line_expr'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.use_feature_store:
+            self._frames_from_tensors()
+
+    def target_bags(self, drug_ids):
+        """
+        一组药物的靶点按 embedding_bag 的输入格式展开
+        :param drug_ids: LongTensor [B]
+        :return: (indices [nnz], offsets [B], weights [nnz])
+        """
+        return gather_csr_rows(self.target_ptr, self.target_indices, self.target_values, drug_ids)
+
+    def packed_drug_graphs(self):
+        """
+        按药物 ID 打包全部分子图 (每个不同的 SMILES 只存一份)，供 gather_graphs 直接按 ID 拼批量图
+        :return: (drug_slots LongTensor [药物数]，药物 ID -> 打包数组中的图序号；pack_graphs 布局的张量字典)
+        """
+        if not self.use_feature_store:
+            raise ValueError("按 ID 打包分子图需要特征仓库模式 (use_feature_store=True)")
+        smiles_to_slot = {}
+        for smiles in self.drug_smiles_by_id:
+            smiles_to_slot.setdefault(smiles, len(smiles_to_slot))
+        _, arrays = pack_graphs({smiles: self.smiles_to_graph(smiles) for smiles in smiles_to_slot})
+        drug_slots = torch.tensor([smiles_to_slot[s] for s in self.drug_smiles_by_id], dtype=torch.long)
+        return drug_slots, {name: torch.from_numpy(arr) for name, arr in arrays.items()}
+
+    def _target_features(self, name, drug_id):
+        if self.sparse_targets:
+            start, end = self.target_ptr[drug_id], self.target_ptr[drug_id + 1]
+            return {f'{name}_indices': self.target_indices[start:end].clone(),
+                    f'{name}_weights': self.target_values[start:end].clone()}
+        return {name: self.target_tensor[drug_id].clone()}
+
+    @staticmethod
+    def _frame_to_tensor(frame, names, dim):
+        """按名称顺序把 DataFrame 重排为连续 float32 张量，缺失行填 0"""
+        if frame is None or dim == 0:
+            return torch.zeros((len(names), dim), dtype=torch.float32)
+        frame = frame[~frame.index.duplicated(keep='first')]
+        frame.index = frame.index.astype(str)
+        # pandas 的写时复制可能返回只读视图，显式拷贝成可写的连续数组
+        values = np.array(frame.reindex(names).fillna(0).to_numpy(dtype=np.float32), dtype=np.float32, order='C')
+        return torch.from_numpy(values)
+
+    def get_drug_id(self, drug_name):
+        return self.drug_to_id.get(str(drug_name).strip(), 0)
+
+    def get_cell_id(self, cell_line):
+        return self.cell_to_id.get(str(cell_line).strip(), 0)
+
+    def resolve_ids(self, drug1_list, drug2_list, cell_line_list):
+        """将整列样本一次性解析为 [N, 3] 的 (drug1_id, drug2_id, cell_id) 张量"""
+        drug1_ids = [self.get_drug_id(d) for d in drug1_list]
+        drug2_ids = [self.get_drug_id(d) for d in drug2_list]
+        cell_ids = [self.get_cell_id(c) for c in cell_line_list]
+
+        missing_cells = {str(c).strip() for c, i in zip(cell_line_list, cell_ids) if i == 0}
+        for cell_line in sorted(missing_cells):
+            logger.warning(f"未找到细胞系: {cell_line}")
+
+        return torch.tensor([drug1_ids, drug2_ids, cell_ids], dtype=torch.long).t().contiguous()
+
     def get_drug_smiles(self, drug_name):
         drug_name = str(drug_name).strip()
         return self.drug_smiles_map.get(drug_name, 'C')
@@ -163,62 +453,78 @@ class DrugCellDataProcessor:
             logger.warning(f"未找到细胞系: {cell_line}")
             return torch.zeros(self.cell_dim, dtype=torch.float32)
 
-    def get_atom_features(self, atom):
-        """原子特征提取 (保持不变)"""
-        if not RDKIT_AVAILABLE:
-            return np.random.randn(self.atom_feature_dim)
-        try:
-            features = []
-            atom_types = ['C', 'N', 'O', 'S', 'F', 'Cl', 'Br', 'I', 'P']
-            atom_type = atom.GetSymbol()
-            features.extend([1 if atom_type == t else 0 for t in atom_types])
-            features.append(atom.GetDegree())
-            features.append(atom.GetFormalCharge())
-            features.append(int(atom.GetChiralTag()))
-            features.append(int(atom.GetIsAromatic()))
-            features.append(atom.GetTotalNumHs())
-            features.append(atom.GetMass() / 100.0)
-            features.append(atom.GetAtomicNum())
-            if len(features) < self.atom_feature_dim:
-                features.extend([0] * (self.atom_feature_dim - len(features)))
+    def precompute_graphs(self, n_jobs=None):
+        """
+        批量预计算 drug_smiles_map 中全部药物的分子图，训练热路径上不再做 RDKit 解析
+        :param n_jobs: 进程数，None 表示使用全部 CPU 核
+        :return: 本次新解析的分子数
+        """
+        n_jobs = n_jobs or os.cpu_count() or 1
+        pending = {}
+        for smiles in list(self.drug_smiles_map.values()) + ['C']:
+            key = graph_key(smiles, FEATURIZER_VERSION)
+            if key in self.graph_cache or (self.graph_store is not None and key in self.graph_store):
+                continue
+            pending.setdefault(key, smiles)
+        if not pending:
+            return 0
+
+        start_time = time.time()
+        smiles_list = list(pending.values())
+        if n_jobs > 1:
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                chunksize = max(1, len(smiles_list) // (n_jobs * 4))
+                results = list(pool.map(featurize_smiles, smiles_list, [self.atom_feature_dim] * len(smiles_list),
+                                        chunksize=chunksize))
+        else:
+            results = [featurize_smiles(smiles, self.atom_feature_dim) for smiles in smiles_list]
+
+        graphs = {}
+        for key, res in zip(pending, results):
+            if res is None:
+                graphs[key] = self._random_graph()
             else:
-                features = features[:self.atom_feature_dim]
-            return np.array(features, dtype=np.float32)
-        except:
-            return np.random.randn(self.atom_feature_dim)
+                edge_index, x = res
+                graphs[key] = (torch.from_numpy(edge_index), torch.from_numpy(x))
+
+        elapsed = time.time() - start_time
+        logger.info(f"预计算 {len(graphs)} 个分子图，{n_jobs} 进程，耗时 {elapsed:.2f}s "
+                    f"({len(graphs) / max(elapsed, 1e-9):.1f} mol/s)")
+
+        if self.graph_store is not None:
+            self.graph_store.build(graphs)
+        else:
+            self.graph_cache.update(graphs)
+        return len(graphs)
 
     def smiles_to_graph(self, smiles):
-        """SMILES转图 (保持不变)"""
-        cache_key = f"graph_{hash(smiles)}"
+        """SMILES转图：进程内缓存 -> 磁盘图缓存 -> RDKit 解析"""
+        cache_key = graph_key(smiles, FEATURIZER_VERSION)
         if cache_key in self.graph_cache:
             return self.graph_cache[cache_key]
 
-        try:
-            if RDKIT_AVAILABLE:
-                mol = Chem.MolFromSmiles(smiles)
-                if mol is None: raise ValueError()
-
-                node_features = [self.get_atom_features(atom) for atom in mol.GetAtoms()]
-                edge_index = []
-                for bond in mol.GetBonds():
-                    i, j = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
-                    edge_index += [[i, j], [j, i]]
-
-                if not edge_index: edge_index = [[0, 0]]
-
-                x = torch.from_numpy(np.array(node_features, dtype=np.float32))
-                edge_index = torch.tensor(edge_index, dtype=torch.long).t().contiguous()
-            else:
-                x = torch.randn(5, self.atom_feature_dim)
-                edge_index = torch.tensor([[0, 1, 1, 2], [1, 0, 2, 1]], dtype=torch.long)
-        except:
-            x = torch.randn(5, self.atom_feature_dim)
-            edge_index = torch.tensor([[0, 1, 1, 2], [1, 0, 2, 1]], dtype=torch.long)
+        if self.graph_store is not None:
+            res = self.graph_store.get(cache_key)
+            if res is not None:
+                return res
 
-        res = (edge_index, x)
+        res = self._featurize_smiles(smiles)
         self.graph_cache[cache_key] = res
         return res
 
+    def _featurize_smiles(self, smiles):
+        """用 RDKit 解析 SMILES 并提取原子特征与边索引，失败时退回随机占位图"""
+        res = featurize_smiles(smiles, self.atom_feature_dim)
+        if res is None:
+            return self._random_graph()
+        edge_index, x = res
+        return torch.from_numpy(edge_index), torch.from_numpy(x)
+
+    def _random_graph(self):
+        x = torch.randn(5, self.atom_feature_dim)
+        edge_index = torch.tensor([[0, 1, 1, 2], [1, 0, 2, 1]], dtype=torch.long)
+        return edge_index, x
+
     def process_sample(self, drug1, drug2, cell_line, augment=False):
         """处理单个样本，包含新增的理化特征"""
         try:
@@ -247,15 +553,58 @@ class DrugCellDataProcessor:
             logger.error(f"Error processing {drug1}-{drug2}: {e}")
             return self._create_default_sample()
 
+    def process_ids(self, drug1_id, drug2_id, cell_id, augment=False, include_graphs=True):
+        """
+        特征仓库模式下处理单个样本：纯张量索引，不经过 pandas
+        :param include_graphs: False 时不取分子图，只带药物 ID，由 create_packed_collate_fn 在 collate 时按 ID 批量拼图
+        """
+        try:
+            smiles1 = self.drug_smiles_by_id[drug1_id]
+            smiles2 = self.drug_smiles_by_id[drug2_id]
+
+            graphs = {}
+            if include_graphs:
+                edge_index1, node_features1 = self.smiles_to_graph(smiles1)
+                edge_index2, node_features2 = self.smiles_to_graph(smiles2)
+
+                if augment:
+                    edge_index1, node_features1 = self.augment_molecular_data((edge_index1, node_features1))
+                    edge_index2, node_features2 = self.augment_molecular_data((edge_index2, node_features2))
+                graphs = {'graph1': (edge_index1, node_features1), 'graph2': (edge_index2, node_features2)}
+
+            # clone 出独立的小张量，避免 DataLoader 把整块特征矩阵的存储一起传回主进程
+            return {
+                **graphs,
+                **self._target_features('target1', drug1_id),
+                **self._target_features('target2', drug2_id),
+                'physchem1': self.physchem_tensor[drug1_id].clone(),
+                'physchem2': self.physchem_tensor[drug2_id].clone(),
+                'cell_expr': self.cell_tensor[cell_id].clone(),
+                'drug1_id': drug1_id,
+                'drug2_id': drug2_id,
+                'drug1_smiles': smiles1,
+                'drug2_smiles': smiles2
+            }
+        except Exception as e:
+            logger.error(f"Error processing ids {drug1_id}-{drug2_id}: {e}")
+            return self._create_default_sample()
+
     def _create_default_sample(self):
         # 创建维度匹配的默认数据
         x = torch.randn(5, self.atom_feature_dim)
         edge = torch.tensor([[0, 1], [1, 0]], dtype=torch.long)
+        if getattr(self, 'sparse_targets', False):
+            # 与正常样本保持相同的键，ID 0 (未知药物) 没有靶点
+            targets = {**self._target_features('target1', 0), **self._target_features('target2', 0)}
+        else:
+            targets = {'target1': torch.zeros(self.target_dim), 'target2': torch.zeros(self.target_dim)}
         return {
             'graph1': (edge, x), 'graph2': (edge, x),
-            'target1': torch.zeros(self.target_dim), 'target2': torch.zeros(self.target_dim),
+            **targets,
             'physchem1': torch.zeros(self.physchem_dim), 'physchem2': torch.zeros(self.physchem_dim),
             'cell_expr': torch.zeros(self.cell_dim),
+            # ID 0 为未知药物，其 SMILES 同样为 'C'
+            'drug1_id': 0, 'drug2_id': 0,
             'drug1_smiles': 'C', 'drug2_smiles': 'C'
         }
 
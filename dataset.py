@@ -18,11 +18,51 @@ class DrugSynergyDataset(torch.utils.data.Dataset):
 
         self.processor = data_processor
         self.augment = augment
+        # 为 False 时样本不带分子图，只带药物 ID (配合 create_packed_collate_fn 在 collate 时批量拼图)
+        self.include_graphs = True
+
+        # 特征仓库模式：预先把每一行解析成 ID 元组，__getitem__ 只做张量索引
+        self.use_feature_store = getattr(data_processor, 'use_feature_store', False)
+        if self.use_feature_store:
+            self.sample_ids = data_processor.resolve_ids(
+                self.data['Drug1'].tolist(),
+                self.data['Drug2'].tolist(),
+                self.data['Cell_line'].tolist()
+            )
+            label_str = self.data['classification'].astype(str).str.lower().str.strip()
+            self.labels = torch.tensor(label_str.str.contains('synergy', regex=False).to_numpy(), dtype=torch.long)
+
+    @classmethod
+    def from_bundle(cls, data_processor, augment=False):
+        """
+        使用 DrugCellDataProcessor.from_bundle 打开的数据包中已编码好的样本对与标签，不读取协同数据 CSV
+        """
+        bundle = data_processor.bundle
+        self = cls.__new__(cls)
+        self.processor = data_processor
+        self.augment = augment
+        self.include_graphs = True
+        self.use_feature_store = True
+
+        pairs = bundle.arrays['pairs']
+        self.sample_ids = torch.from_numpy(pairs)
+        # CrossEntropyLoss 需要 int64 标签
+        self.labels = torch.from_numpy(bundle.arrays['labels']).long()
+        # 名称形式的样本表 (分类编码，不复制字符串)，供 process_sample 等按名称的接口使用
+        self.data = pd.DataFrame({
+            'Drug1': pd.Categorical.from_codes(pairs[:, 0], data_processor.drug_names),
+            'Drug2': pd.Categorical.from_codes(pairs[:, 1], data_processor.drug_names),
+            'Cell_line': pd.Categorical.from_codes(pairs[:, 2], data_processor.cell_names)
+        })
+        return self
 
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, idx):
+        if self.use_feature_store:
+            return self._get_item_by_ids(idx)
+
         try:
             row = self.data.iloc[idx]
 
@@ -45,6 +85,18 @@ class DrugSynergyDataset(torch.utils.data.Dataset):
             logger.error(f"获取样本 {idx} 失败: {e}")
             return self._create_default_sample()
 
+    def _get_item_by_ids(self, idx):
+        try:
+            drug1_id, drug2_id, cell_id = self.sample_ids[idx].tolist()
+            processed = self.processor.process_ids(drug1_id, drug2_id, cell_id, augment=self.augment,
+                                                   include_graphs=self.include_graphs)
+            processed['labels'] = self.labels[idx].clone()
+            return processed
+
+        except Exception as e:
+            logger.error(f"获取样本 {idx} 失败: {e}")
+            return self._create_default_sample()
+
     def _create_default_sample(self):
         default_sample = self.processor._create_default_sample()
         default_sample['labels'] = torch.tensor(0, dtype=torch.long)
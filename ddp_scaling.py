@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+数据并行扩展性测试：用小型本地 Qwen2 配置，分别以不同进程数通过 torchrun (gloo) 训练固定数量的样本，
+报告全局吞吐 (samples/s)、相对单进程的加速比与并行效率。可在纯 CPU 的 Linux 机器上运行。
+
+用法:
+    python ddp_scaling.py --ranks 1 2 4 --samples 512
+    python ddp_scaling.py --ranks 1 2 --out ddp_scaling.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+import torch
+from torch.utils.data import DataLoader, Subset
+
+TINY_GCN_CONFIG = {'in_feats': 64, 'hidden_size': 32, 'out_feats': 64}
+
+
+def worker(args):
+    """torchrun 启动的单个 rank：训练 args.epochs 个 epoch，由 rank 0 写出吞吐"""
+    import logging
+    logging.disable(logging.WARNING)
+    from main import build_processor
+    from dataset import DrugSynergyDataset
+    from model import QwenEnhancedDrugSynergyModel
+    from trainer import ImprovedDrugSynergyTrainer
+    from sampler import LengthBucketBatchSampler, compute_pair_lengths
+    from utils import SmilesTokenCache, create_tokenized_collate_fn
+    from distributed import init_distributed, is_main_process, all_reduce_sum, cleanup
+
+    rank, world_size, device = init_distributed()
+    # 与训练相同的特征管线 (数据包、图缓存与靶点处理均已由 launch 预先构建，这里只是打开)
+    processor = build_processor(args.bundle, args.graph_cache)
+    dataset = Subset(DrugSynergyDataset.from_bundle(processor), range(args.samples))
+
+    torch.manual_seed(0)
+    model = QwenEnhancedDrugSynergyModel(
+        gcn_config=TINY_GCN_CONFIG,
+        qwen_model_name=args.tiny_qwen_dir,
+        target_dim=processor.target_dim,
+        cell_dim=processor.cell_dim,
+        physchem_dim=processor.physchem_dim
+    )
+    token_cache = SmilesTokenCache(model.tokenizer)
+    # 每个 rank 的 batch 大小固定，总 batch 随进程数线性增大 (弱扩展)
+    sampler = LengthBucketBatchSampler(*compute_pair_lengths(dataset, processor, token_cache),
+                                       batch_size=args.batch_size, num_replicas=world_size, rank=rank)
+    loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=create_tokenized_collate_fn(token_cache))
+    # 只测训练吞吐，不做评估
+    trainer = ImprovedDrugSynergyTrainer(model, loader, None, None, device, metrics_log=None)
+
+    results = []
+    for epoch in range(1, args.epochs + 1):
+        start = time.perf_counter()
+        trainer.train_epoch(epoch)
+        elapsed = time.perf_counter() - start
+        samples = torch.tensor(float(trainer.epoch_samples))
+        all_reduce_sum(samples)
+        results.append(samples.item() / elapsed)
+
+    if is_main_process():
+        # 第一个 epoch 含预热开销，只在多于一个 epoch 时丢弃
+        steady = results[1:] or results
+        with open(args.result_file, 'w', encoding='utf-8') as f:
+            json.dump({'world_size': world_size, 'samples_per_s': sum(steady) / len(steady)}, f)
+    cleanup()
+
+
+def launch(args):
+    from main import build_processor
+    from utils import build_tiny_qwen
+
+    # 在启动各 rank 之前构建好数据包与缓存，避免多个进程同时编译
+    processor = build_processor(args.bundle, args.graph_cache)
+    if not os.path.exists(os.path.join(args.tiny_qwen_dir, 'config.json')):
+        build_tiny_qwen(args.tiny_qwen_dir, processor.drug_smiles_map.values())
+
+    rows = []
+    for nproc in args.ranks:
+        with tempfile.TemporaryDirectory() as tmp:
+            result_file = os.path.join(tmp, 'result.json')
+            cmd = [sys.executable, '-m', 'torch.distributed.run', '--standalone', f'--nproc_per_node={nproc}',
+                   os.path.abspath(__file__), '--worker', '--result-file', result_file,
+                   '--samples', str(args.samples), '--batch-size', str(args.batch_size),
+                   '--epochs', str(args.epochs), '--bundle', args.bundle, '--graph-cache', args.graph_cache,
+                   '--tiny-qwen-dir', args.tiny_qwen_dir]
+            print(f"启动 {nproc} 个进程...")
+            subprocess.run(cmd, check=True, env={**os.environ, 'OMP_NUM_THREADS': '1'})
+            with open(result_file, 'r', encoding='utf-8') as f:
+                rows.append(json.load(f))
+
+    base = rows[0]['samples_per_s'] / rows[0]['world_size']
+    print(f"\n{'ranks':>6}{'samples/s':>12}{'speedup':>10}{'efficiency':>12}")
+    for row in rows:
+        speedup = row['samples_per_s'] / base
+        row.update({'speedup': speedup, 'efficiency': speedup / row['world_size']})
+        print(f"{row['world_size']:>6}{row['samples_per_s']:>12.1f}{speedup:>10.2f}{row['efficiency']:>12.0%}")
+    print(f"(CPU 核数: {os.cpu_count()}，进程数超过核数时吞吐不会继续提升)")
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump({'cpu_count': os.cpu_count(), 'results': rows}, f, indent=2)
+        print(f"结果已写入 {args.out}")
+
+
+def main():
+    from main import BUNDLE_PATH, GRAPH_CACHE_PATH
+
+    parser = argparse.ArgumentParser(description="数据并行训练扩展性测试 (torchrun + gloo)")
+    parser.add_argument('--ranks', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--samples', type=int, default=512, help="参与训练的样本数")
+    parser.add_argument('--batch-size', type=int, default=16, help="每个 rank 的 batch 大小")
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--bundle', default=BUNDLE_PATH)
+    parser.add_argument('--graph-cache', default=GRAPH_CACHE_PATH)
+    parser.add_argument('--tiny-qwen-dir', default='cache/tiny_qwen')
+    parser.add_argument('--out', help="结果 JSON 输出路径")
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+    else:
+        launch(args)
+
+
+if __name__ == '__main__':
+    main()
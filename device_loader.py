@@ -0,0 +1,134 @@
+import math
+
+import torch
+
+from data_processor import gather_csr_rows
+from graph_store import gather_graphs
+from sampler import _resolve_subset
+
+
+class DeviceResidentLoader:
+    """
+    设备常驻的数据加载：特征矩阵、靶点 CSR、按药物打包的分子图以及 (可选的) 预分词结果在构造时一次性上传到训练设备，
+    之后每个 batch 只是按打乱后的下标张量在设备上做 gather，分子图由偏移表向量化拼成块对角批量图，
+    不经过 Dataset.__getitem__、collate_fn 与 DataLoader worker。
+    产出的 batch 与 (预分词的) collate_fn 键相同、张量已在设备上，可直接替代 DataLoader 传给 ImprovedDrugSynergyTrainer。
+    """
+
+    def __init__(self, dataset, processor, device, batch_size=32, shuffle=False, drop_last=False,
+                 batch_sampler=None, token_cache=None, seed=42):
+        """
+        :param dataset: 特征仓库模式的 DrugSynergyDataset 或其 random_split Subset
+        :param batch_sampler: 产出数据集下标列表的采样器 (如 LengthBucketBatchSampler)，提供时忽略 batch_size / shuffle；
+                              分布式训练需传入按 rank 分片的采样器
+        :param token_cache: SmilesTokenCache，提供时预先为每个样本分词，batch 中直接带 input_ids / attention_mask
+        :param seed: shuffle 的随机种子，每个 epoch 的顺序由 seed + epoch 决定
+        """
+        base, rows = _resolve_subset(dataset)
+        if not getattr(base, 'use_feature_store', False):
+            raise ValueError("设备常驻模式需要 DrugCellDataProcessor(use_feature_store=True)")
+        if base.augment:
+            raise ValueError("设备常驻模式不支持分子图数据增强 (augment=True)")
+
+        self.device = device
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.batch_sampler = batch_sampler
+        self.seed = seed
+        self.epoch = 0
+
+        rows = torch.from_numpy(rows)
+        # CPU 上保留一份样本 ID，用于生成 SMILES 列表 (评估时药物嵌入缓存的键) 和 batch 的文本长度
+        self.sample_ids = base.sample_ids[rows].long()
+        self.smiles_by_id = processor.drug_smiles_by_id
+
+        self.device_sample_ids = self.sample_ids.to(device)
+        self.labels = base.labels[rows].to(device)
+        self.physchem = processor.physchem_tensor.to(device)
+        self.cell = processor.cell_tensor.to(device)
+        self.sparse_targets = processor.sparse_targets
+        if self.sparse_targets:
+            self.target_csr = tuple(t.to(device) for t in
+                                    (processor.target_ptr, processor.target_indices, processor.target_values))
+        else:
+            self.target = processor.target_tensor.to(device)
+
+        drug_slots, graph_arrays = processor.packed_drug_graphs()
+        self.drug_slots = drug_slots.to(device)
+        self.graph_arrays = {name: arr.to(device) for name, arr in graph_arrays.items()}
+
+        self.token_cache = token_cache
+        if token_cache is not None:
+            # 全部样本按全局最长序列填充后上传，每个 batch 再裁到本 batch 的最长长度 (与逐 batch 分词结果一致)
+            smiles = [self.smiles_by_id[i] for i in self.sample_ids[:, :2].flatten().tolist()]
+            input_ids, attention_mask = token_cache.encode_pairs(smiles[0::2], smiles[1::2])
+            self.token_lengths = attention_mask.sum(dim=1)
+            self.input_ids = input_ids.to(device)
+            self.attention_mask = attention_mask.to(device)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if hasattr(self.batch_sampler, 'set_epoch'):
+            self.batch_sampler.set_epoch(epoch)
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        if self.drop_last:
+            return len(self.labels) // self.batch_size
+        return math.ceil(len(self.labels) / self.batch_size)
+
+    def index_batches(self):
+        """每个 batch 的样本下标 (CPU LongTensor)，与 make_batch 配合可把额外的逐样本数据对齐到 batch"""
+        if self.batch_sampler is not None:
+            return (torch.as_tensor(indices, dtype=torch.long) for indices in self.batch_sampler)
+
+        num_samples = len(self.labels)
+        if self.shuffle:
+            order = torch.randperm(num_samples, generator=torch.Generator().manual_seed(self.seed + self.epoch))
+        else:
+            order = torch.arange(num_samples)
+        # 与 LengthBucketBatchSampler 一致：未调用 set_epoch 时每次迭代也换一种顺序
+        self.epoch += 1
+        batches = order.split(self.batch_size)
+        if self.drop_last and num_samples % self.batch_size:
+            batches = batches[:-1]
+        return iter(batches)
+
+    def _targets(self, name, drug_ids):
+        if not self.sparse_targets:
+            return {name: self.target[drug_ids]}
+        indices, offsets, weights = gather_csr_rows(*self.target_csr, drug_ids)
+        return {f'{name}_indices': indices, f'{name}_offsets': offsets, f'{name}_weights': weights}
+
+    def make_batch(self, indices):
+        """
+        :param indices: CPU 上的 LongTensor，数据集中的样本下标
+        """
+        index = indices.to(self.device, non_blocking=True)
+        drug1, drug2, cell = self.device_sample_ids[index].unbind(dim=1)
+        cpu_ids = self.sample_ids[indices]
+
+        batch = {
+            'graph1': gather_graphs(self.graph_arrays, self.drug_slots[drug1]),
+            'graph2': gather_graphs(self.graph_arrays, self.drug_slots[drug2]),
+            **self._targets('target1', drug1),
+            **self._targets('target2', drug2),
+            'physchem1': self.physchem[drug1],
+            'physchem2': self.physchem[drug2],
+            'cell_expr': self.cell[cell],
+            'labels': self.labels[index],
+            'drug1_smiles': [self.smiles_by_id[i] for i in cpu_ids[:, 0].tolist()],
+            'drug2_smiles': [self.smiles_by_id[i] for i in cpu_ids[:, 1].tolist()]
+        }
+        if self.token_cache is not None:
+            length = int(self.token_lengths[indices].max())
+            columns = slice(-length, None) if self.token_cache.padding_side == 'left' else slice(0, length)
+            batch['input_ids'] = self.input_ids[index][:, columns]
+            batch['attention_mask'] = self.attention_mask[index][:, columns]
+        return batch
+
+    def __iter__(self):
+        for indices in self.index_batches():
+            yield self.make_batch(indices)
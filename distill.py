@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+知识蒸馏：用微调后的教师模型 (QwenEnhancedDrugSynergyModel) 的 logits 训练不含语言模型的 StudentDrugSynergyModel，
+并在测试集上报告学生与教师的一致性，以及两者在 CPU 上的单次查询 / 批量推理延迟。
+教师 logits 只计算一次，按 (教师权重, 数据包, 数据处理配置) 缓存到 cache/ 下，调整蒸馏超参数时无需再跑教师。
+
+用法:
+    python distill.py --teacher-weights checkpoints --out student.pt
+    python distill.py --teacher-weights model_weights.pt --epochs 30 --temperature 2.0 --alpha 0.7 --report distill_report.json
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import random_split
+from tqdm import tqdm
+
+from model import QwenEnhancedDrugSynergyModel, StudentDrugSynergyModel
+from metrics import StreamingBinaryMetrics
+from checkpoint import load_model_weights
+from device_loader import DeviceResidentLoader
+from instrumentation import time_it
+from screen import predict_pairs
+
+
+def distillation_loss(student_logits, teacher_logits, labels, temperature=2.0, alpha=0.7):
+    """
+    alpha * T^2 * KL(teacher_T || student_T) + (1 - alpha) * CE(student, labels)
+    T^2 使软标签项的梯度量级不随温度变化
+    """
+    kl = F.kl_div(F.log_softmax(student_logits / temperature, dim=1),
+                  F.log_softmax(teacher_logits / temperature, dim=1), log_target=True, reduction='batchmean')
+    return alpha * temperature ** 2 * kl + (1 - alpha) * F.cross_entropy(student_logits, labels)
+
+
+@torch.no_grad()
+def compute_teacher_logits(teacher, loader, cache_path=None):
+    """按 loader (不打乱) 的顺序跑一遍教师，返回 [N, 类别数] 的 float32 logits (CPU)"""
+    if cache_path is not None and os.path.exists(cache_path):
+        print(f"使用缓存的教师 logits: {cache_path}")
+        return torch.load(cache_path)
+
+    teacher.eval()
+    logits = torch.cat([teacher(batch).float().cpu() for batch in tqdm(loader, desc="Teacher logits")])
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        torch.save(logits, f"{cache_path}.tmp")
+        os.replace(f"{cache_path}.tmp", cache_path)
+    return logits
+
+
+def teacher_cache_path(weights_path, processor, extra, cache_dir='cache'):
+    digest = hashlib.sha1()
+    with open(weights_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    digest.update(processor.feature_key().encode('utf-8'))
+    digest.update(json.dumps(extra, sort_keys=True).encode('utf-8'))
+    return os.path.join(cache_dir, f"teacher_logits_{digest.hexdigest()[:16]}.pt")
+
+
+def train_student(student, loader, teacher_logits, device, epochs=20, lr=1e-3, temperature=2.0, alpha=0.7,
+                  val_loader=None, val_teacher_logits=None):
+    """
+    :param teacher_logits: 与 loader 的样本下标对齐的教师 logits [N, 类别数]
+    """
+    optimizer = torch.optim.AdamW(student.parameters(), lr=lr, weight_decay=0.01)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=epochs)
+    for epoch in range(1, epochs + 1):
+        student.train()
+        loader.set_epoch(epoch - 1)
+        total_loss = torch.zeros((), device=device)
+        num_batches = 0
+        for indices in loader.index_batches():
+            batch = loader.make_batch(indices)
+            logits = student(batch)
+            loss = distillation_loss(logits, teacher_logits[indices].to(device), batch['labels'], temperature, alpha)
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(student.parameters(), 1.0)
+            optimizer.step()
+            total_loss += loss.detach()
+            num_batches += 1
+        scheduler.step()
+
+        message = f"Epoch {epoch} | 蒸馏 Loss: {(total_loss / max(num_batches, 1)).item():.4f}"
+        if val_loader is not None:
+            report = agreement_report(student, val_loader, val_teacher_logits, device)
+            message += f" | 验证集与教师一致率: {report['agreement']:.4f} | 学生 AUROC: {report['student']['AUROC']:.4f}"
+        print(message)
+    return student
+
+
+@torch.no_grad()
+def agreement_report(student, loader, teacher_logits, device):
+    """学生与教师在同一批样本上的预测一致性，以及两者各自对真实标签的精确指标"""
+    student.eval()
+    student_logits = torch.cat([student(loader.make_batch(indices)).float().cpu()
+                                for indices in loader.index_batches()])
+    labels = loader.labels.cpu()
+
+    results = {}
+    for name, logits in (('teacher', teacher_logits), ('student', student_logits)):
+        metrics = StreamingBinaryMetrics(torch.device('cpu'), exact=True)
+        metrics.update(F.softmax(logits, dim=1)[:, 1], logits.argmax(dim=1), labels)
+        results[name] = metrics.compute()
+
+    teacher_probs = F.softmax(teacher_logits, dim=1)[:, 1]
+    student_probs = F.softmax(student_logits, dim=1)[:, 1]
+    results['agreement'] = (student_logits.argmax(dim=1) == teacher_logits.argmax(dim=1)).float().mean().item()
+    results['prob_mae'] = (student_probs - teacher_probs).abs().mean().item()
+    results['prob_pearson'] = torch.corrcoef(torch.stack([student_probs, teacher_probs]))[0, 1].item()
+    return results
+
+
+def measure_latency(model, processor, queries, device, token_cache=None, repeat=20):
+    """
+    predict_pairs 的单次查询与批量 (同一药物对 × 全部细胞系) 延迟中位数 (毫秒)；
+    测量时关闭跨调用的药物嵌入缓存，每次查询都重新编码分子图
+    """
+    graphs = processor.packed_drug_graphs()
+    model.eval()
+    model.cache_drug_embeddings = False
+    cell_lines = processor.cell_names[1:]
+    batch_queries = [(queries[0][0], queries[0][1], cell) for cell in cell_lines]
+    position = iter(range(1 << 30))
+    single = time_it(lambda: predict_pairs(model, processor, [queries[next(position) % len(queries)]], device,
+                                           token_cache, graphs), repeat)
+    batch = time_it(lambda: predict_pairs(model, processor, batch_queries, device, token_cache, graphs),
+                    max(3, repeat // 4))
+    model.cache_drug_embeddings = True
+    return {'single_query_ms': single, f'batch{len(batch_queries)}_ms': batch}
+
+
+def feature_fingerprint(processor):
+    """
+    学生模型所用特征表 (药物 / 细胞系 ID 顺序、理化特征、靶点谱、细胞系表达) 的摘要。
+    数值先舍入到 1e-4，重新计算的靶点传播结果有浮点尾差时摘要不变
+    """
+    digest = hashlib.sha1()
+    digest.update('\n'.join(processor.drug_names).encode('utf-8'))
+    digest.update('\n'.join(processor.cell_names).encode('utf-8'))
+    for tensor in (processor.physchem_tensor, processor.target_tensor, processor.cell_tensor):
+        digest.update(torch.round(tensor.float() * 1e4).to(torch.int64).numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def save_student(student, path, config, processor=None):
+    checkpoint = {'config': config, 'state_dict': student.state_dict()}
+    if processor is not None:
+        checkpoint['features'] = feature_fingerprint(processor)
+    torch.save(checkpoint, path)
+
+
+def load_student(path, map_location='cpu', processor=None):
+    """
+    读取 save_student 保存的学生模型 (含构造参数)，返回 eval 模式的模型
+    :param processor: 打分用的数据处理器，提供时检查其特征与蒸馏时一致 (学生只认蒸馏时的特征表)
+    """
+    checkpoint = torch.load(path, map_location=map_location)
+    if processor is not None and 'features' in checkpoint and checkpoint['features'] != feature_fingerprint(processor):
+        raise ValueError(f"{path} 蒸馏时使用的特征与当前数据处理器不一致，"
+                         f"请用 main.build_processor() 构建与蒸馏时相同的数据包与靶点传播设置")
+    student = StudentDrugSynergyModel(**checkpoint['config'])
+    student.load_state_dict(checkpoint['state_dict'])
+    return student.eval()
+
+
+def main():
+    import logging
+    from main import QWEN_MODEL_NAME, GCN_CONFIG, LORA_CONFIG, BUNDLE_PATH, GRAPH_CACHE_PATH, build_processor
+    from dataset import DrugSynergyDataset
+    from utils import SmilesTokenCache
+
+    parser = argparse.ArgumentParser(description="从微调后的教师模型蒸馏不含语言模型的学生模型")
+    parser.add_argument('--teacher-weights', required=True, help="教师权重 (state_dict / checkpoint 文件或目录)")
+    parser.add_argument('--qwen-model', default=QWEN_MODEL_NAME)
+    parser.add_argument('--gcn-config', type=json.loads, default=GCN_CONFIG, help="教师的 GCN 配置 (JSON)")
+    parser.add_argument('--lora-config', type=json.loads, default=LORA_CONFIG,
+                        help="教师训练时的 LoRA 配置 (JSON)，全秩微调的教师传 null")
+    parser.add_argument('--bundle', default=BUNDLE_PATH)
+    parser.add_argument('--graph-cache', default=GRAPH_CACHE_PATH)
+    parser.add_argument('--hidden-size', type=int, default=256, help="学生模型的投影维度")
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--temperature', type=float, default=2.0)
+    parser.add_argument('--alpha', type=float, default=0.7, help="软标签 (KL) 项的权重，其余为真实标签 CE")
+    parser.add_argument('--no-init-from-teacher', action='store_true', help="不用教师的 GAT 权重初始化学生")
+    parser.add_argument('--out', default='student.pt')
+    parser.add_argument('--report', default='distill_report.json')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # 与 main.py 相同的数据处理与 8:1:1 划分，保证学生在教师没见过的测试集上评估
+    processor = build_processor(args.bundle, args.graph_cache)
+    full_dataset = DrugSynergyDataset.from_bundle(processor)
+    total_size = len(full_dataset)
+    train_size, val_size = int(0.8 * total_size), int(0.1 * total_size)
+    splits = random_split(full_dataset, [train_size, val_size, total_size - train_size - val_size],
+                          generator=torch.Generator().manual_seed(42))
+
+    teacher = QwenEnhancedDrugSynergyModel(gcn_config=args.gcn_config, qwen_model_name=args.qwen_model,
+                                           target_dim=processor.target_dim, cell_dim=processor.cell_dim,
+                                           physchem_dim=processor.physchem_dim, lora_config=args.lora_config)
+    weights_path = load_model_weights(teacher, args.teacher_weights)
+    teacher.merge_lora()
+    teacher.to(device)
+    token_cache = SmilesTokenCache(teacher.tokenizer)
+
+    # 教师 logits 对全部样本计算一次，各划分按行号取出
+    full_loader = DeviceResidentLoader(full_dataset, processor, device, batch_size=64, token_cache=token_cache)
+    all_logits = compute_teacher_logits(teacher, full_loader, teacher_cache_path(
+        weights_path, processor, {'qwen': args.qwen_model, 'gcn': args.gcn_config, 'targets': 'rwr-0.5'}))
+    train_logits, val_logits, test_logits = (all_logits[torch.as_tensor(split.indices)] for split in splits)
+
+    config = {'gcn_config': args.gcn_config, 'target_dim': processor.target_dim, 'cell_dim': processor.cell_dim,
+              'physchem_dim': processor.physchem_dim, 'hidden_size': args.hidden_size}
+    student = StudentDrugSynergyModel(**config).to(device)
+    if not args.no_init_from_teacher:
+        student.gcn_drug1.load_state_dict(teacher.gcn_drug1.state_dict())
+        student.gcn_drug2.load_state_dict(teacher.gcn_drug2.state_dict())
+
+    train_loader, val_loader, test_loader = (
+        DeviceResidentLoader(split, processor, device, batch_size=args.batch_size, shuffle=(i == 0))
+        for i, split in enumerate(splits))
+    start = time.time()
+    train_student(student, train_loader, train_logits, device, epochs=args.epochs, lr=args.lr,
+                  temperature=args.temperature, alpha=args.alpha, val_loader=val_loader,
+                  val_teacher_logits=val_logits)
+    print(f"蒸馏完成，耗时 {time.time() - start:.1f}s")
+    save_student(student, args.out, config, processor)
+
+    report = agreement_report(student, test_loader, test_logits, device)
+    # 延迟在 CPU 上测量 (交互式服务场景)
+    cpu = torch.device('cpu')
+    queries = [(processor.drug_names[d1], processor.drug_names[d2], processor.cell_names[c])
+               for d1, d2, c in test_loader.sample_ids[:64].tolist()]
+    teacher_params = sum(p.numel() for p in teacher.parameters())
+    student_params = sum(p.numel() for p in student.parameters())
+    report['latency'] = {
+        'teacher': measure_latency(teacher.to(cpu), processor, queries, cpu, token_cache),
+        'student': measure_latency(student.to(cpu), processor, queries, cpu)
+    }
+    report['parameters'] = {'teacher': teacher_params, 'student': student_params}
+
+    print("\n--- 测试集: 学生 vs 教师 ---")
+    print(f"预测一致率: {report['agreement']:.4f} | 概率 MAE: {report['prob_mae']:.4f} | "
+          f"概率相关系数: {report['prob_pearson']:.4f}")
+    print(f"{'':>10}{'AUROC':>10}{'AUPRC':>10}{'ACC':>10}{'params':>14}" +
+          ''.join(f"{key:>18}" for key in report['latency']['student']))
+    for name in ('teacher', 'student'):
+        print(f"{name:>10}{report[name]['AUROC']:>10.4f}{report[name]['AUPRC']:>10.4f}{report[name]['ACC']:>10.4f}"
+              f"{report['parameters'][name]:>14,}" +
+              ''.join(f"{value:>18.2f}" for value in report['latency'][name].values()))
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"学生模型已保存到 {args.out}，报告已写入 {args.report}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+CPU 推理导出：把学生模型 (distill.py 训练的 StudentDrugSynergyModel) 的两个 DrugGAT 编码器 (含平均池化) 与
+投影 + 分类头分别 trace 为 TorchScript，可选对分类头的 Linear 层做动态 int8 量化；同时导出全部药物的池化 GAT 嵌入
+以及靶点 / 理化 / 细胞系特征表。cpu_runner.py 只依赖 torch 即可加载导出目录打分，不需要 transformers、
+torch_geometric 或 RDKit。导出后自动与 eager 模型做一致性检查，超出容差时退出码为 1。
+
+用法:
+    python export.py --student student.pt --out-dir export
+    python export.py --student student.pt --out-dir export_int8 --quantize
+"""
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+from distill import load_student
+from graph_store import gather_graphs
+from instrumentation import time_it
+from screen import build_screen_batch
+
+EXPORT_VERSION = 1
+HEAD_FILE = 'head.pt'
+ENCODER_FILES = ('gat_drug1.pt', 'gat_drug2.pt')
+FEATURES_FILE = 'features.pt'
+MANIFEST_FILE = 'manifest.json'
+# 动态量化只作用于输入维度大的投影层；分类头的第一层输入是各路特征的拼接，数值范围差异大，
+# 按张量量化激活会使判定一致率降到约 93%，保持 fp32
+QUANTIZED_MODULES = ('proj_gcn', 'proj_target', 'proj_cell')
+
+
+class PooledDrugEncoder(nn.Module):
+    """
+    DrugGAT + 按 ptr 的平均池化。图数取自 ptr 的形状而不是 Python int，trace 后对任意节点数 / 图数都成立
+    (torch_geometric 的 global_mean_pool 会把 batch.max() 固化为常量)
+    """
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, x, edge_index, batch, ptr):
+        h = self.encoder(x, edge_index)
+        sums = torch.zeros(ptr.size(0) - 1, h.size(1), dtype=h.dtype, device=h.device).index_add_(0, batch, h)
+        counts = (ptr[1:] - ptr[:-1]).clamp(min=1).unsqueeze(1).to(h.dtype)
+        return sums / counts
+
+
+class ScoringHead(nn.Module):
+    """学生模型的投影层 + 分类头，输入为按药物 / 细胞系 gather 好的稠密特征"""
+
+    def __init__(self, student):
+        super().__init__()
+        self.proj_gcn = copy.deepcopy(student.proj_gcn)
+        self.proj_target = copy.deepcopy(student.proj_target)
+        self.proj_physchem = copy.deepcopy(student.proj_physchem)
+        self.proj_cell = copy.deepcopy(student.proj_cell)
+        self.classifier = copy.deepcopy(student.classifier)
+
+    def forward(self, drug_embedding1, drug_embedding2, target1, target2, physchem1, physchem2, cell_expr):
+        features = torch.cat([
+            self.proj_gcn(drug_embedding1), self.proj_gcn(drug_embedding2),
+            self.proj_target(target1), self.proj_target(target2),
+            self.proj_physchem(physchem1), self.proj_physchem(physchem2),
+            self.proj_cell(cell_expr)
+        ], dim=1)
+        return self.classifier(features)
+
+
+@torch.no_grad()
+def encode_all_drugs(student, processor, batch_size=256):
+    """两个编码器下全部药物 (含 ID 0 的未知药物) 的池化 GAT 嵌入，各为 [药物数, out_feats]"""
+    student.eval()
+    drug_slots, graph_arrays = processor.packed_drug_graphs()
+    embeddings = ([], [])
+    for start in range(0, len(drug_slots), batch_size):
+        graph = gather_graphs(graph_arrays, drug_slots[start:start + batch_size])
+        for table, name in zip(embeddings, ('gcn_drug1', 'gcn_drug2')):
+            table.append(student.encode_drugs(name, graph))
+    return torch.cat(embeddings[0]), torch.cat(embeddings[1])
+
+
+def export(student, processor, out_dir, quantize=False, source=None):
+    """
+    :param quantize: 对 QUANTIZED_MODULES 中的 nn.Linear 做动态 int8 量化 (权重 int8，激活按 batch 动态量化)；
+                     GAT 的线性层为 torch_geometric 自有实现，保持 fp32
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    student = student.cpu().eval()
+
+    embedding1, embedding2 = encode_all_drugs(student, processor)
+    features = {
+        'drug_names': list(processor.drug_names),
+        'cell_names': list(processor.cell_names),
+        'drug_embedding1': embedding1,
+        'drug_embedding2': embedding2,
+        'target': processor.target_tensor.float().clone(),
+        'physchem': processor.physchem_tensor.float().clone(),
+        'cell': processor.cell_tensor.float().clone()
+    }
+    torch.save(features, os.path.join(out_dir, FEATURES_FILE))
+
+    head = ScoringHead(student).eval()
+    if quantize:
+        head = torch.ao.quantization.quantize_dynamic(head, set(QUANTIZED_MODULES), dtype=torch.qint8)
+    ids = torch.tensor([[1, 2, 1], [3, 4, 2]])
+    example = (embedding1[ids[:, 0]], embedding2[ids[:, 1]], features['target'][ids[:, 0]],
+               features['target'][ids[:, 1]], features['physchem'][ids[:, 0]], features['physchem'][ids[:, 1]],
+               features['cell'][ids[:, 2]])
+    with torch.no_grad():
+        torch.jit.trace(head, example).save(os.path.join(out_dir, HEAD_FILE))
+
+        # 编码器用两个不同大小的图 trace (新分子在调用方用同样的原子特征提取后传入)
+        drug_slots, graph_arrays = processor.packed_drug_graphs()
+        graph = gather_graphs(graph_arrays, drug_slots[1:3])
+        for name, filename in zip(('gcn_drug1', 'gcn_drug2'), ENCODER_FILES):
+            traced = torch.jit.trace(PooledDrugEncoder(getattr(student, name)).eval(),
+                                     (graph.x, graph.edge_index, graph.batch, graph.ptr), check_trace=False)
+            traced.save(os.path.join(out_dir, filename))
+
+    manifest = {
+        'version': EXPORT_VERSION,
+        'format': 'torchscript',
+        'quantized': quantize,
+        'quantized_modules': list(QUANTIZED_MODULES) if quantize else [],
+        'source': source,
+        'atom_feature_dim': processor.atom_feature_dim,
+        'num_drugs': len(processor.drug_names),
+        'num_cell_lines': len(processor.cell_names),
+        'torch': torch.__version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+    with open(os.path.join(out_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    size_mb = sum(os.path.getsize(os.path.join(out_dir, name)) for name in os.listdir(out_dir)) / 1e6
+    print(f"已导出到 {out_dir} ({'int8 动态量化' if quantize else 'fp32'}，{size_mb:.1f} MB)")
+    return manifest
+
+
+@torch.no_grad()
+def parity_check(student, processor, out_dir, num_samples=2048, seed=0):
+    """
+    在随机药物对 × 细胞系上比较导出产物与 eager 学生模型的协同概率，并抽查编码器的池化嵌入
+    :return: 报告字典
+    """
+    from cpu_runner import SynergyScorer
+
+    student = student.cpu().eval()
+    scorer = SynergyScorer(out_dir)
+    generator = torch.Generator().manual_seed(seed)
+    ids = torch.stack([torch.randint(1, len(processor.drug_names), (num_samples,), generator=generator),
+                       torch.randint(1, len(processor.drug_names), (num_samples,), generator=generator),
+                       torch.randint(1, len(processor.cell_names), (num_samples,), generator=generator)], dim=1)
+
+    graphs = processor.packed_drug_graphs()
+    eager = torch.cat([student.predict(build_screen_batch(processor, chunk, graphs=graphs))
+                       for chunk in ids.split(256)])
+    exported = scorer.score_ids(ids)
+    diff = (eager - exported).abs()
+
+    drug_slots, graph_arrays = graphs
+    graph = gather_graphs(graph_arrays, drug_slots[torch.arange(5, 37)])
+    encoder_diff = (scorer.encode_graph(graph.x, graph.edge_index, graph.batch, graph.ptr)[0]
+                    - student.encode_drugs('gcn_drug1', graph)).abs().max().item()
+
+    query = ids[:1]
+    report = {
+        'samples': num_samples,
+        'quantized': scorer.manifest['quantized'],
+        'prob_max_abs_diff': diff.max().item(),
+        'prob_mean_abs_diff': diff.mean().item(),
+        'decision_agreement': ((eager >= 0.5) == (exported >= 0.5)).float().mean().item(),
+        'encoder_max_abs_diff': encoder_diff,
+        'eager_single_query_ms': time_it(lambda: student.predict(build_screen_batch(processor, query,
+                                                                                    graphs=graphs))),
+        'exported_single_query_ms': time_it(lambda: scorer.score_ids(query)),
+        'eager_batch256_ms': time_it(lambda: student.predict(build_screen_batch(processor, ids[:256],
+                                                                                graphs=graphs)), 10),
+        'exported_batch256_ms': time_it(lambda: scorer.score_ids(ids[:256]), 10)
+    }
+    return report
+
+
+def main():
+    import logging
+    from main import BUNDLE_PATH, GRAPH_CACHE_PATH, build_processor
+
+    parser = argparse.ArgumentParser(description="导出学生模型的 CPU 推理产物 (TorchScript，可选 int8 动态量化)")
+    parser.add_argument('--student', default='student.pt', help="distill.py 保存的学生模型")
+    parser.add_argument('--out-dir', default='export')
+    parser.add_argument('--quantize', action='store_true', help="输入投影层做动态 int8 量化")
+    parser.add_argument('--bundle', default=BUNDLE_PATH)
+    parser.add_argument('--graph-cache', default=GRAPH_CACHE_PATH)
+    parser.add_argument('--parity-samples', type=int, default=2048)
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help="fp32 为概率最大绝对误差的容差 (默认 1e-4)；int8 为平均绝对误差的容差 (默认 0.01)")
+    parser.add_argument('--min-agreement', type=float, default=0.98, help="int8 导出的最低判定一致率")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    # 与训练 / 蒸馏相同的特征 (main.TARGET_PROPAGATION 决定是否做靶点网络传播)
+    processor = build_processor(args.bundle, args.graph_cache)
+    student = load_student(args.student, processor=processor)
+
+    export(student, processor, args.out_dir, quantize=args.quantize, source=os.path.abspath(args.student))
+    report = parity_check(student, processor, args.out_dir, num_samples=args.parity_samples)
+    tolerance = args.tolerance if args.tolerance is not None else (0.01 if args.quantize else 1e-4)
+
+    print(f"一致性检查 ({report['samples']} 个样本): 概率最大误差 {report['prob_max_abs_diff']:.2e}，"
+          f"平均误差 {report['prob_mean_abs_diff']:.2e}，判定一致率 {report['decision_agreement']:.4f}，"
+          f"编码器最大误差 {report['encoder_max_abs_diff']:.2e}")
+    print(f"单次查询: eager {report['eager_single_query_ms']:.3f} ms -> 导出 {report['exported_single_query_ms']:.3f} ms | "
+          f"256 条: eager {report['eager_batch256_ms']:.2f} ms -> 导出 {report['exported_batch256_ms']:.2f} ms")
+    with open(os.path.join(args.out_dir, 'parity.json'), 'w', encoding='utf-8') as f:
+        json.dump(dict(report, tolerance=tolerance), f, indent=2)
+    # 编码器不量化，两种导出都应与 eager 一致；int8 的个别样本误差可能较大，按平均误差与判定一致率检查
+    if args.quantize:
+        passed = report['prob_mean_abs_diff'] <= tolerance and report['decision_agreement'] >= args.min_agreement
+    else:
+        passed = report['prob_max_abs_diff'] <= tolerance
+    if not passed or report['encoder_max_abs_diff'] > 1e-4:
+        print(f"一致性检查未通过 (容差 {tolerance})")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
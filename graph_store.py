@@ -0,0 +1,251 @@
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+# 文件头: 魔数 + 8 字节头长度 + JSON 头；数组按 64 字节对齐紧随其后
+_MAGIC = b'DGSTORE1'
+_ALIGN = 64
+
+
+def write_packed(path, magic, header, arrays):
+    """
+    写出 "魔数 + 8 字节头长度 + JSON 头 + 64 字节对齐数组" 格式的文件 (先写临时文件再原子替换)
+    :param header: 可 JSON 序列化的字典，数组的 dtype/shape/offset 会写入其中的 'arrays' 字段
+    :param arrays: {name: np.ndarray}
+    """
+    metas, offset = {}, 0
+    arrays = {name: np.ascontiguousarray(arr) for name, arr in arrays.items()}
+    for name, arr in arrays.items():
+        metas[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+        offset += -(-arr.nbytes // _ALIGN) * _ALIGN
+
+    # 头部长度会影响数组的绝对偏移 (偏移的位数又影响头部长度)：按当前偏移序列化头部，
+    # 放不下时以新的长度重新对齐并平移，直到头部能放进预留空间 (base 只增不减，必然收敛)
+    header = dict(header, arrays=metas)
+    relative = {name: meta['offset'] for name, meta in metas.items()}
+    base = 0
+    while True:
+        for name, meta in metas.items():
+            meta['offset'] = relative[name] + base
+        header_bytes = json.dumps(header).encode('utf-8')
+        needed = -(-(len(magic) + 8 + len(header_bytes)) // _ALIGN) * _ALIGN
+        if needed <= base:
+            break
+        base = needed
+    header_bytes += b' ' * (base - len(magic) - 8 - len(header_bytes))
+
+    dir_name = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dir_name, exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(magic)
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for name, arr in arrays.items():
+            f.seek(metas[name]['offset'])
+            f.write(arr.tobytes())
+        f.truncate(base + offset)
+    # 原子替换，避免并发运行读到写了一半的文件
+    os.replace(tmp_path, path)
+
+
+def read_packed_header(path, magic):
+    """只读取文件头；魔数不匹配时抛出 ValueError"""
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError("文件头不匹配")
+        header_len = int.from_bytes(f.read(8), 'little')
+        return json.loads(f.read(header_len).decode('utf-8'))
+
+
+def open_packed_arrays(path, header, mode='r'):
+    """按文件头把各数组映射为 memmap 视图 (mode='c' 时为写时复制，可直接交给 torch.from_numpy)"""
+    mm = np.memmap(path, dtype=np.uint8, mode=mode)
+    return {
+        name: np.ndarray(tuple(meta['shape']), dtype=np.dtype(meta['dtype']), buffer=mm, offset=meta['offset'])
+        for name, meta in header['arrays'].items()
+    }
+
+
+def pack_graphs(graphs):
+    """
+    把 {key: (edge_index, x)} 打包为扁平数组 + 偏移表
+    :return: (keys, {'x', 'edge_index', 'node_ptr', 'edge_ptr'} 的 numpy 数组)
+    """
+    keys = list(graphs)
+    xs = [graphs[k][1].numpy().astype(np.float32, copy=False) for k in keys]
+    edges = [graphs[k][0].numpy().astype(np.int64, copy=False) for k in keys]
+    feat_dim = xs[0].shape[1] if xs else 0
+    return keys, {
+        'x': np.concatenate(xs) if xs else np.zeros((0, feat_dim), dtype=np.float32),
+        'edge_index': np.concatenate(edges, axis=1) if edges else np.zeros((2, 0), dtype=np.int64),
+        'node_ptr': np.concatenate([[0], np.cumsum([len(x) for x in xs])]).astype(np.int64),
+        'edge_ptr': np.concatenate([[0], np.cumsum([e.shape[1] for e in edges])]).astype(np.int64),
+    }
+
+
+def gather_graphs(arrays, slots):
+    """
+    按图序号从打包数组中直接拼出块对角的批量图 (与 Batch.from_data_list 的结果相同)，全部为向量化张量操作，
+    数组与 slots 在哪个设备上就在哪个设备上完成
+    :param arrays: pack_graphs 布局的张量字典 {'x', 'edge_index', 'node_ptr', 'edge_ptr'}
+    :param slots: LongTensor [B]，batch 中每个图在打包数组中的序号 (可重复)
+    :return: torch_geometric Batch (x, edge_index, batch, ptr)
+    """
+    from torch_geometric.data import Batch
+
+    node_ptr, edge_ptr = arrays['node_ptr'], arrays['edge_ptr']
+    node_starts, edge_starts = node_ptr[slots], edge_ptr[slots]
+    node_counts = node_ptr[slots + 1] - node_starts
+    edge_counts = edge_ptr[slots + 1] - edge_starts
+    graph_ids = torch.arange(len(slots), device=slots.device)
+
+    # 新批量中各图的起始节点 / 起始边位置
+    ptr = torch.cat([node_counts.new_zeros(1), torch.cumsum(node_counts, 0)])
+    edge_offsets = torch.cumsum(edge_counts, 0) - edge_counts
+    # 输出大小需要同步一次到 CPU，之后的展开都不再同步
+    num_nodes, num_edges = int(ptr[-1]), int(edge_counts.sum())
+
+    # 第 j 个位置在打包数组中的下标 = j - (新起点 - 原起点)，按所属图展开
+    node_index = torch.arange(num_nodes, device=slots.device) - torch.repeat_interleave(
+        ptr[:-1] - node_starts, node_counts, output_size=num_nodes)
+    edge_graph = torch.repeat_interleave(graph_ids, edge_counts, output_size=num_edges)
+    edge_index = torch.arange(num_edges, device=slots.device) - (edge_offsets - edge_starts)[edge_graph]
+    return Batch(
+        x=arrays['x'][node_index],
+        # 打包数组中是图内局部编号，加上各图在新批量中的起始节点
+        edge_index=arrays['edge_index'][:, edge_index] + ptr[edge_graph],
+        batch=torch.repeat_interleave(graph_ids, node_counts, output_size=num_nodes),
+        ptr=ptr
+    )
+
+
+def graph_key(smiles, featurizer_version):
+    """稳定的内容哈希 (不受 Python 进程级 hash 随机化影响)"""
+    return hashlib.sha1(f"{featurizer_version}\x00{smiles}".encode('utf-8')).hexdigest()
+
+
+class PackedGraphStore:
+    """
+    磁盘上的分子图缓存：所有图的节点特征与边索引打包成扁平数组 + 偏移表，
+    以 memmap 方式只读打开，DataLoader 的各个 worker 共享同一份物理页。
+
+    布局:
+        x          float32 [总节点数, atom_feature_dim]
+        edge_index int64   [2, 总边数]   (每个图内部的局部节点编号)
+        node_ptr   int64   [图数 + 1]
+        edge_ptr   int64   [图数 + 1]
+    """
+
+    def __init__(self, path, featurizer_version):
+        self.path = path
+        self.featurizer_version = featurizer_version
+        self.key_to_slot = {}
+        self.arrays = {}
+        if os.path.exists(path):
+            self._open()
+
+    def _open(self):
+        try:
+            header = read_packed_header(self.path, _MAGIC)
+        except Exception as e:
+            logger.warning(f"图缓存文件 {self.path} 无法读取，将重新构建: {e}")
+            return
+
+        if header.get('featurizer_version') != self.featurizer_version:
+            logger.info(f"图缓存特征版本不一致 ({header.get('featurizer_version')})，将重新构建")
+            return
+
+        self.arrays = open_packed_arrays(self.path, header)
+        self.key_to_slot = {key: i for i, key in enumerate(header['keys'])}
+
+    def __len__(self):
+        return len(self.key_to_slot)
+
+    def __contains__(self, key):
+        return key in self.key_to_slot
+
+    def get(self, key):
+        """按内容哈希取图，返回 (edge_index, x)；不存在时返回 None"""
+        slot = self.key_to_slot.get(key)
+        if slot is None:
+            return None
+        node_ptr, edge_ptr = self.arrays['node_ptr'], self.arrays['edge_ptr']
+        # 从 memmap 中拷贝出这一个图的小切片，整块数组始终只有一份物理拷贝
+        x = torch.from_numpy(np.array(self.arrays['x'][node_ptr[slot]:node_ptr[slot + 1]]))
+        edge_index = torch.from_numpy(np.array(self.arrays['edge_index'][:, edge_ptr[slot]:edge_ptr[slot + 1]]))
+        return edge_index, x
+
+    def items(self):
+        for key in self.key_to_slot:
+            yield key, self.get(key)
+
+    def build(self, graphs):
+        """
+        将新图与已有缓存合并后写回磁盘并重新 memmap 打开
+        :param graphs: {key: (edge_index, x)}
+        """
+        merged = dict(self.items())
+        merged.update(graphs)
+        keys, arrays = pack_graphs(merged)
+
+        # 释放旧的 memmap 后再覆盖文件
+        self.arrays, self.key_to_slot = {}, {}
+        write_packed(self.path, _MAGIC, {'featurizer_version': self.featurizer_version, 'keys': keys}, arrays)
+        self._open()
+        logger.info(f"图缓存已写入 {self.path}: {len(keys)} 个分子, {len(arrays['x'])} 个原子")
+
+    def __getstate__(self):
+        # 以 spawn 方式启动 worker 时只传路径，到子进程里重新 memmap，而不是把整块数组序列化过去
+        state = self.__dict__.copy()
+        state['arrays'], state['key_to_slot'] = {}, {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if os.path.exists(self.path):
+            self._open()
+
+
+class SharedGraphArrays:
+    """
+    进程内的打包图缓存：与 PackedGraphStore 相同的扁平数组 + 偏移布局，但存放在共享内存张量中，
+    用于没有磁盘图缓存时替代由大量小张量组成的 graph_cache 字典 (fork 出的 worker 触碰其引用计数会复制内存页)
+    """
+
+    def __init__(self, graphs):
+        self.key_to_slot = {}
+        self.arrays = {}
+        self.build(graphs)
+
+    def __len__(self):
+        return len(self.key_to_slot)
+
+    def __contains__(self, key):
+        return key in self.key_to_slot
+
+    def get(self, key):
+        slot = self.key_to_slot.get(key)
+        if slot is None:
+            return None
+        node_ptr, edge_ptr = self.arrays['node_ptr'], self.arrays['edge_ptr']
+        x = self.arrays['x'][int(node_ptr[slot]):int(node_ptr[slot + 1])].clone()
+        edge_index = self.arrays['edge_index'][:, int(edge_ptr[slot]):int(edge_ptr[slot + 1])].clone()
+        return edge_index, x
+
+    def items(self):
+        for key in self.key_to_slot:
+            yield key, self.get(key)
+
+    def build(self, graphs):
+        merged = dict(self.items())
+        merged.update(graphs)
+        keys, arrays = pack_graphs(merged)
+        self.arrays = {name: torch.from_numpy(arr).share_memory_() for name, arr in arrays.items()}
+        self.key_to_slot = {key: i for i, key in enumerate(keys)}
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import resource
+import statistics
+import contextlib
+from collections import defaultdict
+
+import torch
+
+# 训练步内的各个阶段，顺序即报告中的列顺序
+STAGES = ['data_wait', 'h2d', 'gat_forward', 'projection', 'tokenization', 'qwen_forward', 'backward', 'optimizer']
+
+
+class StepTimer:
+    """
+    训练步分阶段计时：数据等待、主机到设备拷贝、GAT 前向、投影、分词、Qwen 前向、反向、优化器。
+    每步的记录以 JSONL 流式写出，同时统计 samples/s 与 tokens/s；可选对指定步数窗口抓取 torch.profiler trace。
+    计时时会在阶段边界同步 CUDA，以便把异步执行的耗时准确归到对应阶段，因此只应在诊断时开启。
+    """
+
+    def __init__(self, device, log_path='step_timing.jsonl', profile_steps=None, profile_dir='profiler_traces'):
+        """
+        :param log_path: JSONL 输出路径，None 表示不落盘
+        :param profile_steps: (起始步, 结束步)，在该窗口内 (按全局步数计) 抓取 profiler trace
+        """
+        self.device = device
+        self.log_path = log_path
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        self.global_step = 0
+        self._current = None
+        self._step_start = None
+        self._epoch_totals = defaultdict(float)
+        self._profiler = None
+
+        self._log_file = None
+        if log_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+            self._log_file = open(log_path, 'a', encoding='utf-8')
+
+    def _sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self._current is None:
+            yield
+            return
+        self._sync()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            self._current[name] = self._current.get(name, 0.0) + time.perf_counter() - start
+
+    def begin_step(self, epoch):
+        self._current = {}
+        self._epoch = epoch
+        self._step_start = time.perf_counter()
+        if self.profile_steps is not None and self.global_step == self.profile_steps[0]:
+            self._start_profiler()
+
+    def cancel_step(self):
+        """数据迭代结束时丢弃未完成的一步"""
+        self._current = None
+
+    def end_step(self, num_samples, num_tokens):
+        self._sync()
+        total = time.perf_counter() - self._step_start
+        record = {'epoch': self._epoch, 'step': self.global_step}
+        record.update({name: self._current.get(name, 0.0) for name in STAGES})
+        record['other'] = max(0.0, total - sum(self._current.values()))
+        record.update({
+            'total': total,
+            'samples': num_samples,
+            'tokens': num_tokens,
+            'samples_per_s': num_samples / total,
+            'tokens_per_s': num_tokens / total
+        })
+
+        for key in STAGES + ['other', 'total', 'samples', 'tokens']:
+            self._epoch_totals[key] += record[key]
+        self._epoch_totals['steps'] += 1
+        if self._log_file is not None:
+            self._log_file.write(json.dumps(record) + '\n')
+            self._log_file.flush()
+
+        self._current = None
+        self.global_step += 1
+        if self._profiler is not None:
+            self._profiler.step()
+            if self.global_step >= self.profile_steps[1]:
+                self._stop_profiler()
+        return record
+
+    def _start_profiler(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self._profiler = torch.profiler.profile(
+            activities=activities,
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(self.profile_dir),
+            record_shapes=True,
+            profile_memory=True
+        )
+        self._profiler.__enter__()
+
+    def _stop_profiler(self):
+        self._profiler.__exit__(None, None, None)
+        self._profiler = None
+        print(f"Profiler trace 已写入 {self.profile_dir}")
+
+    def epoch_summary(self):
+        """打印并返回本 epoch 各阶段的平均耗时占比与吞吐，然后清零累计"""
+        totals, self._epoch_totals = self._epoch_totals, defaultdict(float)
+        steps = totals.get('steps', 0)
+        if not steps:
+            return {}
+        wall = totals['total']
+        summary = {name: totals[name] / steps for name in STAGES + ['other']}
+        summary['samples_per_s'] = totals['samples'] / wall
+        summary['tokens_per_s'] = totals['tokens'] / wall
+
+        parts = ' | '.join(f"{name}: {summary[name] * 1000:.1f}ms ({totals[name] / wall:.0%})"
+                           for name in STAGES + ['other'])
+        print(f"[Step Timing] {parts}")
+        print(f"[Throughput] {summary['samples_per_s']:.1f} samples/s | {summary['tokens_per_s']:.0f} tokens/s")
+        return summary
+
+    def close(self):
+        if self._profiler is not None:
+            self._stop_profiler()
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+
+def time_it(fn, repeat=50, warmup=5):
+    """
+    多次调用 fn，返回单次耗时的中位数 (毫秒)
+    :param warmup: 预热调用次数，不计入统计
+    """
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def current_rss_bytes():
+    # Linux: /proc/self/statm 的第二列为当前常驻页数 (ru_maxrss 只是历史峰值，不能做差)
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def peak_rss_bytes():
+    # Linux 下 ru_maxrss 单位为 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
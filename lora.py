@@ -0,0 +1,99 @@
+import re
+import math
+import logging
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+# Qwen2 每个解码层中注意力与 MLP 的线性投影
+QWEN_PROJECTIONS = ('q_proj', 'k_proj', 'v_proj', 'o_proj', 'gate_proj', 'up_proj', 'down_proj')
+
+_LAYER_PATTERN = re.compile(r'(?:^|\.)layers\.(\d+)\.')
+
+
+class LoRALinear(nn.Module):
+    """
+    冻结的 nn.Linear 加低秩增量: y = W x + b + (alpha / rank) * B A dropout(x)
+    A 按 Kaiming 均匀分布初始化、B 初始化为 0，注入后模型输出与原模型一致。
+    A、B 保持 fp32 (基座为 bf16 时 AdamW 的小步长更新不会被舍入掉)，merge 时再折叠进基座权重的精度
+    """
+
+    def __init__(self, base, rank=8, alpha=16, dropout=0.0):
+        super().__init__()
+        self.base = base
+        for param in base.parameters():
+            param.requires_grad = False
+        self.rank = rank
+        self.scaling = alpha / rank
+        device = base.weight.device
+        self.lora_A = nn.Parameter(torch.empty(rank, base.in_features, device=device))
+        self.lora_B = nn.Parameter(torch.zeros(base.out_features, rank, device=device))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.dropout = nn.Dropout(dropout) if dropout > 0 else nn.Identity()
+
+    def forward(self, x):
+        out = self.base(x)
+        delta = F.linear(F.linear(self.dropout(x).to(self.lora_A.dtype), self.lora_A), self.lora_B)
+        return out + (delta * self.scaling).to(out.dtype)
+
+    @torch.no_grad()
+    def merge(self):
+        """把低秩增量加到基座权重上，返回可直接替换回去的 nn.Linear"""
+        weight = self.base.weight
+        delta = (self.lora_B @ self.lora_A) * self.scaling
+        weight.copy_((weight.float() + delta).to(weight.dtype))
+        return self.base
+
+
+def inject_lora(module, target_modules=QWEN_PROJECTIONS, layers=None, rank=8, alpha=16, dropout=0.0):
+    """
+    冻结 module 的全部参数，把指定解码层中名为 target_modules 的 nn.Linear 原地替换为 LoRALinear
+    :param layers: 解码层编号的集合 (按模块名中的 'layers.<i>.' 匹配)，None 表示全部层
+    :return: 被替换的模块名列表
+    """
+    for param in module.parameters():
+        param.requires_grad = False
+
+    layers = None if layers is None else set(layers)
+    names = []
+    for name, child in module.named_modules():
+        if not isinstance(child, nn.Linear) or name.rsplit('.', 1)[-1] not in target_modules:
+            continue
+        if layers is not None:
+            match = _LAYER_PATTERN.search(name)
+            if match is None or int(match.group(1)) not in layers:
+                continue
+        names.append(name)
+
+    for name in names:
+        parent_name, _, attr = name.rpartition('.')
+        parent = module.get_submodule(parent_name)
+        setattr(parent, attr, LoRALinear(getattr(parent, attr), rank=rank, alpha=alpha, dropout=dropout))
+    if not names:
+        logger.warning(f"没有匹配到可注入 LoRA 的线性层: {target_modules}, layers={sorted(layers or [])}")
+    return names
+
+
+def merge_lora(module):
+    """把 module 中的所有 LoRALinear 合并回普通 nn.Linear (推理用，合并后 state_dict 与原模型键名一致)"""
+    names = [name for name, child in module.named_modules() if isinstance(child, LoRALinear)]
+    for name in names:
+        parent_name, _, attr = name.rpartition('.')
+        parent = module.get_submodule(parent_name) if parent_name else module
+        setattr(parent, attr, getattr(parent, attr).merge())
+    return len(names)
+
+
+def parameter_summary(model):
+    """
+    可训练参数量、总参数量与 AdamW 状态 (两个与参数同 dtype 的矩估计) 占用的字节数
+    """
+    trainable = [p for p in model.parameters() if p.requires_grad]
+    return {
+        'trainable': sum(p.numel() for p in trainable),
+        'total': sum(p.numel() for p in model.parameters()),
+        'optimizer_state_bytes': sum(2 * p.numel() * p.element_size() for p in trainable)
+    }
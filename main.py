@@ -6,34 +6,107 @@ from model import QwenEnhancedDrugSynergyModel
 from trainer import ImprovedDrugSynergyTrainer
 from dataset import DrugSynergyDataset
 from data_processor import DrugCellDataProcessor
-from utils import collate_fn
+from utils import SmilesTokenCache, create_tokenized_collate_fn, create_packed_collate_fn
+from sampler import LengthBucketBatchSampler, compute_pair_lengths, report_padding
+from device_loader import DeviceResidentLoader
+from prefix_cache import PrefixStateCache
+from autotune import load_autotune_config, describe_device
+from distributed import init_distributed, is_main_process, barrier, cleanup
+
+
+# 1. 基础配置 (screen.py 等脚本复用同一份模型配置)
+QWEN_MODEL_NAME = "Qwen/Qwen2.5-3B-Instruct"
+
+GCN_CONFIG = {
+    'in_feats': 64,
+    'hidden_size': 256,
+    'out_feats': 512
+}
+
+# Qwen 微调方式：最后 12 个解码层的注意力与 MLP 投影上训练秩 16 的低秩适配器，其余参数冻结；
+# 设为 None 则回到解冻最后 120 个参数张量的全秩微调 (两种方式的 checkpoint 互不兼容)
+LORA_CONFIG = {
+    'rank': 16,
+    'alpha': 32,
+    'dropout': 0.05,
+    'last_layers': 12
+}
+
+# 文本在前布局 + 冻结前缀隐状态缓存：冻结的下层只依赖 SMILES 文本，其输出按药物对缓存 (内存 LRU + 磁盘)，
+# 每步只有可训练的上层前向/反向；布局与默认不同，需从头训练，checkpoint 与默认布局不通用
+# 例: {'max_bytes': 8 * 2 ** 30, 'cache_dir': 'cache/prefix_states'}
+PREFIX_CACHE = None
+
+# 可选的设备常驻加载：全部特征与分子图只有几十 MB，一次性上传到训练设备，batch 在设备上直接按下标 gather，
+# 不再经过 DataLoader 与 collate。默认关闭 (共享内存 + 多 worker 的 DataLoader)；autotune 测得更快时由其结果开启
+DEVICE_RESIDENT_DATA = False
+
+# 二进制数据包及其源文件：首次运行时编译，源文件变化时自动重建
+BUNDLE_PATH = 'cache/dataset.bundle'
+DATA_SOURCES = {
+    'drug_data_file': 'merged_drug_data_complete.csv',
+    'drug_target_file': 'Drug_Target_Protein.csv',
+    'cell_line_file': 'cell_ge_1024_features.csv',
+    'synergy_file': 'two_class_synergy_data.csv'
+}
+GRAPH_CACHE_PATH = 'cache/drug_graphs.bin'
+
+# 靶点谱在靶点相互作用网络上的传播 (propagate_targets 的参数)，None 表示使用原始靶点谱。
+# 传播后靶点谱明显变稠密 (约 46 个非零/药物)，稀疏靶点编码的收益随之减小；开启后需重新训练
+# 例: {'network_file': 'Target_realation.csv', 'method': 'rwr', 'restart_prob': 0.5}
+TARGET_PROPAGATION = None
+
+# python autotune.py 的结果：存在且与当前设备、模型配置一致时覆盖下面的 batch_size、worker 数与 DEVICE_RESIDENT_DATA
+AUTOTUNE_CONFIG = 'autotune_config.json'
+
+
+def build_processor(bundle_path=BUNDLE_PATH, graph_cache_path=GRAPH_CACHE_PATH, precompute_jobs=8,
+                    target_propagation=TARGET_PROPAGATION):
+    """
+    构建训练所用的数据处理器；distill.py / export.py / autotune.py / screen.py 都经由这里，保证特征与训练时一致
+    :param graph_cache_path: 磁盘图缓存，各 worker memmap 共享，后续运行无需再解析 SMILES
+    :param precompute_jobs: 首次构建图缓存时并行解析全部药物的进程数
+    :param target_propagation: propagate_targets 的参数，None 时不做靶点网络传播
+    """
+    # 三个特征 csv 与协同数据 csv 首次运行时编译为二进制数据包 (源文件变化时自动重建)，之后以 memmap 打开，不再解析 CSV
+    # 样本只携带靶点下标，模型用 embedding_bag 完成靶点投影
+    processor = DrugCellDataProcessor.from_bundle(bundle_path, sources=DATA_SOURCES, graph_cache_path=graph_cache_path,
+                                                  precompute_jobs=precompute_jobs, sparse_targets=True)
+    if target_propagation is not None:
+        # 传播结果按网络与参数缓存在 cache/ 下，只需计算一次
+        processor.propagate_targets(**target_propagation)
+    return processor
 
 
 def main():
-    # 1. 基础配置
-    QWEN_MODEL_NAME = "Qwen/Qwen2.5-3B-Instruct"
-
-    gcn_config = {
-        'in_feats': 64,
-        'hidden_size': 256,
-        'out_feats': 512
-    }
-
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(f"使用的计算设? {device}")
+    # 单进程: python main.py；数据并行: torchrun --nproc_per_node=N main.py (CPU 上走 gloo 后端)
+    rank, world_size, device = init_distributed()
+    print(f"[rank {rank}/{world_size}] 使用的计算设? {device}")
+
+    tuned = load_autotune_config(AUTOTUNE_CONFIG, device=describe_device(device), model={
+        'qwen': QWEN_MODEL_NAME, 'gcn': GCN_CONFIG, 'lora': LORA_CONFIG, 'precision': 'bf16'}) or {}
+    device_resident = tuned.get('device_resident', DEVICE_RESIDENT_DATA)
+    num_workers = tuned.get('num_workers', 8)
+    if tuned:
+        print(f"使用 {AUTOTUNE_CONFIG} 的调参结果: batch_size={tuned['batch_size']}, "
+              f"{'设备常驻加载' if device_resident else f'num_workers={num_workers}'}")
 
     # 2. 初始化数据处理器
     # 请确保这三个 csv 文件在你的项目目录下
     print("正在初始化数据处理器...")
-    processor = DrugCellDataProcessor(
-        'merged_drug_data_complete.csv',
-        'Drug_Target_Protein.csv',
-        'cell_ge_1024_features.csv'
-    )
+    # 首次运行时由 rank 0 构建图缓存，其余 rank 等待后直接 memmap 读取
+    if not is_main_process():
+        barrier()
+    processor = build_processor()
+    if not device_resident:
+        # 特征矩阵放入共享内存，8 个 DataLoader worker 直接映射同一份数据而不是各自复制
+        processor.share_memory()
+    if is_main_process():
+        barrier()
 
     # 3. 加载完整数据集并进行划分 (?8:1:1 比例)
     print("正在加载数据?..")
-    full_dataset = DrugSynergyDataset('two_class_synergy_data.csv', processor)
+    full_dataset = DrugSynergyDataset.from_bundle(processor)
 
     total_size = len(full_dataset)
     train_size = int(0.8 * total_size)
@@ -49,30 +122,71 @@ def main():
         generator=torch.Generator().manual_seed(42)
     )
 
+    # 预分词：每个药物对的整句文本只分词一次并按药物对缓存，forward 中不再调用分词器；
+    # 下面 compute_pair_lengths 会为 train/val/test 的全部药物对预先分词，DataLoader worker fork 后直接继承这份缓存
+    token_cache = SmilesTokenCache.from_pretrained(QWEN_MODEL_NAME)
+    # 样本只带药物 ID，collate 时从打包的分子图数组按偏移表一次拼出批量图 (不逐样本构造 Data)
+    full_dataset.include_graphs = False
+    collate_fn = create_tokenized_collate_fn(token_cache, create_packed_collate_fn(processor))
+
     # 4. 创建对应?DataLoader
     # 【优化项 1】：针对 A40 48GB 显存，大幅提?batch_size 榨干显卡算力
-    batch_size = 32 
-
-    # 【优化项 2】：开启多线程 (num_workers) 和锁页内?(pin_memory)，加?CPU ?GPU 喂数据的速度
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, collate_fn=collate_fn, num_workers=8, pin_memory=True)
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn, num_workers=8, pin_memory=True)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn, num_workers=8, pin_memory=True)
+    batch_size = tuned.get('batch_size', 32)
+
+    # 长度分桶：按 (token 长度, 原子数) 把相近的样本放进同一个 batch，减少填充；
+    # 需要固定填充 token 总数时可改用 token_budget=batch_size * 平均长度
+    train_lengths, train_atoms = compute_pair_lengths(train_dataset, processor, token_cache)
+    # 分布式时各 rank 取 batch 列表的不同分片；评估不截断，保证每个样本恰好评估一次
+    shard = {'num_replicas': world_size, 'rank': rank}
+    train_sampler = LengthBucketBatchSampler(train_lengths, train_atoms, batch_size=batch_size, shuffle=True, **shard)
+    if is_main_process():
+        report_padding(train_lengths, train_sampler, batch_size=batch_size)
+    val_sampler = LengthBucketBatchSampler(*compute_pair_lengths(val_dataset, processor, token_cache),
+                                           batch_size=batch_size, shuffle=False, even_shards=False, **shard)
+    test_sampler = LengthBucketBatchSampler(*compute_pair_lengths(test_dataset, processor, token_cache),
+                                            batch_size=batch_size, shuffle=False, even_shards=False, **shard)
+
+    if device_resident:
+        # 沿用上面的长度分桶 (及分布式分片) 采样器，只替换取数与拼 batch 的方式
+        train_loader = DeviceResidentLoader(train_dataset, processor, device, batch_sampler=train_sampler,
+                                            token_cache=token_cache)
+        val_loader = DeviceResidentLoader(val_dataset, processor, device, batch_sampler=val_sampler,
+                                          token_cache=token_cache)
+        test_loader = DeviceResidentLoader(test_dataset, processor, device, batch_sampler=test_sampler,
+                                           token_cache=token_cache)
+    else:
+        # 【优化项 2】：开启多线程 (num_workers) 和锁页内?(pin_memory)，加?CPU ?GPU 喂数据的速度
+        train_loader = DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=collate_fn, num_workers=num_workers, pin_memory=True)
+        val_loader = DataLoader(val_dataset, batch_sampler=val_sampler, collate_fn=collate_fn, num_workers=num_workers, pin_memory=True)
+        test_loader = DataLoader(test_dataset, batch_sampler=test_sampler, collate_fn=collate_fn, num_workers=num_workers, pin_memory=True)
 
     print("正在初始化大语言模型及GNN网络...")
     model = QwenEnhancedDrugSynergyModel(
-        gcn_config=gcn_config,
+        gcn_config=GCN_CONFIG,
         qwen_model_name=QWEN_MODEL_NAME,
         target_dim=processor.target_dim,  # 动态传入真实的靶点维度 (1162)
         cell_dim=processor.cell_dim,  # 动态传入真实的细胞系维?(1024)
-        physchem_dim=processor.physchem_dim  # 动态传入真实的理化维度 (7)
+        physchem_dim=processor.physchem_dim,  # 动态传入真实的理化维度 (7)
+        lora_config=LORA_CONFIG
     )
+    if PREFIX_CACHE is not None:
+        model.enable_text_first(prefix_cache=PrefixStateCache(**PREFIX_CACHE))
+        print(f"文本在前布局: 前 {model.prefix_split_layer} 层的文本隐状态按药物对缓存")
 
     # 5. 初始?Trainer 并启动训?
     # 此时传入的已经是真实划分好的三个独立?loader，不再是重复传入 train_loader
-    trainer = ImprovedDrugSynergyTrainer(model, train_loader, val_loader, test_loader, device)
+    # bf16 autocast + 梯度累积 (等效 batch = batch_size * accumulation_steps)，loss 每 50 步才同步一次
+    trainer = ImprovedDrugSynergyTrainer(model, train_loader, val_loader, test_loader, device,
+                                         precision='bf16', accumulation_steps=1, compile_modules=False,
+                                         log_every=50,
+                                         instrument=False,  # 设为 True 可按阶段拆分每步耗时，写入 step_timing.jsonl
+                                         checkpoint_dir='checkpoints',  # 每个 epoch 异步保存可训练参数增量
+                                         resume_from='checkpoints',  # 目录下有 checkpoint 时自动从最新一次继续
+                                         metrics_log='training_metrics.jsonl')  # 每次评估立即追加，Excel 用 metrics.py export 生成
 
     print("所有准备工作完毕，开始训练！")
     trainer.train(num_epochs=100)
+    cleanup()
 
 
 if __name__ == '__main__':
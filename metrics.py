@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import argparse
+
+import pandas as pd
+import torch
+import torch.distributed as dist
+
+from distributed import is_distributed, get_world_size, all_reduce_sum
+from sklearn.metrics import (
+    accuracy_score, f1_score, precision_score, recall_score,
+    roc_auc_score, average_precision_score, matthews_corrcoef, cohen_kappa_score
+)
+
+
+class StreamingBinaryMetrics:
+    """
+    在设备上流式累积二分类指标：混淆矩阵计数 + 正/负样本的定长概率直方图，
+    每个 batch 只做几次 bincount，不与 CPU 同步，内存与评估集大小无关。
+    AUROC / AUPRC 由直方图近似 (分桶越多越精确)；exact=True 时额外在设备上保留全部概率，
+    结束时一次性拷回 CPU 用 sklearn 精确计算 (用于最终测试集)。
+    """
+
+    def __init__(self, device, num_bins=1000, exact=False):
+        self.device = device
+        self.num_bins = num_bins
+        self.exact = exact
+        self.reset()
+
+    def reset(self):
+        # 顺序为 [TN, FP, FN, TP] (下标 = label * 2 + pred)
+        self.confusion = torch.zeros(4, dtype=torch.long, device=self.device)
+        # 第 0 行为负样本、第 1 行为正样本在各概率分桶中的计数
+        self.histogram = torch.zeros(2, self.num_bins, dtype=torch.long, device=self.device)
+        self._probs, self._preds, self._labels = [], [], []
+
+    def update(self, probs, preds, labels):
+        """
+        :param probs: 正类概率 [B]
+        :param preds: 预测类别 [B]
+        :param labels: 真实标签 [B]
+        """
+        labels = labels.long()
+        self.confusion += torch.bincount(labels * 2 + preds.long(), minlength=4)
+        bins = (probs.float() * self.num_bins).long().clamp_(0, self.num_bins - 1)
+        self.histogram += torch.bincount(labels * self.num_bins + bins,
+                                         minlength=2 * self.num_bins).view(2, self.num_bins)
+        if self.exact:
+            self._probs.append(probs.detach().float())
+            self._preds.append(preds.detach())
+            self._labels.append(labels.detach())
+
+    def state_tensors(self):
+        """需要跨进程求和的累计量 (分布式评估时 all_reduce 用)"""
+        return [self.confusion, self.histogram]
+
+    def all_reduce(self):
+        """分布式评估：各 rank 的计数求和；exact 模式下把全部概率汇集到每个 rank"""
+        if not is_distributed():
+            return
+        all_reduce_sum(*self.state_tensors())
+        if self.exact:
+            local = [torch.cat(values).cpu() if values else torch.zeros(0)
+                     for values in (self._probs, self._preds, self._labels)]
+            gathered = [None] * get_world_size()
+            dist.all_gather_object(gathered, local)
+            self._probs, self._preds, self._labels = ([part[i] for part in gathered if len(part[i])]
+                                                      for i in range(3))
+
+    def _approx_curves(self):
+        # 从高概率分桶往低扫描阈值，得到累计 TP / FP
+        neg, pos = self.histogram.double().flip(1).cpu()
+        tp, fp = torch.cumsum(pos, 0), torch.cumsum(neg, 0)
+        n_pos, n_neg = tp[-1].item(), fp[-1].item()
+
+        auroc = 0.0
+        if n_pos > 0 and n_neg > 0:
+            tpr = torch.cat([torch.zeros(1, dtype=tp.dtype), tp / n_pos])
+            fpr = torch.cat([torch.zeros(1, dtype=fp.dtype), fp / n_neg])
+            auroc = torch.trapezoid(tpr, fpr).item()
+
+        auprc = 0.0
+        if n_pos > 0:
+            precision = tp / (tp + fp).clamp(min=1)
+            recall_gain = pos / n_pos
+            auprc = (recall_gain * precision).sum().item()
+        return auroc, auprc
+
+    def _exact_metrics(self):
+        labels = torch.cat(self._labels).cpu().numpy()
+        preds = torch.cat(self._preds).cpu().numpy()
+        probs = torch.cat(self._probs).cpu().numpy()
+        try:
+            auroc = roc_auc_score(labels, probs)
+        except ValueError:
+            auroc = 0.0  # 只有一个类别时无法计算
+        return {
+            'ACC': accuracy_score(labels, preds),
+            'F1': f1_score(labels, preds, zero_division=0),
+            'PREC': precision_score(labels, preds, zero_division=0),
+            'Recall': recall_score(labels, preds, zero_division=0),
+            'AUROC': auroc,
+            'AUPRC': average_precision_score(labels, probs),
+            'MCC': matthews_corrcoef(labels, preds),
+            'KAPPA': cohen_kappa_score(labels, preds)
+        }
+
+    def compute(self):
+        if self.exact and self._probs:
+            return self._exact_metrics()
+
+        tn, fp, fn, tp = (float(v) for v in self.confusion.cpu())
+        total = tn + fp + fn + tp
+        acc = (tp + tn) / total if total else 0.0
+        prec = tp / (tp + fp) if tp + fp else 0.0
+        rec = tp / (tp + fn) if tp + fn else 0.0
+        f1 = 2 * tp / (2 * tp + fp + fn) if tp else 0.0
+
+        mcc_denom = math.sqrt((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn))
+        mcc = (tp * tn - fp * fn) / mcc_denom if mcc_denom else 0.0
+
+        expected = ((tp + fp) * (tp + fn) + (fn + tn) * (fp + tn)) / (total * total) if total else 0.0
+        kappa = (acc - expected) / (1 - expected) if expected != 1 else 0.0
+
+        auroc, auprc = self._approx_curves()
+        return {'ACC': acc, 'F1': f1, 'PREC': prec, 'Recall': rec,
+                'AUROC': auroc, 'AUPRC': auprc, 'MCC': mcc, 'KAPPA': kappa}
+
+
+def new_run_id():
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+
+class MetricsLog:
+    """
+    只追加的指标日志：每条评估记录立即以一行 JSON 写入并落盘，带 run_id 与时间戳。
+    写入开销与历史长度无关，训练中途崩溃也不会丢失已完成 epoch 的指标；Excel 由 export 命令按需生成。
+    """
+
+    def __init__(self, path='training_metrics.jsonl', run_id=None):
+        self.path = path
+        self.run_id = run_id or new_run_id()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def append(self, record):
+        line = json.dumps({'run_id': self.run_id, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), **record},
+                          ensure_ascii=False, default=float)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def read_metrics_log(path, run_ids=None):
+    """读取指标日志为 DataFrame；崩溃时可能残留的半行会被跳过"""
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if run_ids is None or record.get('run_id') in run_ids:
+                records.append(record)
+    return pd.DataFrame(records)
+
+
+def export_metrics_to_excel(log_path='training_metrics.jsonl', filename='training_metrics.xlsx', run_ids=None):
+    df = read_metrics_log(log_path, run_ids)
+    df.to_excel(filename, index=False)
+    print(f"Metrics exported to {filename} ({len(df)} rows)")
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="指标日志工具")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export = subparsers.add_parser('export', help="由 JSONL 指标日志生成 Excel")
+    export.add_argument('--log', default='training_metrics.jsonl')
+    export.add_argument('--out', default='training_metrics.xlsx')
+    export.add_argument('--run-id', nargs='+', help="只导出指定 run (默认全部)")
+
+    subparsers.add_parser('runs', help="列出日志中的 run").add_argument('--log', default='training_metrics.jsonl')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.log):
+        print(f"指标日志不存在: {args.log}")
+        sys.exit(1)
+    if args.command == 'export':
+        export_metrics_to_excel(args.log, args.out, args.run_id)
+    else:
+        df = read_metrics_log(args.log)
+        for run_id, group in df.groupby('run_id', sort=False):
+            print(f"{run_id}  {group['time'].iloc[0]} -> {group['time'].iloc[-1]}  {len(group)} records")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,13 @@
+import contextlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch_geometric.nn import GATv2Conv, global_mean_pool
 from transformers import AutoModel, AutoTokenizer
 
+from lora import inject_lora, merge_lora
+from prefix_cache import frozen_prefix_layers, run_decoder_layers
+
 
 class FocalLoss(nn.Module):
     def __init__(self, weight=None, gamma=2.0, reduction='mean'):
@@ -35,14 +39,118 @@ class DrugGAT(nn.Module):
         return self.conv3(x, edge_index)
 
 
-class QwenEnhancedDrugSynergyModel(nn.Module):
+def _select_graphs(graph, index, num_graphs):
+    """
+    从批量图中选出 index (升序的图序号) 对应的子批量，纯张量操作，不重建 Data 对象
+    :return: (x, edge_index, batch)，batch 中的图序号为在 index 中的位置
+    """
+    keep = torch.zeros(num_graphs, dtype=torch.bool, device=index.device)
+    keep[index] = True
+    node_mask = keep[graph.batch]
+
+    new_node_id = torch.cumsum(node_mask, dim=0) - 1
+    edge_index = graph.edge_index[:, node_mask[graph.edge_index[0]]]
+    new_graph_id = torch.cumsum(keep, dim=0) - 1
+    return graph.x[node_mask], new_node_id[edge_index], new_graph_id[graph.batch[node_mask]]
+
+
+class DrugEncoderMixin:
+    """
+    教师 (QwenEnhancedDrugSynergyModel) 与学生 (StudentDrugSynergyModel) 共用的药物编码、靶点投影与推理接口。
+    使用方需提供 gcn_drug1 / gcn_drug2 / proj_target 子模块以及 unique_drug_encoding、cache_drug_embeddings、
+    _drug_embedding_cache、stage_timer 属性
+    """
+
+    def train(self, mode=True):
+        self.clear_drug_embedding_cache()
+        return super().train(mode)
+
+    def load_state_dict(self, *args, **kwargs):
+        self.clear_drug_embedding_cache()
+        return super().load_state_dict(*args, **kwargs)
+
+    def clear_drug_embedding_cache(self):
+        self._drug_embedding_cache = {}
+
+    def encode_drugs(self, encoder_name, graph, keys=None):
+        """
+        GAT 编码 + 全局平均池化，返回 [图数, out_feats]
+        :param keys: 每个图对应的药物标识 (如 SMILES)。训练模式或未提供时逐图编码；
+                     评估模式下只编码唯一且未缓存的药物，再按索引 gather
+        """
+        encoder = getattr(self, encoder_name)
+        if self.training or not self.unique_drug_encoding or keys is None:
+            return global_mean_pool(encoder(graph.x, graph.edge_index), graph.batch)
+
+        if not self.cache_drug_embeddings:
+            self.clear_drug_embedding_cache()
+        slots, table = self._drug_embedding_cache.setdefault(encoder_name, ({}, None))
+
+        first_pos = {}
+        for i, key in enumerate(keys):
+            if key not in slots and key not in first_pos:
+                first_pos[key] = i
+
+        if first_pos:
+            index = torch.tensor(list(first_pos.values()), dtype=torch.long, device=graph.x.device)
+            x, edge_index, batch = _select_graphs(graph, index, len(keys))
+            pooled = global_mean_pool(encoder(x, edge_index), batch, size=len(first_pos))
+            for key in first_pos:
+                slots[key] = len(slots)
+            table = pooled if table is None else torch.cat([table, pooled], dim=0)
+            self._drug_embedding_cache[encoder_name] = (slots, table)
+
+        gather_index = torch.tensor([slots[key] for key in keys], dtype=torch.long, device=table.device)
+        return table.index_select(0, gather_index)
+
+    def _stage(self, name):
+        """训练器开启分阶段计时时返回对应阶段的计时上下文，否则为空操作"""
+        if self.stage_timer is None:
+            return contextlib.nullcontext()
+        return self.stage_timer.stage(name)
+
+    def project_targets(self, batch_data, name):
+        """
+        靶点投影：稠密输入直接过 proj_target；稀疏输入 (indices/offsets/weights) 用 embedding_bag 对
+        proj_target 权重的对应列加权求和再加偏置，与稠密 Linear 数学上等价，计算量只与实际靶点数成正比
+        """
+        if name in batch_data:
+            return self.proj_target(batch_data[name].to(self.proj_target.weight.dtype))
+        weight = self.proj_target.weight
+        projected = F.embedding_bag(batch_data[f'{name}_indices'], weight.t(), batch_data[f'{name}_offsets'],
+                                    mode='sum', per_sample_weights=batch_data[f'{name}_weights'].to(weight.dtype))
+        return projected + self.proj_target.bias
+
+    @torch.no_grad()
+    def predict(self, batch_data):
+        """推理接口 (教师与学生模型相同)：返回正类 (协同) 概率 [B]"""
+        if self.training:
+            self.eval()
+        return F.softmax(self(batch_data).float(), dim=1)[:, 1]
+
+
+class QwenEnhancedDrugSynergyModel(DrugEncoderMixin, nn.Module):
     def __init__(self, gcn_config, num_classes=2, target_dim=560, cell_dim=1024, physchem_dim=7,
-                 qwen_model_name="Qwen/Qwen2.5-3B-Instruct"):
+                 qwen_model_name="Qwen/Qwen2.5-3B-Instruct", lora_config=None):
+        """
+        :param lora_config: None 时解冻 Qwen 最后 120 个参数张量做全秩微调；提供 {'rank', 'alpha', 'dropout',
+                            'last_layers', 'target_modules'} (除 rank 外均可省略) 时 Qwen 全部冻结，只在最后
+                            last_layers 个解码层的注意力与 MLP 投影上训练低秩适配器，推理前可调用 merge_lora 合并
+        """
         super().__init__()
         self.gcn_drug1 = DrugGAT(**gcn_config)
         self.gcn_drug2 = DrugGAT(**gcn_config)
 
-        # 【优化项 3】：开?bfloat16 半精度加载，激?A40 ?Tensor Core 加速计?
+        # 推理模式：每个唯一药物只过一次 GAT，再按索引 gather；
+        # 跨 batch 的药物嵌入缓存在每次切换 train/eval 或加载权重时清空
+        self.unique_drug_encoding = True
+        self.cache_drug_embeddings = True
+        self._drug_embedding_cache = {}
+
+        # 分阶段计时器 (由训练器在开启 instrument 时注入)
+        self.stage_timer = None
+
+        # 【优化项 3】：开启 bfloat16 半精度加载，激活 A40 的 Tensor Core 加速计算
         self.qwen = AutoModel.from_pretrained(
             qwen_model_name, 
             trust_remote_code=True,
@@ -51,21 +159,34 @@ class QwenEnhancedDrugSynergyModel(nn.Module):
         self.tokenizer = AutoTokenizer.from_pretrained(qwen_model_name, trust_remote_code=True)
         if self.tokenizer.pad_token is None: self.tokenizer.pad_token = self.tokenizer.eos_token
 
-        # 【修复警?】：手动关闭缓存机制
+        # 【修复警告】：手动关闭缓存机制
         self.qwen.config.use_cache = False
 
         # 【优化项 4】：A40 显存充足，注释掉梯度检查点以换取约 30% 的前向传播速度提升
         self.qwen.gradient_checkpointing_enable()
 
-        # 【修复警?】：强制输入层要求梯度，防止 PyTorch 报错
+        # 【修复警告】：强制输入层要求梯度，防止 PyTorch 报错
         self.qwen.enable_input_require_grads()
 
-        # 冻结部分参数，仅微调最?12 层以平衡效果与显?
-        for param in self.qwen.parameters(): param.requires_grad = False
-        for param in list(self.qwen.parameters())[-120:]: param.requires_grad = True
+        self.lora_config = lora_config
+        if lora_config is None:
+            # 冻结部分参数，仅微调最后 12 层以平衡效果与显存
+            for param in self.qwen.parameters(): param.requires_grad = False
+            for param in list(self.qwen.parameters())[-120:]: param.requires_grad = True
+        else:
+            # 低秩适配器：AdamW 只为 A/B 矩阵保存矩估计，checkpoint 也只含适配器
+            config = dict(lora_config)
+            num_layers = self.qwen.config.num_hidden_layers
+            last_layers = config.pop('last_layers', None)
+            layers = None if last_layers is None else range(max(0, num_layers - last_layers), num_layers)
+            inject_lora(self.qwen, layers=layers, **config)
+
+        # 文本在前布局的切分层与前缀隐状态缓存 (见 enable_text_first)；None 为默认的软 token 在前布局
+        self.prefix_split_layer = None
+        self.prefix_cache = None
 
         q_hid = self.qwen.config.hidden_size
-        # 特征投影?(确保将投影层转换?bfloat16 以匹?Qwen)
+        # 特征投影层 (确保将投影层转换为 bfloat16 以匹配 Qwen)
         self.proj_gcn = nn.Linear(gcn_config['out_feats'], q_hid, dtype=torch.bfloat16)
         self.proj_target = nn.Linear(target_dim, q_hid, dtype=torch.bfloat16)
         self.proj_physchem = nn.Linear(physchem_dim, q_hid, dtype=torch.bfloat16)
@@ -76,51 +197,167 @@ class QwenEnhancedDrugSynergyModel(nn.Module):
             nn.Linear(256, num_classes, dtype=torch.bfloat16)
         )
 
+    def enable_text_first(self, split_layer=None, prefix_cache=None):
+        """
+        改为文本 token 在前、7 个软 token 在后的输入布局：因果注意力下文本 token 看不到软 token，
+        冻结的前 split_layer 层对文本的输出只取决于 SMILES，可按药物对缓存 (prefix_cache.PrefixStateCache)；
+        软 token 从第 split_layer 层接入，只有上层处理完整序列。该布局与默认布局的权重不通用，需在此布局下训练。
+        prefix_cache 为 None 时每步重新计算下层 (即缓存路径的对照)
+        :param split_layer: 默认取从第 0 层起参数全部冻结的层数
+        """
+        frozen = frozen_prefix_layers(self.qwen)
+        split_layer = frozen if split_layer is None else split_layer
+        if not 0 < split_layer <= frozen:
+            raise ValueError(f"切分层 {split_layer} 无效: 只有前 {frozen} 层 (及词嵌入) 是冻结的")
+        self.prefix_split_layer = split_layer
+        self.prefix_cache = prefix_cache
+        if prefix_cache is not None:
+            config = self.qwen.config
+            prefix_cache.bind(f"{config.name_or_path}|{config.num_hidden_layers}|{split_layer}|{self.qwen.dtype}")
+
+    def _encode_text_prefix(self, input_ids, text_valid):
+        """冻结的前 split_layer 层对文本的输出，按样本返回有效 token 的隐状态列表"""
+        with torch.no_grad():
+            # 只保留这些行实际用到的列，左右填充都按有效 token 重新编号位置
+            columns = text_valid.any(dim=0)
+            input_ids, text_valid = input_ids[:, columns], text_valid[:, columns]
+            positions = (text_valid.long().cumsum(dim=1) - 1).clamp(min=0)
+            hidden = run_decoder_layers(self.qwen, self.qwen.get_input_embeddings()(input_ids), text_valid,
+                                        positions, 0, self.prefix_split_layer)
+            return list(hidden[text_valid].split(text_valid.sum(dim=1).tolist()))
+
+    def _text_first_forward(self, soft_tokens, input_ids, text_attention_mask, keys):
+        """[文本, 软 token, 填充] 经过上层后按有效位置平均池化"""
+        text_valid = text_attention_mask.bool()
+        if self.prefix_cache is None:
+            states = self._encode_text_prefix(input_ids, text_valid)
+        else:
+            states = self.prefix_cache.gather(
+                keys, lambda rows: self._encode_text_prefix(input_ids[rows.to(input_ids.device)],
+                                                            text_valid[rows.to(input_ids.device)]),
+                soft_tokens.device)
+
+        batch_size, num_soft, hidden_size = soft_tokens.shape
+        lengths = torch.tensor([len(state) for state in states], device=soft_tokens.device)
+        totals = lengths + num_soft
+        positions = torch.arange(int(totals.max()), device=soft_tokens.device).expand(batch_size, -1)
+        valid = positions < totals[:, None]
+        text_slots = positions < lengths[:, None]
+
+        hidden = soft_tokens.new_zeros(batch_size, positions.size(1), hidden_size)
+        hidden[text_slots] = torch.cat(states).to(hidden.dtype)
+        hidden[valid & ~text_slots] = soft_tokens.reshape(-1, hidden_size)
+        hidden = run_decoder_layers(self.qwen, hidden, valid, positions, self.prefix_split_layer,
+                                    self.qwen.config.num_hidden_layers)
+        hidden = self.qwen.norm(hidden)
+        return (hidden * valid.unsqueeze(-1)).sum(dim=1) / totals[:, None].to(hidden.dtype)
+
+    def merge_lora(self):
+        """把低秩适配器合并进 Qwen 权重 (推理用，合并后不再区分适配器参数)，返回合并的层数"""
+        return merge_lora(self.qwen)
+
     def forward(self, batch_data):
         device = next(self.parameters()).device
 
-        # 1. 提取图结构特?
-        d1 = global_mean_pool(self.gcn_drug1(batch_data['graph1'].x, batch_data['graph1'].edge_index),
-                              batch_data['graph1'].batch)
-        d2 = global_mean_pool(self.gcn_drug2(batch_data['graph2'].x, batch_data['graph2'].edge_index),
-                              batch_data['graph2'].batch)
-
-        # 将图特征转为 bfloat16 以匹?Qwen 精度
-        d1 = d1.to(torch.bfloat16)
-        d2 = d2.to(torch.bfloat16)
-        
-        # 将外部特征转?bfloat16
-        t1 = batch_data['target1'].to(torch.bfloat16)
-        t2 = batch_data['target2'].to(torch.bfloat16)
-        p1 = batch_data['physchem1'].to(torch.bfloat16)
-        p2 = batch_data['physchem2'].to(torch.bfloat16)
-        ce = batch_data['cell_expr'].to(torch.bfloat16)
-
-        # 2. 构?Soft Tokens (7个连续特?
-        soft_tokens = torch.stack([
-            self.proj_gcn(d1), self.proj_gcn(d2),
-            self.proj_target(t1), self.proj_target(t2),
-            self.proj_physchem(p1), self.proj_physchem(p2),
-            self.proj_cell(ce)
-        ], dim=1)  # [Batch, 7, Hidden]
+        # 1. 提取图结构特征
+        with self._stage('gat_forward'):
+            d1 = self.encode_drugs('gcn_drug1', batch_data['graph1'], batch_data.get('drug1_smiles'))
+            d2 = self.encode_drugs('gcn_drug2', batch_data['graph2'], batch_data.get('drug2_smiles'))
+
+        with self._stage('projection'):
+            # 将图特征转为 bfloat16 以匹配 Qwen 精度
+            d1 = d1.to(torch.bfloat16)
+            d2 = d2.to(torch.bfloat16)
+
+            # 将外部特征转为 bfloat16
+            p1 = batch_data['physchem1'].to(torch.bfloat16)
+            p2 = batch_data['physchem2'].to(torch.bfloat16)
+            ce = batch_data['cell_expr'].to(torch.bfloat16)
+
+            # 2. 构造 Soft Tokens (7个连续特征)
+            soft_tokens = torch.stack([
+                self.proj_gcn(d1), self.proj_gcn(d2),
+                self.project_targets(batch_data, 'target1'), self.project_targets(batch_data, 'target2'),
+                self.proj_physchem(p1), self.proj_physchem(p2),
+                self.proj_cell(ce)
+            ], dim=1)  # [Batch, 7, Hidden]
 
         # 3. 提取文本 Token 的基础 Embedding（【关键提速点】：不跑整个模型，瞬间完成）
-        smiles_text = [f"Drug1: {s1}, Drug2: {s2}" for s1, s2 in
-                       zip(batch_data['drug1_smiles'], batch_data['drug2_smiles'])]
-        text_inputs = self.tokenizer(smiles_text, return_tensors="pt", padding=True, truncation=True,
-                                     max_length=128).to(device)
-        text_embeds = self.qwen.get_input_embeddings()(text_inputs.input_ids)
+        #    collate 阶段已用 SmilesTokenCache 预分词时直接使用，否则退回逐批分词
+        with self._stage('tokenization'):
+            if 'input_ids' in batch_data:
+                input_ids = batch_data['input_ids'].to(device)
+                text_attention_mask = batch_data['attention_mask'].to(device)
+            else:
+                smiles_text = [f"Drug1: {s1}, Drug2: {s2}" for s1, s2 in
+                               zip(batch_data['drug1_smiles'], batch_data['drug2_smiles'])]
+                text_inputs = self.tokenizer(smiles_text, return_tensors="pt", padding=True, truncation=True,
+                                             max_length=128).to(device)
+                input_ids, text_attention_mask = text_inputs.input_ids, text_inputs.attention_mask
+            if self.prefix_split_layer is None:
+                text_embeds = self.qwen.get_input_embeddings()(input_ids)
+
+        if self.prefix_split_layer is not None:
+            # 文本在前布局：冻结下层的文本隐状态取自缓存 (或现算)，只有上层在 [文本, 软 token] 上前向
+            with self._stage('qwen_forward'):
+                keys = list(zip(batch_data['drug1_smiles'], batch_data['drug2_smiles']))
+                pooled = self._text_first_forward(soft_tokens, input_ids, text_attention_mask, keys)
+            return self.classifier(pooled).to(torch.float32)
+
+        with self._stage('qwen_forward'):
+            # 4. 拼接输入 Qwen (Soft Tokens + Text Tokens)
+            full_embeds = torch.cat([soft_tokens, text_embeds], dim=1)
+
+            # 5. 生成对应的注意力掩码 Attention Mask (7个软Token都是有效的，设为1)
+            batch_size = full_embeds.shape[0]
+            soft_tokens_mask = torch.ones((batch_size, 7), dtype=torch.long, device=device)
+            full_attention_mask = torch.cat([soft_tokens_mask, text_attention_mask], dim=1)
+
+            # 6. 大模型只在这里真正前向传播一次！
+            outputs = self.qwen(inputs_embeds=full_embeds, attention_mask=full_attention_mask).last_hidden_state
+
+            # 平均池化后分类
+            return self.classifier(outputs.mean(dim=1)).to(torch.float32) # 最后转回 float32 计算 Loss
 
-        # 4. 拼接输入 Qwen (Soft Tokens + Text Tokens)
-        full_embeds = torch.cat([soft_tokens, text_embeds], dim=1)
 
-        # 5. 生成对应的注意力掩码 Attention Mask (7个软Token都是有效的，设为1)
-        batch_size = full_embeds.shape[0]
-        soft_tokens_mask = torch.ones((batch_size, 7), dtype=torch.long, device=device)
-        full_attention_mask = torch.cat([soft_tokens_mask, text_inputs.attention_mask], dim=1)
+class StudentDrugSynergyModel(DrugEncoderMixin, nn.Module):
+    """
+    不含语言模型的轻量学生模型：与教师相同的 DrugGAT 编码器和靶点/理化/细胞系投影，
+    7 个特征向量拼接后由 MLP 分类。由 distill.py 用教师 logits 蒸馏训练，用于 CPU 上的低延迟交互式打分；
+    输入 batch 与教师相同 (input_ids / SMILES 文本被忽略)，推理同样通过 predict
+    """
 
-        # 6. 大模型只在这里真正前向传播一次！
-        outputs = self.qwen(inputs_embeds=full_embeds, attention_mask=full_attention_mask).last_hidden_state
+    def __init__(self, gcn_config, num_classes=2, target_dim=560, cell_dim=1024, physchem_dim=7,
+                 hidden_size=256, dropout=0.2):
+        super().__init__()
+        self.gcn_drug1 = DrugGAT(**gcn_config)
+        self.gcn_drug2 = DrugGAT(**gcn_config)
+
+        self.unique_drug_encoding = True
+        self.cache_drug_embeddings = True
+        self._drug_embedding_cache = {}
+        self.stage_timer = None
+
+        self.proj_gcn = nn.Linear(gcn_config['out_feats'], hidden_size)
+        self.proj_target = nn.Linear(target_dim, hidden_size)
+        self.proj_physchem = nn.Linear(physchem_dim, hidden_size)
+        self.proj_cell = nn.Linear(cell_dim, hidden_size)
+
+        self.classifier = nn.Sequential(
+            nn.Linear(hidden_size * 7, hidden_size), nn.LayerNorm(hidden_size), nn.GELU(), nn.Dropout(dropout),
+            nn.Linear(hidden_size, num_classes)
+        )
+
+    def forward(self, batch_data):
+        with self._stage('gat_forward'):
+            d1 = self.encode_drugs('gcn_drug1', batch_data['graph1'], batch_data.get('drug1_smiles'))
+            d2 = self.encode_drugs('gcn_drug2', batch_data['graph2'], batch_data.get('drug2_smiles'))
 
-        # 平均池化后分?
-        return self.classifier(outputs.mean(dim=1)).to(torch.float32) # 最后转?float32 计算 Loss
\ No newline at end of file
+        with self._stage('projection'):
+            features = torch.cat([
+                self.proj_gcn(d1), self.proj_gcn(d2),
+                self.project_targets(batch_data, 'target1'), self.project_targets(batch_data, 'target2'),
+                self.proj_physchem(batch_data['physchem1'].float()), self.proj_physchem(batch_data['physchem2'].float()),
+                self.proj_cell(batch_data['cell_expr'].float())
+            ], dim=1)  # [Batch, 7 * Hidden]
+        return self.classifier(features)
@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import tempfile
+from collections import OrderedDict
+
+import torch
+
+
+def frozen_prefix_layers(qwen):
+    """从第 0 层起连续的、参数全部冻结的解码层数 (词嵌入可训练时为 0)"""
+    if any(param.requires_grad for param in qwen.get_input_embeddings().parameters()):
+        return 0
+    count = 0
+    for layer in qwen.layers:
+        if any(param.requires_grad for param in layer.parameters()):
+            break
+        count += 1
+    return count
+
+
+def run_decoder_layers(qwen, hidden, key_valid, position_ids, start, end):
+    """
+    在 qwen.layers[start:end] 上前向 hidden：因果注意力并屏蔽 key_valid 为 False 的填充位置，位置编号显式给出，
+    同一样本的有效 token 的输出不受 batch 中其他样本及填充长度的影响
+    :param key_valid: BoolTensor [B, L]
+    :param position_ids: LongTensor [B, L]
+    """
+    seq_len = hidden.size(1)
+    causal = torch.ones(seq_len, seq_len, dtype=torch.bool, device=hidden.device).tril()
+    allowed = causal & key_valid[:, None, :]
+    # 加性掩码用 dtype 的最小值而不是 -inf：左填充时填充 query 行没有可见的 key，也不会产生 NaN
+    mask = torch.zeros(allowed.shape, dtype=hidden.dtype, device=hidden.device)
+    mask = mask.masked_fill_(~allowed, torch.finfo(hidden.dtype).min).unsqueeze(1)
+    position_embeddings = qwen.rotary_emb(hidden, position_ids)
+    for layer in qwen.layers[start:end]:
+        hidden = layer(hidden, attention_mask=mask, position_embeddings=position_embeddings,
+                       position_ids=position_ids)
+    return hidden
+
+
+class PrefixStateCache:
+    """
+    文本前缀隐状态缓存：键为 (drug1_smiles, drug2_smiles)，值为该药物对的文本 token 经过冻结的前 split_layer 层后的
+    隐状态 [文本长度, hidden] (CPU)。内存中按字节数上限做 LRU 淘汰；提供 cache_dir 时每个条目同时落盘，
+    淘汰后或下次运行可直接从磁盘读回。
+    只能按药物对缓存：因果注意力下 drug2 部分的 token 会看到 drug1 的 SMILES
+    """
+
+    def __init__(self, max_bytes=2 * 2 ** 30, cache_dir=None):
+        """
+        :param max_bytes: 内存中缓存的隐状态总字节数上限
+        :param cache_dir: 磁盘缓存目录，按模型与切分层分子目录存放 (None 时只用内存)
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.namespace = None
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def bind(self, namespace):
+        """由模型在启用时调用：不同的基座 / 切分层 / 精度使用不同的磁盘子目录，并清空内存中的条目"""
+        self.namespace = hashlib.sha1(namespace.encode('utf-8')).hexdigest()[:16]
+        self.clear()
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _path(self, key):
+        digest = hashlib.sha1('\x00'.join(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, self.namespace, digest[:2], f'{digest}.pt')
+
+    def _remember(self, key, state):
+        self._entries[key] = state
+        self._bytes += state.numel() * state.element_size()
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.numel() * evicted.element_size()
+
+    def evict(self, key):
+        """
+        从内存中移除一个条目 (磁盘上的文件保留)
+        :return: 条目是否存在
+        """
+        state = self._entries.pop(key, None)
+        if state is None:
+            return False
+        self._bytes -= state.numel() * state.element_size()
+        return True
+
+    def get(self, key):
+        state = self._entries.get(key)
+        if state is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return state
+        if self.cache_dir is not None:
+            path = self._path(key)
+            if os.path.exists(path):
+                state = torch.load(path, map_location='cpu', weights_only=True)
+                self._remember(key, state)
+                self.disk_hits += 1
+                return state
+        self.misses += 1
+        return None
+
+    def put(self, key, state):
+        state = state.detach().to('cpu', copy=True)
+        if key not in self._entries:
+            self._remember(key, state)
+        if self.cache_dir is not None:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再原子替换，多个 rank 共用目录时不会读到写了一半的文件
+            tmp_path = f"{path}.tmp{os.getpid()}"
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+
+    def gather(self, keys, compute, device):
+        """
+        :param compute: fn(rows) -> 对 batch 中这些行 (LongTensor) 重新计算的隐状态列表
+        :return: 与 keys 同序的隐状态列表 (已移到 device)
+        """
+        states = [self.get(key) for key in keys]
+        missing = [i for i, state in enumerate(states) if state is None]
+        if missing:
+            for i, state in zip(missing, compute(torch.tensor(missing, dtype=torch.long))):
+                self.put(keys[i], state)
+                states[i] = state
+        return [state.to(device, non_blocking=True) for state in states]
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'memory_mb': self._bytes / 2 ** 20,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0
+        }
+
+
+# 一致性检查中 logits 最大绝对误差的上限 (bf16 基座)
+CHECK_TOLERANCE = 1e-2
+
+
+@torch.no_grad()
+def check_prefix_cache(model, batch):
+    """
+    一致性检查：同一个 batch 分别走不使用缓存的文本在前布局 (对照)、缓存全部未命中、一半命中
+    (未命中的行单独成批重算，填充长度不同)、全部命中四条路径，返回后三者相对对照的 logits 最大绝对误差。
+    模型需已 enable_text_first 并设置了 prefix_cache；检查期间只使用内存缓存。
+    python prefix_cache.py --check 在随机初始化的小型 Qwen2 上运行本检查
+    """
+    cache = model.prefix_cache
+    cache_dir, was_training = cache.cache_dir, model.training
+    model.eval()
+    report = {}
+    try:
+        model.prefix_cache = None
+        reference = model(batch).float()
+        model.prefix_cache, cache.cache_dir = cache, None
+        cache.clear()
+        report['miss_max_abs_diff'] = (model(batch).float() - reference).abs().max().item()
+        for key in list(cache._entries)[::2]:
+            cache.evict(key)
+        report['partial_max_abs_diff'] = (model(batch).float() - reference).abs().max().item()
+        report['hit_max_abs_diff'] = (model(batch).float() - reference).abs().max().item()
+    finally:
+        # 检查期间的条目没有落盘，清空后正常训练时重新计算
+        cache.clear()
+        model.prefix_cache, cache.cache_dir = cache, cache_dir
+        model.train(was_training)
+    return report
+
+
+def check_with_tiny_model(batch_size=8, seed=0):
+    """
+    在临时目录中生成随机初始化的小型 Qwen2 (4 层，最后 2 层加 LoRA)，用随机的分子图与特征构造一个 batch，
+    运行 check_prefix_cache；不依赖数据文件与预训练权重
+    """
+    from torch_geometric.data import Data, Batch
+    from model import QwenEnhancedDrugSynergyModel
+    from utils import build_tiny_qwen
+
+    torch.manual_seed(seed)
+    smiles = ['CCO', 'CC(=O)O', 'c1ccccc1', 'CCN(CC)CC', 'O=C(O)c1ccccc1O', 'C[N+](C)(C)C', 'CC#N', 'OCC(O)CO']
+    with tempfile.TemporaryDirectory() as model_dir:
+        build_tiny_qwen(model_dir, smiles * 4, vocab_size=300, hidden_size=32, num_layers=4, num_heads=4)
+        model = QwenEnhancedDrugSynergyModel(gcn_config={'in_feats': 64, 'hidden_size': 8, 'out_feats': 16},
+                                             qwen_model_name=model_dir, target_dim=32, cell_dim=16, physchem_dim=7,
+                                             lora_config={'rank': 4, 'alpha': 8, 'last_layers': 2})
+    model.enable_text_first(prefix_cache=PrefixStateCache(max_bytes=64 * 2 ** 20))
+
+    def graphs(names):
+        data = []
+        for name in names:
+            num_atoms = len(name)
+            chain = torch.arange(num_atoms - 1)
+            edge_index = torch.cat([torch.stack([chain, chain + 1]), torch.stack([chain + 1, chain])], dim=1)
+            data.append(Data(x=torch.randn(num_atoms, 64), edge_index=edge_index))
+        return Batch.from_data_list(data)
+
+    # 长短不一的 SMILES 组合，使 batch 内有不同的填充长度
+    drug1 = [smiles[i % len(smiles)] for i in range(batch_size)]
+    drug2 = [smiles[(3 * i + 1) % len(smiles)] for i in range(batch_size)]
+    batch = {
+        'graph1': graphs(drug1), 'graph2': graphs(drug2),
+        'target1': torch.rand(batch_size, 32), 'target2': torch.rand(batch_size, 32),
+        'physchem1': torch.randn(batch_size, 7), 'physchem2': torch.randn(batch_size, 7),
+        'cell_expr': torch.randn(batch_size, 16),
+        'drug1_smiles': drug1, 'drug2_smiles': drug2
+    }
+    report = check_prefix_cache(model, batch)
+    report['split_layer'] = model.prefix_split_layer
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="冻结前缀隐状态缓存的一致性检查")
+    parser.add_argument('--check', action='store_true', help="在随机初始化的小型 Qwen2 上比较缓存与不缓存的 logits")
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--tolerance', type=float, default=CHECK_TOLERANCE, help="logits 最大绝对误差上限")
+    args = parser.parse_args()
+    if not args.check:
+        parser.print_help()
+        return
+
+    report = check_with_tiny_model(batch_size=args.batch_size)
+    print(json.dumps(report, indent=2))
+    failed = [name for name, value in report.items() if name.endswith('_max_abs_diff') and value > args.tolerance]
+    if failed:
+        print(f"一致性检查失败: {failed} 超过 {args.tolerance}")
+        sys.exit(1)
+    print("一致性检查通过")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import os
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+import torch
+
+logger = logging.getLogger(__name__)
+
+PROPAGATION_METHODS = ('rwr', 'heat')
+
+
+def load_target_network(network_file, target_names):
+    """
+    读取靶点-靶点相互作用网络 (Target_realation.csv，制表符分隔: #node1, node2, combined_score)，
+    只保留两端都在靶点列中的边，构建按行归一化的转移矩阵 P = D^-1 A (稀疏 COO，[T, T])。
+    网络中没有边的靶点加自环，传播时保持原值。
+    """
+    df = pd.read_csv(network_file, sep='\t')
+    df.columns = [c.lstrip('#') for c in df.columns]
+    target_to_idx = {str(name): i for i, name in enumerate(target_names)}
+    src = df['node1'].astype(str).map(target_to_idx)
+    dst = df['node2'].astype(str).map(target_to_idx)
+    keep = src.notna() & dst.notna() & (src != dst)
+    logger.info(f"靶点网络: {int(keep.sum())}/{len(df)} 条边落在 {len(target_names)} 个靶点列内")
+
+    src = torch.tensor(src[keep].to_numpy(dtype=np.int64))
+    dst = torch.tensor(dst[keep].to_numpy(dtype=np.int64))
+    score = torch.tensor(df.loc[keep, 'combined_score'].to_numpy(dtype=np.float32))
+
+    # 无向图：两个方向都加入，重复边的权重累加
+    num_targets = len(target_names)
+    rows, cols, weights = torch.cat([src, dst]), torch.cat([dst, src]), torch.cat([score, score])
+    degree = torch.zeros(num_targets).index_add_(0, rows, weights)
+    isolated = torch.nonzero(degree == 0).flatten()
+    rows, cols = torch.cat([rows, isolated]), torch.cat([cols, isolated])
+    weights = torch.cat([weights, torch.ones(len(isolated))])
+    degree[isolated] = 1.0
+
+    return torch.sparse_coo_tensor(torch.stack([rows, cols]), weights / degree[rows],
+                                   (num_targets, num_targets), check_invariants=True).coalesce()
+
+
+def propagate(profiles, transition, method='rwr', restart_prob=0.5, diffusion_time=1.0, tol=1e-6, max_iter=100):
+    """
+    对所有药物的靶点谱一次性批量传播 (行向量右乘转移矩阵，各行总量保持不变)
+    rwr:  F = r F0 + (1 - r) F P，迭代到收敛
+    heat: F = F0 exp(-t (I - P)) = e^-t * sum_k t^k / k! F0 P^k，按泰勒级数累加到收敛
+    :param profiles: [药物数, T] 的初始靶点矩阵
+    :param transition: load_target_network 返回的 [T, T] 稀疏矩阵
+    """
+    if method not in PROPAGATION_METHODS:
+        raise ValueError(f"不支持的传播方式: {method}")
+    # F P = (P^T F^T)^T，稀疏矩阵放在左侧
+    transition_t = transition.t().coalesce()
+    step = lambda f: torch.sparse.mm(transition_t, f.t()).t()
+
+    f0 = profiles.float()
+    if method == 'rwr':
+        f = f0
+        for i in range(max_iter):
+            f_next = restart_prob * f0 + (1 - restart_prob) * step(f)
+            delta = (f_next - f).abs().max().item()
+            f = f_next
+            if delta < tol:
+                break
+        iterations = i + 1
+    else:
+        term = f0
+        f = f0.clone()
+        for i in range(1, max_iter + 1):
+            term = step(term) * (diffusion_time / i)
+            f += term
+            if term.abs().max().item() < tol:
+                break
+        f *= np.exp(-diffusion_time)
+        iterations = i
+    logger.info(f"靶点网络传播 ({method}) {iterations} 次迭代后收敛")
+    return f
+
+
+def propagated_target_profiles(profiles, target_names, network_file, method='rwr', restart_prob=0.5,
+                               diffusion_time=1.0, min_value=1e-3, cache_dir='cache'):
+    """
+    网络传播后的靶点谱，按 (网络文件内容, 初始靶点矩阵, 传播参数) 的哈希缓存到磁盘
+    :param min_value: 小于该值的传播结果置 0，保持矩阵稀疏 (稀疏靶点编码下每个样本的开销仍与非零数成正比)
+    """
+    digest = hashlib.sha1()
+    with open(network_file, 'rb') as f:
+        digest.update(f.read())
+    digest.update('\x00'.join(map(str, target_names)).encode('utf-8'))
+    digest.update(np.ascontiguousarray(profiles.numpy()).tobytes())
+    digest.update(f"{method}|{restart_prob}|{diffusion_time}|{min_value}".encode('utf-8'))
+    cache_path = os.path.join(cache_dir, f"target_propagation_{digest.hexdigest()[:16]}.npy") if cache_dir else None
+
+    if cache_path is not None and os.path.exists(cache_path):
+        logger.info(f"使用缓存的靶点传播结果: {cache_path}")
+        return torch.from_numpy(np.load(cache_path))
+
+    transition = load_target_network(network_file, target_names)
+    result = propagate(profiles, transition, method, restart_prob, diffusion_time)
+    result[result < min_value] = 0.0
+    logger.info(f"传播后靶点非零数: {int((profiles != 0).sum())} -> {int((result != 0).sum())}")
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.tmp{os.getpid()}.npy"
+        np.save(tmp_path, result.numpy())
+        os.replace(tmp_path, cache_path)
+    return result
@@ -0,0 +1,138 @@
+import numpy as np
+import torch
+from torch.utils.data import Subset
+
+
+def _resolve_subset(dataset):
+    """把 (可能嵌套的) random_split Subset 还原为底层数据集 + 行号"""
+    indices = np.arange(len(dataset))
+    while isinstance(dataset, Subset):
+        indices = np.asarray(dataset.indices)[indices]
+        dataset = dataset.dataset
+    return dataset, indices
+
+
+def compute_pair_lengths(dataset, processor, token_cache):
+    """
+    计算每个样本的 (文本 token 长度, 两个分子的总原子数)，与数据集 (或其 Subset) 的下标一一对应。
+    原子数按药物 ID、token 长度按去重后的药物对只计算一次 (分词结果同时写入 token_cache)，再向量化拼到每一行。
+    """
+    base, indices = _resolve_subset(dataset)
+    if not getattr(base, 'use_feature_store', False):
+        raise ValueError("长度分桶需要 DrugCellDataProcessor(use_feature_store=True)")
+
+    drug_atoms = np.array([processor.smiles_to_graph(s)[1].shape[0] for s in processor.drug_smiles_by_id],
+                          dtype=np.int64)
+
+    ids = base.sample_ids.numpy()[indices]
+    pairs, inverse = np.unique(ids[:, :2], axis=0, return_inverse=True)
+    smiles = processor.drug_smiles_by_id
+    pair_tokens = np.array([len(seq) for seq in token_cache.encode([smiles[i] for i in pairs[:, 0]],
+                                                                   [smiles[i] for i in pairs[:, 1]])],
+                           dtype=np.int64)
+    token_lengths = pair_tokens[inverse.reshape(-1)]
+    atom_counts = drug_atoms[ids[:, 0]] + drug_atoms[ids[:, 1]]
+    return token_lengths, atom_counts
+
+
+class LengthBucketBatchSampler(torch.utils.data.Sampler):
+    """
+    长度分桶的 batch 采样器：每个 epoch 先随机打乱，再在大小为 batch_size * bucket_multiplier 的桶内
+    按 (token 长度, 原子数) 排序切成 batch，最后打乱 batch 顺序。
+    token_budget 不为 None 时按 "batch 内最长序列 × batch 大小 <= token_budget" 动态决定 batch 大小，
+    使每个 batch 的填充后 token 总数基本恒定。
+    num_replicas > 1 时为分布式采样：各 rank 用相同种子生成同一份 batch 列表，再按 rank 交错取各自的分片。
+    """
+
+    def __init__(self, token_lengths, atom_counts=None, batch_size=32, bucket_multiplier=50, token_budget=None,
+                 shuffle=True, drop_last=False, seed=42, num_replicas=1, rank=0, even_shards=True):
+        """
+        :param even_shards: 分布式时截掉多余的 batch，使每个 rank 的步数相同 (DDP 训练必需)；
+                            评估时设为 False，保证每个样本恰好被评估一次
+        """
+        self.token_lengths = np.asarray(token_lengths, dtype=np.int64)
+        self.atom_counts = np.zeros_like(self.token_lengths) if atom_counts is None else np.asarray(atom_counts)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_multiplier
+        self.token_budget = token_budget
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.even_shards = even_shards
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = None
+
+    def _split_bucket(self, bucket):
+        if self.token_budget is None:
+            batches = [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+        else:
+            batches, start = [], 0
+            lengths = self.token_lengths[bucket]
+            for end in range(1, len(bucket) + 1):
+                # 桶内已升序，当前样本即为 batch 内最长
+                if (end - start) * lengths[end - 1] > self.token_budget and end - 1 > start:
+                    batches.append(bucket[start:end - 1])
+                    start = end - 1
+            batches.append(bucket[start:])
+        if self.drop_last and len(batches[-1]) < self.batch_size and self.token_budget is None:
+            batches = batches[:-1]
+        return batches
+
+    def _make_batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = rng.permutation(len(self.token_lengths)) if self.shuffle else np.arange(len(self.token_lengths))
+
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            # lexsort 以最后一个键为主键：先按 token 长度，再按原子数
+            bucket = bucket[np.lexsort((self.atom_counts[bucket], self.token_lengths[bucket]))]
+            batches.extend(b for b in self._split_bucket(bucket) if len(b))
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1:
+            if self.even_shards:
+                batches = batches[:len(batches) // self.num_replicas * self.num_replicas]
+            batches = batches[self.rank::self.num_replicas]
+        return [b.tolist() for b in batches]
+
+    def __iter__(self):
+        if self._batches is None:
+            self._batches = self._make_batches()
+        batches, self._batches = self._batches, None
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        if self._batches is None:
+            self._batches = self._make_batches()
+        return len(self._batches)
+
+
+def padding_fraction(batches, token_lengths):
+    """填充 token 占比 = 1 - 真实 token 数 / (每个 batch 最长长度 × batch 大小 之和)"""
+    token_lengths = np.asarray(token_lengths)
+    real = padded = 0
+    for batch in batches:
+        lengths = token_lengths[np.asarray(batch)]
+        real += lengths.sum()
+        padded += lengths.max() * len(lengths)
+    return 1.0 - real / max(padded, 1)
+
+
+def report_padding(token_lengths, batch_sampler, batch_size=32, seed=42):
+    """对比随机 batch 与分桶 batch 的填充比例"""
+    order = np.random.default_rng(seed).permutation(len(token_lengths))
+    random_batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    before = padding_fraction(random_batches, token_lengths)
+    # 直接调用 _make_batches，不推进采样器的 epoch
+    after = padding_fraction(batch_sampler._make_batches(), token_lengths)
+    print(f"填充比例: 随机 batch {before:.1%} -> 长度分桶 {after:.1%}")
+    return {'random': before, 'bucketed': after}
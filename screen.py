@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+高通量组合筛选：对全部药物对 × 全部细胞系做批量推理，流式写出分片结果，
+并为每个细胞系维护有界的 Top-K 排名，中断后可从最后完成的分片继续。
+
+用法:
+    python screen.py --weights model_weights.pt --out-dir screen_results --canonical --top-k 100
+"""
+import os
+import json
+import heapq
+import hashlib
+import argparse
+import itertools
+
+import numpy as np
+import pandas as pd
+import torch
+from torch_geometric.data import Data, Batch
+from tqdm import tqdm
+
+from graph_store import gather_graphs
+
+STATE_FILE = 'state.json'
+
+
+def iter_drug_pairs(drug_ids, canonical=False):
+    """惰性生成药物对；canonical=True 时把 (A, B) 与 (B, A) 视为同一对，只保留一次"""
+    if canonical:
+        return itertools.combinations(drug_ids, 2)
+    return itertools.permutations(drug_ids, 2)
+
+
+def count_drug_pairs(n_drugs, canonical=False):
+    return n_drugs * (n_drugs - 1) // (2 if canonical else 1)
+
+
+@torch.no_grad()
+def warm_drug_embeddings(model, processor, drug_ids, device, batch_size=256):
+    """预先把所有待筛选药物的 GAT 池化嵌入写入模型缓存，之后的批次无需再构建分子图"""
+    for start in range(0, len(drug_ids), batch_size):
+        chunk = drug_ids[start:start + batch_size]
+        smiles = [processor.drug_smiles_by_id[i] for i in chunk]
+        graphs = []
+        for s in smiles:
+            edge_index, x = processor.smiles_to_graph(s)
+            graphs.append(Data(x=x, edge_index=edge_index))
+        graph = Batch.from_data_list(graphs).to(device)
+        model.encode_drugs('gcn_drug1', graph, smiles)
+        model.encode_drugs('gcn_drug2', graph, smiles)
+
+
+def build_screen_batch(processor, ids, token_cache=None, graphs=None):
+    """
+    由 [B, 3] 的 (drug1_id, drug2_id, cell_id) 直接按索引 gather 特征，构建模型输入；
+    默认分子图由模型内的药物嵌入缓存提供，因此这里不组装 graph
+    :param graphs: processor.packed_drug_graphs() 的结果，提供时按药物 ID 拼出批量图 (药物未预热到缓存时需要)
+    """
+    drug1, drug2, cell = ids[:, 0], ids[:, 1], ids[:, 2]
+    smiles1 = [processor.drug_smiles_by_id[i] for i in drug1.tolist()]
+    smiles2 = [processor.drug_smiles_by_id[i] for i in drug2.tolist()]
+    if graphs is not None:
+        drug_slots, graph_arrays = graphs
+        graph1, graph2 = gather_graphs(graph_arrays, drug_slots[drug1]), gather_graphs(graph_arrays, drug_slots[drug2])
+    else:
+        graph1 = graph2 = None
+    batch = {
+        'graph1': graph1,
+        'graph2': graph2,
+        'physchem1': processor.physchem_tensor[drug1],
+        'physchem2': processor.physchem_tensor[drug2],
+        'cell_expr': processor.cell_tensor[cell],
+        'drug1_smiles': smiles1,
+        'drug2_smiles': smiles2
+    }
+    for name, drug_ids in (('target1', drug1), ('target2', drug2)):
+        if getattr(processor, 'sparse_targets', False):
+            batch[f'{name}_indices'], batch[f'{name}_offsets'], batch[f'{name}_weights'] = \
+                processor.target_bags(drug_ids)
+        else:
+            batch[name] = processor.target_tensor[drug_ids]
+    if token_cache is not None:
+        batch['input_ids'], batch['attention_mask'] = token_cache.encode_pairs(smiles1, smiles2, remember=False)
+    return batch
+
+
+@torch.no_grad()
+def predict_pairs(model, processor, queries, device, token_cache=None, graphs=None):
+    """
+    交互式打分：教师 (QwenEnhancedDrugSynergyModel) 与学生 (StudentDrugSynergyModel) 使用同一接口
+    :param queries: [(drug1, drug2, cell_line), ...]，均为名称
+    :param token_cache: 教师模型的预分词缓存 (学生模型不需要)
+    :param graphs: processor.packed_drug_graphs() 的结果，多次调用时预先计算一次传入
+    :return: np.ndarray，每个查询的协同概率
+    """
+    if graphs is None:
+        graphs = processor.packed_drug_graphs()
+    ids = torch.tensor([[processor.get_drug_id(d1), processor.get_drug_id(d2), processor.get_cell_id(c)]
+                        for d1, d2, c in queries], dtype=torch.long).reshape(-1, 3)
+    batch = build_screen_batch(processor, ids, token_cache, graphs)
+    batch = {k: v.to(device) if hasattr(v, 'to') else v for k, v in batch.items()}
+    return model.predict(batch).cpu().numpy()
+
+
+def _load_state(out_dir):
+    path = os.path.join(out_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _file_signature(path):
+    """权重文件的 (绝对路径, 修改时间, 大小)，用于判断断点续跑时是否换了权重"""
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+
+
+def _ids_digest(drug_names, drug_ids, cell_lines, cell_ids):
+    """参与筛选的药物 / 细胞系 (名称与 ID，有序) 的摘要：分片按该顺序枚举药物对"""
+    digest = hashlib.sha1('\n'.join(map(str, drug_names)).encode('utf-8'))
+    digest.update('\n'.join(map(str, cell_lines)).encode('utf-8'))
+    digest.update(np.asarray(drug_ids, dtype=np.int64).tobytes())
+    digest.update(np.asarray(cell_ids, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
+def _atomic_write_json(path, obj):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+@torch.no_grad()
+def screen(model, processor, out_dir, device, token_cache=None, drug_names=None, cell_lines=None,
+           canonical=False, batch_size=512, pairs_per_shard=10000, top_k=100, weights=None):
+    """
+    对 药物对 × 细胞系 全组合打分
+    :param model: 已加载权重的 QwenEnhancedDrugSynergyModel (或蒸馏得到的 StudentDrugSynergyModel)
+    :param processor: 开启 use_feature_store 的 DrugCellDataProcessor
+    :param drug_names: 参与筛选的药物，默认为全部有 SMILES 的药物
+    :param cell_lines: 参与筛选的细胞系，默认为全部细胞系
+    :param canonical: 是否把对称药物对只计算一次
+    :param pairs_per_shard: 每个输出分片包含的药物对数 (每对覆盖全部细胞系)
+    :param top_k: 每个细胞系保留的最高协同概率条目数
+    :param weights: 模型权重文件路径，其路径、修改时间与大小记入断点续跑的配置 (换了权重时不会续跑)
+    :return: {cell_line: [(prob, drug1, drug2), ...]} 按概率降序
+    """
+    if not getattr(processor, 'use_feature_store', False):
+        raise ValueError("筛选需要 DrugCellDataProcessor(use_feature_store=True)")
+
+    os.makedirs(out_dir, exist_ok=True)
+    if drug_names is None:
+        drug_names = sorted(processor.drug_smiles_map)
+    if cell_lines is None:
+        cell_lines = processor.cell_names[1:]
+    drug_ids = [processor.get_drug_id(d) for d in drug_names]
+    cell_ids = np.array([processor.get_cell_id(c) for c in cell_lines], dtype=np.int64)
+
+    config = {'drugs': len(drug_ids), 'cell_lines': len(cell_ids), 'ids': _ids_digest(drug_names, drug_ids, cell_lines, cell_ids),
+              'weights': _file_signature(weights), 'features': processor.feature_key(), 'canonical': canonical,
+              'pairs_per_shard': pairs_per_shard, 'top_k': top_k}
+    n_pairs = count_drug_pairs(len(drug_ids), canonical)
+    n_shards = -(-n_pairs // pairs_per_shard)
+
+    # 断点续跑：配置一致时从最后完成的分片之后继续，并恢复各细胞系的 Top-K 堆
+    state = _load_state(out_dir)
+    if state is not None and state['config'] == config:
+        completed = state['completed_shards']
+        heaps = {c: [tuple(item) for item in items] for c, items in state['heaps'].items()}
+        print(f"从分片 {completed}/{n_shards} 继续筛选")
+    else:
+        completed, heaps = 0, {}
+    heaps = {c: heaps.get(c, []) for c in cell_lines}
+
+    model.eval()
+    model.unique_drug_encoding = True
+    model.cache_drug_embeddings = True
+    warm_drug_embeddings(model, processor, drug_ids, device)
+
+    pair_iter = itertools.islice(iter_drug_pairs(drug_ids, canonical), completed * pairs_per_shard, None)
+    n_cells = len(cell_ids)
+    for shard in tqdm(range(completed, n_shards), desc="Screening", initial=completed, total=n_shards):
+        pairs = np.array(list(itertools.islice(pair_iter, pairs_per_shard)), dtype=np.int64).reshape(-1, 2)
+        # 每个药物对展开到全部细胞系：同一对药物在相邻行，GAT 嵌入直接命中缓存
+        ids = torch.from_numpy(np.column_stack([
+            np.repeat(pairs, n_cells, axis=0),
+            np.tile(cell_ids, len(pairs))
+        ]))
+
+        probs = []
+        for start in range(0, len(ids), batch_size):
+            batch = build_screen_batch(processor, ids[start:start + batch_size], token_cache)
+            batch = {k: v.to(device) if hasattr(v, 'to') else v for k, v in batch.items()}
+            probs.append(model.predict(batch))
+        probs = torch.cat(probs).cpu().numpy()
+
+        result = pd.DataFrame({
+            'Drug1': [processor.drug_names[i] for i in ids[:, 0].tolist()],
+            'Drug2': [processor.drug_names[i] for i in ids[:, 1].tolist()],
+            'Cell_line': np.tile(np.asarray(cell_lines, dtype=object), len(pairs)),
+            'synergy_prob': probs
+        })
+        shard_path = os.path.join(out_dir, f"shard_{shard:05d}.csv")
+        result.to_csv(f"{shard_path}.tmp", index=False)
+        os.replace(f"{shard_path}.tmp", shard_path)
+
+        # 每个细胞系先取分片内的 Top-K，再并入有界堆
+        for cell, group in result.groupby('Cell_line', sort=False):
+            heap = heaps[cell]
+            for row in group.nlargest(top_k, 'synergy_prob').itertuples(index=False):
+                item = (float(row.synergy_prob), row.Drug1, row.Drug2)
+                if len(heap) < top_k:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+
+        _atomic_write_json(os.path.join(out_dir, STATE_FILE),
+                           {'config': config, 'completed_shards': shard + 1, 'heaps': heaps})
+
+    ranking = {cell: sorted(heap, reverse=True) for cell, heap in heaps.items()}
+    top_rows = [
+        {'Cell_line': cell, 'rank': rank, 'Drug1': d1, 'Drug2': d2, 'synergy_prob': prob}
+        for cell, items in ranking.items()
+        for rank, (prob, d1, d2) in enumerate(items, start=1)
+    ]
+    pd.DataFrame(top_rows).to_csv(os.path.join(out_dir, 'topk.csv'), index=False)
+    print(f"筛选完成: {n_pairs} 个药物对 × {n_cells} 个细胞系，Top-{top_k} 结果已写入 {out_dir}/topk.csv")
+    return ranking
+
+
+def main():
+    from main import QWEN_MODEL_NAME, GCN_CONFIG, LORA_CONFIG, BUNDLE_PATH, GRAPH_CACHE_PATH, build_processor
+    from model import QwenEnhancedDrugSynergyModel
+    from checkpoint import load_model_weights
+    from utils import SmilesTokenCache
+
+    parser = argparse.ArgumentParser(description="药物对 × 细胞系 全组合协同筛选")
+    parser.add_argument('--weights', help="模型权重 (state_dict / checkpoint 文件或目录)")
+    parser.add_argument('--student', help="distill.py 保存的学生模型，提供时不加载 Qwen")
+    parser.add_argument('--out-dir', default='screen_results')
+    parser.add_argument('--qwen-model', default=QWEN_MODEL_NAME)
+    parser.add_argument('--lora-config', type=json.loads, default=LORA_CONFIG,
+                        help="训练时的 LoRA 配置 (JSON)，全秩微调的权重传 null")
+    parser.add_argument('--bundle', default=BUNDLE_PATH)
+    parser.add_argument('--graph-cache', default=GRAPH_CACHE_PATH)
+    parser.add_argument('--canonical', action='store_true', help="对称药物对只计算一次")
+    parser.add_argument('--batch-size', type=int, default=512)
+    parser.add_argument('--pairs-per-shard', type=int, default=10000)
+    parser.add_argument('--top-k', type=int, default=100)
+    args = parser.parse_args()
+    if not args.weights and not args.student:
+        parser.error("需要 --weights 或 --student")
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # 与训练时相同的特征 (数据包 + 稀疏靶点谱，按 main.TARGET_PROPAGATION 传播)，教师与学生共用
+    processor = build_processor(args.bundle, args.graph_cache)
+    if args.student:
+        from distill import load_student
+        model, token_cache = load_student(args.student, processor=processor).to(device), None
+        weights_path = args.student
+    else:
+        token_cache = SmilesTokenCache.from_pretrained(args.qwen_model)
+
+        model = QwenEnhancedDrugSynergyModel(
+            gcn_config=GCN_CONFIG,
+            qwen_model_name=args.qwen_model,
+            target_dim=processor.target_dim,
+            cell_dim=processor.cell_dim,
+            physchem_dim=processor.physchem_dim,
+            lora_config=args.lora_config
+        )
+        weights_path = load_model_weights(model, args.weights)
+        # 适配器合并进基座权重，打分时没有额外的低秩分支
+        model.merge_lora()
+        model.to(device)
+
+    screen(model, processor, args.out_dir, device, token_cache=token_cache, canonical=args.canonical,
+           batch_size=args.batch_size, pairs_per_shard=args.pairs_per_shard, top_k=args.top_k, weights=weights_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+import pytest
+import torch
+
+from prefix_cache import CHECK_TOLERANCE, PrefixStateCache, check_with_tiny_model
+
+
+def test_evict_updates_memory_usage():
+    cache = PrefixStateCache()
+    cache.put(('CCO', 'CC#N'), torch.zeros(3, 4))
+    cache.put(('CC#N', 'CCO'), torch.zeros(5, 4))
+    assert cache.evict(('CCO', 'CC#N'))
+    assert not cache.evict(('CCO', 'CC#N'))
+    assert len(cache) == 1
+    assert cache.stats()['memory_mb'] == 5 * 4 * 4 / 2 ** 20
+
+
+@pytest.mark.parametrize('batch_size', [1, 8])
+def test_prefix_cache_matches_uncached_logits(batch_size):
+    report = check_with_tiny_model(batch_size=batch_size)
+    diffs = {name: value for name, value in report.items() if name.endswith('_max_abs_diff')}
+    assert set(diffs) == {'miss_max_abs_diff', 'partial_max_abs_diff', 'hit_max_abs_diff'}
+    for name, value in diffs.items():
+        assert value <= CHECK_TOLERANCE, f"{name} = {value}"
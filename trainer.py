@@ -1,20 +1,48 @@
 import torch
 import numpy as np
 import time
+import contextlib
 from tqdm import tqdm
 import torch.nn.functional as F
-from sklearn.metrics import (
-    accuracy_score, f1_score, precision_score, recall_score,
-    roc_auc_score, average_precision_score, matthews_corrcoef, cohen_kappa_score
-)
+from torch.nn.parallel import DistributedDataParallel
 
 from model import FocalLoss
-# 引入你在 utils.py 中写好的保存 Excel 的函?
-from utils import save_metrics_to_excel
+from lora import parameter_summary
+from metrics import StreamingBinaryMetrics, MetricsLog, new_run_id
+from distributed import is_distributed, get_world_size, is_main_process, all_reduce_sum
+from instrumentation import StepTimer
+from checkpoint import AsyncCheckpointer, build_checkpoint, load_checkpoint, resolve_checkpoint
+
+
+# 模型内部投影层与 Qwen 均为 bfloat16，autocast 只提供 bf16 (fp16 与 bf16 权重混用会在 LayerNorm 等处报错)
+AUTOCAST_DTYPES = {'bf16': torch.bfloat16}
 
 
 class ImprovedDrugSynergyTrainer:
-    def __init__(self, model, train_loader, val_loader, test_loader, device):
+    def __init__(self, model, train_loader, val_loader, test_loader, device,
+                 precision='fp32', accumulation_steps=1, compile_modules=False, log_every=50,
+                 instrument=False, instrument_log='step_timing.jsonl', profile_steps=None,
+                 profile_dir='profiler_traces', checkpoint_dir=None, resume_from=None, keep_checkpoints=2,
+                 metrics_log='training_metrics.jsonl', run_id=None, lora_lr=2e-4):
+        """
+        :param precision: 'fp32' 或 'bf16'，后者在 autocast 下运行前向，GAT 等 fp32 子模块的矩阵乘法也走 bf16
+        :param accumulation_steps: 梯度累积步数，等效 batch = batch_size * accumulation_steps
+        :param compile_modules: 是否用 torch.compile 编译 GAT 与投影/分类头子模块
+        :param log_every: 每隔多少步才把 loss 同步到 CPU 刷新进度条，避免每步 loss.item() 触发设备同步
+        :param instrument: 是否开启训练步分阶段计时 (数据等待/拷贝/GAT/分词/Qwen/反向/优化器)
+        :param instrument_log: 分阶段计时记录的 JSONL 路径
+        :param profile_steps: (起始步, 结束步)，开启 instrument 时在该窗口抓取 torch.profiler trace
+        :param checkpoint_dir: 每个 epoch 结束后把可训练参数 + 优化器/调度器/随机数状态异步保存到该目录
+        :param resume_from: checkpoint 文件或目录 (取最新)，在预训练基座上加载增量后从下一个 epoch 继续
+        :param keep_checkpoints: 目录中保留的最近 checkpoint 数
+        :param metrics_log: 只追加的 JSONL 指标日志，每次评估后立即写入 (用 python metrics.py export 生成 Excel)
+        :param run_id: 本次训练的标识，默认自动生成；从 checkpoint 恢复时沿用原 run_id
+        :param lora_lr: 模型以 lora_config 构建时低秩适配器参数的学习率 (适配器从零增量开始，需比全秩微调大得多)
+
+        通过 torchrun 启动并已初始化进程组时自动进入数据并行模式：训练时用 DDP 同步可训练参数的梯度，
+        评估时各 rank 只跑自己的数据分片再汇总指标；日志、指标写入与 checkpoint 只在 rank 0 进行。
+        三个 loader 也可以是 DeviceResidentLoader：batch 直接在设备上按下标 gather 生成，不经过 DataLoader 与 collate
+        """
         self.model = model.to(device)
         self.device = device
         self.train_loader = train_loader
@@ -22,7 +50,32 @@ class ImprovedDrugSynergyTrainer:
         self.test_loader = test_loader
         self.criterion = torch.nn.CrossEntropyLoss()
 
+        if precision != 'fp32' and precision not in AUTOCAST_DTYPES:
+            raise ValueError(f"不支持的精度: {precision}")
+        self.precision = precision
+        self.accumulation_steps = max(1, accumulation_steps)
+        self.log_every = max(1, log_every)
+        self.world_size = get_world_size()
+        self.is_main = is_main_process()
+
+        if compile_modules:
+            self._compile_submodules()
+
+        # 训练用的前向入口：分布式时为 DDP 包装 (只对 requires_grad 的参数做梯度同步，冻结的 Qwen 基座不参与)；
+        # 评估与 checkpoint 仍直接使用 self.model，避免 DDP 在前向时做 buffer 广播等集合通信
+        self.train_model = self.model
+        if is_distributed():
+            self.train_model = DistributedDataParallel(
+                self.model, device_ids=[device.index] if device.type == 'cuda' else None)
+
+        self.step_timer = None
+        if instrument and self.is_main:
+            self.step_timer = StepTimer(device, log_path=instrument_log, profile_steps=profile_steps,
+                                        profile_dir=profile_dir)
+            self.model.stage_timer = self.step_timer
+
         qwen_params = []
+        lora_params = []
         new_params = []
         
         # vģЅ
@@ -31,138 +84,288 @@ class ImprovedDrugSynergyTrainer:
                 continue
             
             # --- ע⣺@ֱ for ѭhĿsM ---
-            if 'qwen' in name:
+            if 'lora_' in name:
+                lora_params.append(param)
+            elif 'qwen' in name:
                 qwen_params.append(param)
             else:
                 new_params.append(param)
             # ------------------------------------------
 
         # O֌ӌW
-        self.optimizer = torch.optim.AdamW([
+        param_groups = [
             {'params': qwen_params, 'lr': 1e-5},     # Qwen ΢{
             {'params': new_params, 'lr': 5e-4}       # GCN/ͶӰ/ ٌW
-        ], weight_decay=0.01)
+        ]
+        # LoRA 模式下只多一个适配器参数组 (全秩微调的 checkpoint 仍是两个参数组，可照常恢复)
+        if lora_params:
+            param_groups.append({'params': lora_params, 'lr': lora_lr})
+        self.optimizer = torch.optim.AdamW(param_groups, weight_decay=0.01)
+        summary = parameter_summary(self.model)
+        self._print(f"可训练参数 {summary['trainable']:,} / {summary['total']:,} "
+                    f"({summary['trainable'] / summary['total']:.2%})，"
+                    f"AdamW 状态约 {summary['optimizer_state_bytes'] / 2 ** 20:.1f} MB")
 
         self.scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(self.optimizer, T_max=100)
-   
+
+        self.checkpointer = None
+        if checkpoint_dir and self.is_main:
+            self.checkpointer = AsyncCheckpointer(checkpoint_dir, keep_checkpoints)
+        self.start_epoch = 1
+        self.run_id = run_id or new_run_id()
+        if resume_from is not None:
+            self._resume(resume_from)
+        self.metrics_log = MetricsLog(metrics_log, self.run_id) if metrics_log and self.is_main else None
+
+    def _resume(self, path):
+        checkpoint_path = resolve_checkpoint(path)
+        if checkpoint_path is None:
+            self._print(f"未找到可恢复的 checkpoint: {path}，从头开始训练")
+            return
+        checkpoint = load_checkpoint(checkpoint_path, self.model, self.optimizer, self.scheduler,
+                                     map_location=self.device)
+        self.start_epoch = checkpoint['epoch'] + 1
+        self.run_id = checkpoint['extra'].get('run_id', self.run_id)
+        self._print(f"已从 {checkpoint_path} 恢复，继续训练 Epoch {self.start_epoch}")
+
+    def _print(self, *args):
+        # 分布式时只由 rank 0 输出
+        if self.is_main:
+            print(*args)
+
+    def _report_prefix_cache(self, epoch, previous):
+        """
+        文本前缀缓存 (main.PREFIX_CACHE) 启用时输出本 epoch (训练 + 验证) 的命中率与内存占用
+        :param previous: 上一个 epoch 结束时的 stats()，用于把累计计数换算为本 epoch 的增量
+        :return: 当前的 stats()，未启用缓存时为 None
+        """
+        cache = getattr(self.model, 'prefix_cache', None)
+        if cache is None:
+            return None
+        stats = cache.stats()
+        counts = {name: stats[name] - (previous or {}).get(name, 0) for name in ('hits', 'disk_hits', 'misses')}
+        lookups = sum(counts.values())
+        hit_rate = (counts['hits'] + counts['disk_hits']) / lookups if lookups else 0.0
+        self._print(f"Epoch {epoch} 前缀缓存: 命中率 {hit_rate:.1%} (内存 {counts['hits']} / 磁盘 {counts['disk_hits']} / "
+                    f"未命中 {counts['misses']}) | {stats['entries']} 条, {stats['memory_mb']:.0f} MB")
+        return stats
+
+    def _compile_submodules(self):
+        """原地编译 GAT 与投影/分类头 (nn.Module.compile 不改变 state_dict 的键名)；Qwen 本体保持 eager"""
+        for name in ['gcn_drug1', 'gcn_drug2', 'proj_gcn', 'proj_target', 'proj_physchem', 'proj_cell', 'classifier']:
+            module = getattr(self.model, name, None)
+            if module is not None:
+                # 分子图的节点数每个 batch 都不同，使用动态形状避免反复重编译
+                module.compile(dynamic=True)
+
+    def _stage(self, name):
+        if self.step_timer is None:
+            return contextlib.nullcontext()
+        return self.step_timer.stage(name)
+
+    def _autocast(self):
+        if self.precision == 'fp32':
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=AUTOCAST_DTYPES[self.precision])
+
+    def _to_device(self, batch):
+        processed_batch = {}
+        for k, v in batch.items():
+            if hasattr(v, 'to'):
+                processed_batch[k] = v.to(self.device, non_blocking=True)
+            else:
+                processed_batch[k] = v
+        return processed_batch
+
+    def _optimizer_step(self):
+        torch.nn.utils.clip_grad_norm_(self.model.parameters(), 1.0)
+        self.optimizer.step()
+        self.optimizer.zero_grad(set_to_none=True)
 
     def train_epoch(self, epoch):
-        self.model.train()
-        total_loss = 0
-        pbar = tqdm(self.train_loader, desc=f"Epoch {epoch} [Train]")
-        for batch in pbar:
-            processed_batch = {}
-            for k, v in batch.items():
-                if hasattr(v, 'to'):
-                    processed_batch[k] = v.to(self.device)
-                else:
-                    processed_batch[k] = v
-            batch = processed_batch
-
-            self.optimizer.zero_grad()
-            logits = self.model(batch)
-            loss = self.criterion(logits, batch['labels'])
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), 1.0)
-            self.optimizer.step()
-
-            total_loss += loss.item()
-            pbar.set_postfix({'Loss': f'{loss.item():.4f}'})
+        self.train_model.train()
+        # 采样器按 epoch 决定打乱顺序，断点恢复后也能复现同样的 batch 序列
+        # (DeviceResidentLoader 自身实现 set_epoch，并转发给其 batch_sampler)
+        epoch_source = self.train_loader
+        if not hasattr(epoch_source, 'set_epoch'):
+            epoch_source = getattr(self.train_loader, 'batch_sampler', None)
+        if hasattr(epoch_source, 'set_epoch'):
+            epoch_source.set_epoch(epoch - 1)
+        # loss 在设备上累加，只在 log_every 步和 epoch 结束时同步
+        total_loss = torch.zeros((), device=self.device)
+        num_batches = len(self.train_loader)
+        num_steps = 0
+        # 当前累积窗口已 backward 的 micro-batch 数，以及该窗口内每步 loss 实际除以的数 (窗口开始时确定)
+        pending_steps = 0
+        pending_scale = 1
+        self.epoch_samples = 0
+        self.optimizer.zero_grad(set_to_none=True)
+
+        pbar = tqdm(self.train_loader, desc=f"Epoch {epoch} [Train]", disable=not self.is_main)
+        data_iter = iter(pbar)
+        step = 0
+        while True:
+            if self.step_timer is not None:
+                self.step_timer.begin_step(epoch)
+            with self._stage('data_wait'):
+                batch = next(data_iter, None)
+            if batch is None:
+                if self.step_timer is not None:
+                    self.step_timer.cancel_step()
+                break
+            step += 1
+
+            with self._stage('h2d'):
+                batch = self._to_device(batch)
+
+            if pending_steps == 0:
+                # 新窗口按剩余批次数确定大小：最后一个窗口可能不足 accumulation_steps 个，loss 按实际个数取平均
+                pending_scale = min(self.accumulation_steps, max(num_batches - step + 1, 1))
+            is_update_step = pending_steps + 1 == pending_scale
+            # 梯度累积的中间步跳过 DDP 的梯度 all-reduce，只在真正更新参数前同步一次
+            sync_context = contextlib.nullcontext()
+            if self.train_model is not self.model and not is_update_step:
+                sync_context = self.train_model.no_sync()
+
+            with sync_context:
+                with self._autocast():
+                    logits = self.train_model(batch)
+                    loss = self.criterion(logits.float(), batch['labels'])
+                with self._stage('backward'):
+                    (loss / pending_scale).backward()
+            total_loss += loss.detach()
+            num_steps = step
+            self.epoch_samples += len(batch['labels'])
+
+            pending_steps = 0 if is_update_step else pending_steps + 1
+
+            if is_update_step:
+                with self._stage('optimizer'):
+                    self._optimizer_step()
+
+            if self.step_timer is not None:
+                num_samples = len(batch['labels'])
+                # 序列长度 = 7 个软 token + 文本 token (需 collate 阶段预分词才能统计)
+                num_tokens = num_samples * 7
+                if 'attention_mask' in batch:
+                    num_tokens += int(batch['attention_mask'].sum())
+                self.step_timer.end_step(num_samples, num_tokens)
+
+            if step % self.log_every == 0:
+                pbar.set_postfix({'Loss': f'{(total_loss / step).item():.4f}'})
+
+        # 批次数不能被累积步数整除 (如 token_budget 分桶导致 len 估计偏差) 时补上最后一次更新
+        if pending_steps:
+            grads = [p.grad for p in self.model.parameters() if p.grad is not None]
+            if self.train_model is not self.model:
+                # 最后几步在 no_sync 下累积，手动把梯度在各 rank 间求和
+                all_reduce_sum(*grads)
+            # 这几步的 loss 都除以了 pending_scale，改为按实际累积的步数 (及 rank 数) 取平均
+            for grad in grads:
+                grad.mul_(pending_scale / (pending_steps * self.world_size))
+            self._optimizer_step()
+
+        if self.step_timer is not None:
+            self.step_timer.epoch_summary()
 
         self.scheduler.step()
-        return total_loss / len(self.train_loader)
+        return (total_loss / max(num_steps, 1)).item()
 
-    def evaluate(self, dataloader, epoch, phase="Validation"):
+    def evaluate(self, dataloader, epoch, phase="Validation", exact=False):
+        """
+        指标在设备上流式累积 (混淆矩阵 + 概率直方图)，循环内不做 .item() / .cpu() 同步
+        :param exact: True 时保留全部概率并用 sklearn 精确计算 AUROC / AUPRC (用于最终测试集)
+        """
         self.model.eval()
-        total_loss = 0
-
-        all_labels = []
-        all_preds = []
-        all_probs = []
+        total_loss = torch.zeros((), device=self.device)
+        num_batches = 0
+        metrics = StreamingBinaryMetrics(self.device, exact=exact)
 
         with torch.no_grad():
-            for batch in tqdm(dataloader, desc=f"Epoch {epoch} [{phase}]"):
-                processed_batch = {}
-                for k, v in batch.items():
-                    if hasattr(v, 'to'):
-                        processed_batch[k] = v.to(self.device)
-                    else:
-                        processed_batch[k] = v
-                batch = processed_batch
-
-                logits = self.model(batch)
+            for batch in tqdm(dataloader, desc=f"Epoch {epoch} [{phase}]", disable=not self.is_main):
+                batch = self._to_device(batch)
+
+                with self._autocast():
+                    logits = self.model(batch).float()
                 loss = self.criterion(logits, batch['labels'])
-                total_loss += loss.item()
+                total_loss += loss.detach()
+                num_batches += 1
 
-                # ?logits 转换为概?(经过 softmax 取正类即 index=1 的概?
+                # 将 logits 转换为概率 (经过 softmax 取正类即 index=1 的概率)
                 probs = F.softmax(logits, dim=1)[:, 1]
                 # 获取预测类别
                 preds = torch.argmax(logits, dim=1)
+                metrics.update(probs, preds, batch['labels'])
 
-                # 收集用于计算指标的数?
-                all_labels.extend(batch['labels'].cpu().numpy())
-                all_preds.extend(preds.cpu().numpy())
-                all_probs.extend(probs.cpu().numpy())
-
-        avg_loss = total_loss / len(dataloader)
-
-        # 计算各类指标 (zero_division=0 防止?警告)
-        acc = accuracy_score(all_labels, all_preds)
-        f1 = f1_score(all_labels, all_preds, zero_division=0)
-        prec = precision_score(all_labels, all_preds, zero_division=0)
-        rec = recall_score(all_labels, all_preds, zero_division=0)
-
-        # 对于 ROC ?PRC，需要模型输出的预测概率，而不?0/1 标签
-        try:
-            auroc = roc_auc_score(all_labels, all_probs)
-        except ValueError:
-            auroc = 0.0  # 防止 batch 内只有一个类别导致报?
-
-        auprc = average_precision_score(all_labels, all_probs)
-        mcc = matthews_corrcoef(all_labels, all_preds)
-        kappa = cohen_kappa_score(all_labels, all_preds)
+        # 分布式时汇总各 rank 分片上的 loss 与计数
+        batch_count = torch.tensor(float(num_batches), device=self.device)
+        all_reduce_sum(total_loss, batch_count)
+        metrics.all_reduce()
+        avg_loss = (total_loss / batch_count.clamp(min=1)).item()
+        results = metrics.compute()
 
         # 打印到控制台
-        print(f"\n--- Epoch {epoch} {phase} Results ---")
-        print(f"Loss: {avg_loss:.4f} | ACC: {acc:.4f} | F1: {f1:.4f} | PREC: {prec:.4f} | Recall: {rec:.4f}")
-        print(f"AUROC: {auroc:.4f} | AUPRC: {auprc:.4f} | MCC: {mcc:.4f} | KAPPA: {kappa:.4f}\n")
-
-        # 返回字典以便保存?Excel
-        return {
-            'Epoch': epoch,
-            'Phase': phase,
-            'Loss': avg_loss,
-            'ACC': acc,
-            'F1': f1,
-            'PREC': prec,
-            'Recall': rec,
-            'AUROC': auroc,
-            'AUPRC': auprc,
-            'MCC': mcc,
-            'KAPPA': kappa
-        }
+        self._print(f"\n--- Epoch {epoch} {phase} Results ---")
+        self._print(f"Loss: {avg_loss:.4f} | ACC: {results['ACC']:.4f} | F1: {results['F1']:.4f} | "
+                    f"PREC: {results['PREC']:.4f} | Recall: {results['Recall']:.4f}")
+        self._print(f"AUROC: {results['AUROC']:.4f} | AUPRC: {results['AUPRC']:.4f} | "
+                    f"MCC: {results['MCC']:.4f} | KAPPA: {results['KAPPA']:.4f}\n")
+
+        record = {'Epoch': epoch, 'Phase': phase, 'Loss': avg_loss, **results}
+        # 立即追加到指标日志，不等训练结束
+        if self.metrics_log is not None:
+            self.metrics_log.append(record)
+        return record
 
     def train(self, num_epochs):
-        print("ʼѵ")
-        all_metrics = []  # 用于收集所?Epoch 的评估结?
+        self._print("ʼѵ")
+        if self.metrics_log is not None:
+            self._print(f"Run ID: {self.metrics_log.run_id} | 指标日志: {self.metrics_log.path}")
+        if self.world_size > 1:
+            self._print(f"数据并行训练: {self.world_size} 个进程")
 
-        for epoch in range(1, num_epochs + 1):
+        prefix_stats = None
+        for epoch in range(self.start_epoch, num_epochs + 1):
             start_time = time.time()
 
             # 1. 训练一?Epoch
             train_loss = self.train_epoch(epoch)
-            print(
-                f"Epoch {epoch} 训练阶段完成 | 耗时: {time.time() - start_time:.1f}s | 平均 Train Loss: {train_loss:.4f}")
+            elapsed = time.time() - start_time
+            # 全局吞吐 = 所有 rank 处理的样本总数 / 墙钟时间，用于观察随进程数的扩展性
+            samples = torch.tensor(float(self.epoch_samples), device=self.device)
+            loss_sum = torch.tensor(train_loss, device=self.device)
+            all_reduce_sum(samples, loss_sum)
+            train_loss = loss_sum.item() / self.world_size
+            throughput = samples.item() / elapsed
+            self._print(
+                f"Epoch {epoch} 训练阶段完成 | 耗时: {elapsed:.1f}s | 平均 Train Loss: {train_loss:.4f} | "
+                f"吞吐: {throughput:.1f} samples/s ({self.world_size} 个进程)")
+            if self.metrics_log is not None:
+                self.metrics_log.append({'Epoch': epoch, 'Phase': 'Train', 'Loss': train_loss,
+                                         'samples_per_s': throughput, 'world_size': self.world_size})
 
             # 2. 在验证集上评?
-            val_metrics = self.evaluate(self.val_loader, epoch, phase="Validation")
-            all_metrics.append(val_metrics)
+            self.evaluate(self.val_loader, epoch, phase="Validation")
+            prefix_stats = self._report_prefix_cache(epoch, prefix_stats)
+
+            # 只保存可训练参数的增量，快照后由后台线程写盘
+            if self.checkpointer is not None:
+                self.checkpointer.save(build_checkpoint(self.model, self.optimizer, self.scheduler, epoch,
+                                                        extra={'run_id': self.run_id}))
 
             # 及时清理显存防止爆存
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
 
-        # 3. 整个训练结束后，将所有验证指标保存到 Excel
-        print("正在将评估指标保存到 Excel...")
-        save_metrics_to_excel(all_metrics, filename='training_metrics.xlsx')
-        print("Training completed.")
\ No newline at end of file
+        if self.checkpointer is not None:
+            self.checkpointer.wait()
+
+        # 最终测试集用精确指标评估一次
+        self.evaluate(self.test_loader, num_epochs, phase="Test", exact=True)
+
+        # 3. 指标已逐条写入日志，Excel 按需导出
+        if self.metrics_log is not None:
+            self._print(f"导出 Excel: python metrics.py export --log {self.metrics_log.path} --run-id {self.metrics_log.run_id}")
+        if self.step_timer is not None:
+            self.step_timer.close()
+        self._print("Training completed.")
\ No newline at end of file
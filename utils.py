@@ -1,16 +1,10 @@
-import pandas as pd
+from collections import OrderedDict
+
+import numpy as np
 import torch
 from torch_geometric.data import Data, Batch
 
-def save_metrics_to_excel(epoch_metrics, filename='training_metrics.xlsx'):
-    df = pd.DataFrame(epoch_metrics)
-    try:
-        existing_df = pd.read_excel(filename)
-        updated_df = pd.concat([existing_df, df], ignore_index=True)
-        updated_df.to_excel(filename, index=False)
-    except FileNotFoundError:
-        df.to_excel(filename, index=False)
-    print(f"Metrics saved to {filename}")
+from graph_store import gather_graphs
 
 def collate_fn(batch):
     graph1_list, graph2_list = [], []
@@ -20,11 +14,17 @@ def collate_fn(batch):
         graph1_list.append(Data(x=x1, edge_index=e1))
         graph2_list.append(Data(x=x2, edge_index=e2))
 
-    res = {
+    return {
         'graph1': Batch.from_data_list(graph1_list),
         'graph2': Batch.from_data_list(graph2_list),
-        'target1': torch.stack([s['target1'] for s in batch]),
-        'target2': torch.stack([s['target2'] for s in batch]),
+        **_collate_features(batch)
+    }
+
+def _collate_features(batch):
+    """分子图以外的字段"""
+    return {
+        **_collate_targets(batch, 'target1'),
+        **_collate_targets(batch, 'target2'),
         'physchem1': torch.stack([s['physchem1'] for s in batch]),
         'physchem2': torch.stack([s['physchem2'] for s in batch]),
         'cell_expr': torch.stack([s['cell_expr'] for s in batch]),
@@ -33,18 +33,168 @@ def collate_fn(batch):
         'drug1_smiles': [s['drug1_smiles'] for s in batch],
         'drug2_smiles': [s['drug2_smiles'] for s in batch]
     }
-    return res
+
+def create_packed_collate_fn(processor):
+    """
+    按药物 ID 拼批量图的 collate：全部分子图预先按药物打包为扁平数组 + 偏移表，
+    collate 时由 gather_graphs 几次向量化操作直接得到 x / 平移后的 edge_index / batch / ptr，
+    不再逐样本构造 Data 再 Batch.from_data_list。输出与 collate_fn 相同，可直接交给 DrugGAT 与 global_mean_pool。
+    样本需带 drug1_id / drug2_id (特征仓库模式的 process_ids)，数据集设置 include_graphs=False 可跳过逐样本取图；
+    augment=True 的分子图增强只作用于逐样本的图，此时应使用 collate_fn。
+    """
+    drug_slots, graph_arrays = processor.packed_drug_graphs()
+
+    def packed_collate_fn(batch):
+        drug1 = torch.tensor([s['drug1_id'] for s in batch], dtype=torch.long)
+        drug2 = torch.tensor([s['drug2_id'] for s in batch], dtype=torch.long)
+        return {
+            'graph1': gather_graphs(graph_arrays, drug_slots[drug1]),
+            'graph2': gather_graphs(graph_arrays, drug_slots[drug2]),
+            **_collate_features(batch)
+        }
+    return packed_collate_fn
+
+def _collate_targets(batch, name):
+    """稠密靶点向量直接 stack；稀疏靶点拼成 embedding_bag 的 (indices, offsets, weights)"""
+    if name in batch[0]:
+        return {name: torch.stack([s[name] for s in batch])}
+    indices = [s[f'{name}_indices'] for s in batch]
+    counts = torch.tensor([len(i) for i in indices], dtype=torch.long)
+    return {
+        f'{name}_indices': torch.cat(indices),
+        f'{name}_offsets': torch.cumsum(counts, 0) - counts,
+        f'{name}_weights': torch.cat([s[f'{name}_weights'] for s in batch])
+    }
 
 def create_safe_collate_fn(processor):
     def safe_collate_fn(batch):
         valid_samples = []
         for sample in batch:
             try:
-                if sample['graph1'][0].dim() == 2 and sample['target1'].dim() == 1:
+                target = sample['target1'] if 'target1' in sample else sample['target1_indices']
+                if sample['graph1'][0].dim() == 2 and target.dim() == 1:
                     valid_samples.append(sample)
             except Exception:
                 continue
         if len(valid_samples) == 0:
             return collate_fn([processor._create_default_sample()])
         return collate_fn(valid_samples)
-    return safe_collate_fn
\ No newline at end of file
+    return safe_collate_fn
+
+
+class SmilesTokenCache:
+    """
+    预分词缓存：每个药物对的 "Drug1: {s1}, Drug2: {s2}" 整句只分词一次 (与模型 forward 中的逐批分词结果完全一致)，
+    collate 时直接按缓存的 token id 填充，替代每个 batch 重复分词。
+    token id 存为 int32 数组，按药物对做 LRU，条目数不超过 max_pairs
+    """
+
+    def __init__(self, tokenizer, max_length=128, max_pairs=100000):
+        """
+        :param max_pairs: 缓存的药物对数上限 (每对约 0.3 KB)，None 表示不限
+        """
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.max_pairs = max_pairs
+        self.pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.padding_side = tokenizer.padding_side
+        self.cache = OrderedDict()
+
+    @classmethod
+    def from_pretrained(cls, model_name, max_length=128, max_pairs=100000):
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+        if tokenizer.pad_token is None: tokenizer.pad_token = tokenizer.eos_token
+        return cls(tokenizer, max_length, max_pairs)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def encode(self, smiles1_list, smiles2_list, remember=True):
+        """
+        每个药物对的 token id 序列 (已截断到 max_length)；未缓存的药物对合并为一次批量分词
+        :param remember: 是否把新分词的药物对加入缓存 (全组合筛选等每对只出现一次的场景传 False)
+        """
+        pairs = list(zip(smiles1_list, smiles2_list))
+        found, missing = {}, []
+        for pair in dict.fromkeys(pairs):
+            ids = self.cache.get(pair)
+            if ids is None:
+                missing.append(pair)
+            else:
+                self.cache.move_to_end(pair)
+                found[pair] = ids
+        if missing:
+            texts = [f"Drug1: {s1}, Drug2: {s2}" for s1, s2 in missing]
+            encoded = self.tokenizer(texts, truncation=True, max_length=self.max_length)['input_ids']
+            for pair, ids in zip(missing, encoded):
+                found[pair] = np.asarray(ids, dtype=np.int32)
+                if remember:
+                    self.cache[pair] = found[pair]
+            while self.max_pairs is not None and len(self.cache) > self.max_pairs:
+                self.cache.popitem(last=False)
+        return [found[pair] for pair in pairs]
+
+    def encode_pair(self, smiles1, smiles2):
+        """单个药物对的 token id 序列 (已截断到 max_length)"""
+        return self.encode([smiles1], [smiles2])[0]
+
+    def encode_pairs(self, smiles1_list, smiles2_list, remember=True):
+        """批量填充，返回 (input_ids, attention_mask)，两者均为 [B, L] 的 long 张量"""
+        seqs = self.encode(smiles1_list, smiles2_list, remember)
+        lengths = torch.tensor([len(seq) for seq in seqs], dtype=torch.long)
+        max_len = int(lengths.max()) if len(seqs) else 0
+
+        positions = torch.arange(max_len).unsqueeze(0)
+        if self.padding_side == 'left':
+            attention_mask = positions >= (max_len - lengths).unsqueeze(1)
+        else:
+            attention_mask = positions < lengths.unsqueeze(1)
+
+        input_ids = torch.full((len(seqs), max_len), self.pad_id, dtype=torch.long)
+        if seqs:
+            input_ids[attention_mask] = torch.from_numpy(np.concatenate(seqs)).long()
+        return input_ids, attention_mask.long()
+
+
+def create_tokenized_collate_fn(token_cache, base_collate_fn=collate_fn):
+    """在原有 collate 结果上附加预分词的 input_ids / attention_mask"""
+    def tokenized_collate_fn(batch):
+        res = base_collate_fn(batch)
+        res['input_ids'], res['attention_mask'] = token_cache.encode_pairs(res['drug1_smiles'], res['drug2_smiles'])
+        return res
+    return tokenized_collate_fn
+
+# Qwen2 的预分词正则，使小模型分词器的切分边界与真实 Qwen 一致
+_QWEN_PRETOKENIZE_PATTERN = (r"(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}| ?[^\s\p{L}\p{N}]+[\r\n]*"
+                             r"|\s*[\r\n]+|\s+(?!\S)|\s+")
+
+
+def build_tiny_qwen(save_dir, smiles_list, vocab_size=600, hidden_size=64, num_layers=4, num_heads=4):
+    """
+    在本地目录生成一个随机初始化的小型 Qwen2 模型及字节级 BPE 分词器 (在 SMILES 语料上训练)，
+    可直接作为 qwen_model_name 传入 QwenEnhancedDrugSynergyModel，无需联网下载即可在 CPU 上验证流程
+    """
+    from tokenizers import Tokenizer, Regex, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast, Qwen2Config, Qwen2Model
+
+    smiles_list = list(smiles_list)
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.Sequence([
+        pre_tokenizers.Split(Regex(_QWEN_PRETOKENIZE_PATTERN), behavior='isolated'),
+        pre_tokenizers.ByteLevel(add_prefix_space=False, use_regex=False)
+    ])
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=['<|endoftext|>'],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(
+        [f"Drug1: {s1}, Drug2: {s2}" for s1, s2 in zip(smiles_list, smiles_list[1:] + smiles_list[:1])], trainer)
+    hf_tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token='<|endoftext|>',
+                                           pad_token='<|endoftext|>')
+
+    config = Qwen2Config(vocab_size=len(hf_tokenizer), hidden_size=hidden_size, intermediate_size=hidden_size * 2,
+                         num_hidden_layers=num_layers, num_attention_heads=num_heads,
+                         num_key_value_heads=max(1, num_heads // 2), max_position_embeddings=512)
+    Qwen2Model(config).save_pretrained(save_dir)
+    hf_tokenizer.save_pretrained(save_dir)
+    return save_dir